@@ -1,16 +1,19 @@
 """Helper functions for arraySpiker which are used to import, process, and analyse the spiked in data."""
 
 from __future__ import print_function
+import collections
+import functools
+import glob
 import itertools
-import matplotlib
-import matplotlib.pyplot as plt
+import multiprocessing
 import numpy as np
 import os
 import pandas
-import re
-import seaborn as sns  # Produces heatmap of results which are useful for debugging
 import datetime
 import yaml  # pyYAML
+from archive_helpers import COMPRESSED_SUFFIXES, fe_file_subarray, is_archive, iter_archive_fe_files, open_fe_file
+from cache_helpers import SIGNATURE_BYTES, cache_file_path, cache_key, load_cached_columns, save_cached_columns
+from profiling_helpers import profile_call
 
 
 def create_output_directory(directory):
@@ -24,83 +27,296 @@ def create_output_directory(directory):
     return directory
 
 
+def iter_spiked_probes_combinations(spike_in_probes, n=3):
+    """Lazily generate each unique combination of n probes, in the same order as
+    calculate_spiked_probes_combinations(), without holding them all in memory"""
+    return itertools.combinations(spike_in_probes, n)
+
+
 def calculate_spiked_probes_combinations(spike_in_probes, n=3):
     """From a list of n probes calculate a unique permutation of three probes to spike to each sample on
     the array.  NOTE: As lexigraphical order is irrelevant we use itertools.combinations rather than
     itertools.permutations for this task"""
-    spike_in_trios = list(itertools.combinations(spike_in_probes, n))
-    return list(spike_in_trios)
+    spike_in_trios = list(iter_spiked_probes_combinations(spike_in_probes, n))
+    return spike_in_trios
 
 
 def num_spiked_probes_combinations(spike_in_probes, n=3):
-    """Number of unique combinations of trios for n probes i.e For 10 probes 120 unique combinations"""
-    num_of_combinations = len(calculate_spiked_probes_combinations(spike_in_probes, n))
+    """Number of unique combinations of trios for n probes i.e For 10 probes 120 unique combinations.
+    Calculated in closed form (binomial coefficient) rather than by generating the combinations."""
+    num_probes = len(spike_in_probes)
+    if n > num_probes:
+        return 0
+    num_of_combinations = 1
+    for i in range(n):
+        # Each partial product is itself a binomial coefficient so integer division is exact:
+        num_of_combinations = num_of_combinations * (num_probes - i) // (i + 1)
     return num_of_combinations
 
 
-def parse_config_file():
+# Cache of parsed config.yaml files keyed by path, so that the config is only read once per process rather than
+# once for every FE file imported:
+_config_cache = {}
+
+
+def load_config(config_file="config.yaml"):
+    """Parses config.yaml file returning a dictionary of all settings. Result is cached for the life of the process."""
+    if config_file not in _config_cache:
+        with open(config_file, 'r') as yaml_file:
+            try:
+                _config_cache[config_file] = yaml.safe_load(yaml_file)
+            except yaml.YAMLError as exc:
+                print(exc)
+                raise
+    return _config_cache[config_file]
+
+
+def parse_config_file(config_file="config.yaml"):
     """Parses config.yaml file returning list of Spike In probes"""
-    with open("config.yaml", 'r') as yaml_file:
-        try:
-            config = yaml.load(yaml_file)
-            # Import spike in probe IDs
-            spike_in_probes = config["spikeInProbes"]
-        except yaml.YAMLError as exc:
-            print(exc)
+    # Import spike in probe IDs
+    spike_in_probes = load_config(config_file)["spikeInProbes"]
     return spike_in_probes
 
 
-def parse_data_file(fe_file):
-    """Parses Agilent Array Feature Extraction (FE) files returning Pandas dataframe of selected fields"""
-    f = open(fe_file, "r")
-    spike_in_probes = parse_config_file()
-    d = []  # Initialises matrix to hold extracted lines.
-    for line in f:
-        for probe in spike_in_probes:
-            if re.match("(.*)%s(.*)" % probe, line):
-                fields = line.strip().split()
-                # Extracted relevant fields - (0-based indexing)
-                d.append({'FeatureNum': fields[1], 'ProbeName': fields[6], 'SystematicName': fields[7],
-                          'gProcessedSignal': fields[13], 'rProcessedSignal': fields[14], 'gMedianSignal': fields[17],
-                          'rMedianSignal': fields[18], 'gBGMedianSignal': fields[19], 'rBGMedianSignal': fields[20],
-                          'gIsSaturated': fields[23], 'rIsSaturated': fields[24]})
-    df = pandas.DataFrame(d)
-    # Cast columns to int or float as appropriate:
-    df[['gIsSaturated', 'rIsSaturated']] = df[['gIsSaturated', 'rIsSaturated']].astype(int)
-    df[['gProcessedSignal', 'rProcessedSignal', 'gMedianSignal', 'rMedianSignal', 'gBGMedianSignal',
-        'rBGMedianSignal']] = df[
-        ['gProcessedSignal', 'rProcessedSignal', 'gMedianSignal', 'rMedianSignal', 'gBGMedianSignal',
-         'rBGMedianSignal']].astype(float)
+# Fields extracted from the FEATURES table of each FE file and the numpy dtype each is cast to.  Column positions
+# are looked up by name from the FEATURES header row so do not depend on the FE protocol version.
+FE_FIELDS = [('FeatureNum', int), ('ProbeName', str), ('SystematicName', str),
+             ('gProcessedSignal', float), ('rProcessedSignal', float),
+             ('gMedianSignal', float), ('rMedianSignal', float),
+             ('gBGMedianSignal', float), ('rBGMedianSignal', float),
+             ('gIsSaturated', int), ('rIsSaturated', int)]
+
+
+def parse_fe_lines(lines, spike_in_probes):
+    """Extracts spike in probe rows from an iterable of FE file lines (bytes) in a single pass.
+    Returns a dictionary mapping each field in FE_FIELDS to a typed numpy array.
+
+    FE files contain three tab-delimited tables (FEPARAMS, STATS, FEATURES) each introduced by a TYPE line and a
+    header row. Column positions are taken from the FEATURES header row and each data row is matched by a set lookup
+    on its ProbeName column.  Only matching rows are split in full."""
+    wanted = set(probe.encode('ascii') for probe in spike_in_probes)
+    columns = None  # Column index of each field, set once the FEATURES header row has been read
+    probe_col = None
+    rows = []
+    for line in lines:
+        if columns is None:
+            # Skip FEPARAMS and STATS tables until the FEATURES header row is found:
+            if line.startswith(b"FEATURES"):
+                header = line.rstrip(b"\r\n").split(b"\t")
+                try:
+                    columns = [header.index(name.encode('ascii')) for name, _ in FE_FIELDS]
+                except ValueError as exc:
+                    raise ValueError("FEATURES header is missing an expected column: %s" % exc)
+                probe_col = header.index(b"ProbeName")
+            continue
+        # Split only as far as the ProbeName column to test for a match:
+        fields = line.split(b"\t", probe_col + 1)
+        if len(fields) > probe_col and fields[probe_col] in wanted:
+            fields = line.rstrip(b"\r\n").split(b"\t")
+            rows.append([fields[i] for i in columns])
+    if columns is None:
+        raise ValueError("No FEATURES table found in Feature Extraction file")
+    data = {}
+    for i, (name, dtype) in enumerate(FE_FIELDS):
+        values = [row[i] for row in rows]
+        if dtype is str:
+            data[name] = np.array([value.decode('ascii') for value in values], dtype=str)
+        else:
+            # numpy parses numeric byte strings directly:
+            data[name] = np.array(values, dtype=bytes).astype(dtype) if values else np.array([], dtype=dtype)
+    return data
+
+
+def _bytes_read(file_path, cache_dir, key, cache_hit):
+    """Return the bytes read to import file_path: the start of the file hashed for its cache key (if cached), then
+    either the cache entry or the whole file"""
+    signature_bytes = 0 if key is None else min(os.path.getsize(file_path), SIGNATURE_BYTES)
+    if cache_hit:
+        return signature_bytes + os.path.getsize(cache_file_path(cache_dir, key))
+    return signature_bytes + os.path.getsize(file_path)
+
+
+def read_fe_columns(fe_file, spike_in_probes=None, cache_dir=None, stats=None):
+    """Reads an Agilent Array Feature Extraction (FE) file returning a dictionary of typed numpy arrays, one for each
+    field in FE_FIELDS, containing only the rows for spike in probes. Compressed FE files are decompressed as they
+    are read (see archive_helpers.py). If cache_dir is given the extracted rows are reused from, or saved to, the
+    cache (see cache_helpers.py). If a stats dictionary is given the bytes read, rows matched and whether the cache
+    was used are added to it (see profiling_helpers.py)"""
+    if spike_in_probes is None:
+        spike_in_probes = parse_config_file()
+    key = None
+    data = None
+    if cache_dir is not None:
+        key = cache_key(fe_file, spike_in_probes)
+        data = load_cached_columns(cache_dir, key)
+    cache_hit = data is not None
+    if not cache_hit:
+        with open_fe_file(fe_file) as f:
+            data = parse_fe_lines(f, spike_in_probes)
+        if key is not None:
+            save_cached_columns(cache_dir, key, data)
+    if stats is not None:
+        stats['bytes_read'] = _bytes_read(fe_file, cache_dir, key, cache_hit)
+        stats['rows_matched'] = len(data['ProbeName'])
+        stats['cache_hit'] = cache_hit
+    return data
+
+
+def read_archive_columns(archive, spike_in_probes=None, cache_dir=None, stats=None):
+    """Reads the FE files in a slide archive (see archive_helpers.py) in a single pass, returning the same dictionary
+    as read_fe_columns() for all of the files plus FE_filename, the path of the file each row was read from
+    (<archive path>/<FE file name>). Files are in order of subarray. The archive is cached as a single entry."""
+    if spike_in_probes is None:
+        spike_in_probes = parse_config_file()
+    key = None
+    data = None
+    if cache_dir is not None:
+        key = cache_key(archive, spike_in_probes)
+        data = load_cached_columns(cache_dir, key)
+    cache_hit = data is not None
+    if not cache_hit:
+        files = sorted(((fe_file_subarray(file_name), file_name, parse_fe_lines(f, spike_in_probes))
+                        for file_name, f in iter_archive_fe_files(archive)), key=lambda member: member[:2])
+        data = dict((name, np.concatenate([np.array([], dtype=dtype)] + [columns[name] for _, _, columns in files]))
+                    for name, dtype in FE_FIELDS)
+        data['FE_filename'] = np.array([os.path.join(archive, file_name) for _, file_name, columns in files
+                                        for _ in range(len(columns['ProbeName']))], dtype=str)
+        if key is not None:
+            save_cached_columns(cache_dir, key, data)
+    if stats is not None:
+        stats['bytes_read'] = _bytes_read(archive, cache_dir, key, cache_hit)
+        stats['rows_matched'] = len(data['ProbeName'])
+        stats['cache_hit'] = cache_hit
+    return data
+
+
+def parse_data_file(fe_file, spike_in_probes=None, cache_dir=None, stats=None):
+    """Parses Agilent Array Feature Extraction (FE) files returning Pandas dataframe of selected fields. A slide archive
+    returns the rows of all of the FE files in it"""
+    if is_archive(fe_file):
+        data = read_archive_columns(fe_file, spike_in_probes, cache_dir, stats)
+    else:
+        data = read_fe_columns(fe_file, spike_in_probes, cache_dir, stats)
+    df = pandas.DataFrame(data, columns=[name for name, _ in FE_FIELDS])
     # Add column identifying the file which the data was imported from:
-    df['FE_filename'] = fe_file
+    df['FE_filename'] = data.get('FE_filename', fe_file)
     return df
 
 
-# Function reiterates through all FE files for a run and aggregates the data into one dataframe:
-def import_data(fe_files):
-    first_import = True  # Set before for loop below
-    for fe_file in fe_files:
-        # On importing first set of data initialise dataframe, additional datasets are then appended to
-        # to this dataframe:
-        # TODO check if I need if statement to initialise df
-        if first_import is True:
-            df = parse_data_file(fe_file)
-            first_import = False
-        else:
-            df2 = parse_data_file(fe_file)
-            df = df.append(df2)
+def import_data(fe_files, spike_in_probes=None, jobs=1, cache_dir=None, profiler=None):
+    """Parses all FE files for a run and aggregates the data into one dataframe. Where jobs > 1 files are parsed in
+    parallel by a pool of worker processes (jobs=0 uses all available cores). Rows are always returned in the order of
+    fe_files. If cache_dir is given previously extracted rows are reused from the cache. If an enabled
+    profiling_helpers.Profiler is given the resources used to parse each file are recorded in it."""
+    if not fe_files:
+        raise ValueError("No FE files to import")
+    if spike_in_probes is None:
+        spike_in_probes = parse_config_file()
+    if jobs == 0:
+        jobs = multiprocessing.cpu_count()
+    jobs = min(jobs, len(fe_files))
+    parse_file = functools.partial(parse_data_file, spike_in_probes=spike_in_probes, cache_dir=cache_dir)
+    profile = profiler is not None and profiler.enabled
+    if profile:
+        # Each file is measured where it is parsed and the measurements returned with its dataframe:
+        parse_file = functools.partial(profile_call, parse_file)
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            # Pool.map returns results in the order of the input list regardless of which worker finishes first:
+            data_frames = pool.map(parse_file, fe_files, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        data_frames = [parse_file(fe_file) for fe_file in fe_files]
+    if profile:
+        for _, metrics in data_frames:
+            profiler.add_file(metrics)
+        data_frames = [data_frame for data_frame, _ in data_frames]
+    # Single concatenation rather than growing the dataframe for every file:
+    df = pandas.concat(data_frames, ignore_index=True)
     return df
 
 
+# Fields holding the saturation flag for the green and red channels, in the order used for the channel axis of the
+# arrays built by build_replicate_array():
+SATURATION_FIELDS = ('gIsSaturated', 'rIsSaturated')
+
+# Result of replicate_consensus(). Arrays are indexed [sample, probe, channel] except saturation which has an extra
+# replicate axis [sample, probe, replicate, channel] and bitmask which is [sample, channel]:
+ReplicateConsensus = collections.namedtuple('ReplicateConsensus', [
+    'samples',  # Sample labels (FE_filename) in order of first appearance
+    'probes',  # Spike in probe names, bit i of bitmask corresponds to probes[i]
+    'saturation',  # Saturation flag for each replicate, -1 where the replicate is missing from the FE file
+    'counts',  # Number of saturated replicates
+    'replicates',  # Number of replicates present in the FE file
+    'calls',  # True where the probe is considered present
+    'discordant',  # True where the replicates disagree
+    'bitmask',  # Integer with bit i set if probes[i] is called present
+])
+
+
+def build_replicate_array(df, spike_in_probes, fields=SATURATION_FIELDS, fill=-1, dtype=np.int8):
+    """Reshape the rows for a run into a samples x probes x replicates x channels array. Returns the sample labels
+    and the array. Replicates are numbered in the order they appear in each FE file, positions with no data are set
+    to fill and rows for probes not in spike_in_probes are ignored."""
+    sample_codes, samples = pandas.factorize(df['FE_filename'])
+    probe_codes = pandas.Index(spike_in_probes).get_indexer(df['ProbeName'])
+    replicate_codes = df.groupby(['FE_filename', 'ProbeName'], sort=False).cumcount().values
+    keep = probe_codes >= 0
+    num_replicates = replicate_codes[keep].max() + 1 if keep.any() else 0
+    data = np.full((len(samples), len(spike_in_probes), num_replicates, len(fields)), fill, dtype=dtype)
+    for channel, field in enumerate(fields):
+        data[sample_codes[keep], probe_codes[keep], replicate_codes[keep], channel] = df[field].values[keep]
+    return list(samples), data
+
+
+def calls_to_bitmask(calls):
+    """Collapse a samples x probes x channels array of calls into a samples x channels array of bitmasks, bit i
+    representing the i-th probe"""
+    probe_bits = np.left_shift(1, np.arange(calls.shape[1], dtype=np.int64))
+    return (calls * probe_bits[np.newaxis, :, np.newaxis]).sum(axis=1)
+
+
+def bitmask_to_calls(bitmasks, num_probes):
+    """Expand a samples x channels array of bitmasks into a samples x probes x channels array of calls. Negative
+    bitmasks (unknown) give True for every probe"""
+    probe_bits = np.left_shift(1, np.arange(num_probes, dtype=np.int64))
+    return np.bitwise_and(np.asarray(bitmasks, dtype=np.int64)[:, np.newaxis, :],
+                          probe_bits[np.newaxis, :, np.newaxis]) > 0
+
+
+def replicate_consensus(df, spike_in_probes, min_replicates=2):
+    """Calls the presence of each spike in probe in each sample and channel from the saturation flags of its
+    replicates in a single vectorised pass. A probe is called present if at least min_replicates replicates are
+    saturated, and flagged as discordant if some, but not all, of its replicates are saturated."""
+    samples, saturation = build_replicate_array(df, spike_in_probes)
+    counts = (saturation == 1).sum(axis=2)
+    replicates = (saturation >= 0).sum(axis=2)
+    calls = counts >= min_replicates
+    discordant = (counts > 0) & (counts < replicates)
+    return ReplicateConsensus(samples, list(spike_in_probes), saturation, counts, replicates, calls, discordant,
+                              calls_to_bitmask(calls))
+
+
 # The array has 3 replicates on the array for each probe - where the data is consistent between each replicate
-# this function collapses the data into a single row, if the replicates disagree it raises an error message
+# this function collapses the data into a single row, if the replicates disagree it prints a warning message
 # identifying the discrepancy.
-def summarise_array_replicates(df, spike_in_probes):
-    # Format data
-    summarised_df = pandas.pivot_table(df, values=['gIsSaturated', 'rIsSaturated'],
-                                       index=['ProbeName'],
-                                       columns=['FE_filename'],
-                                       aggfunc=np.sum)
+def summarise_array_replicates(df, spike_in_probes, consensus=None):
+    """Returns dataframe of the number of saturated replicates for each probe (rows) in each channel and FE file
+    (columns). The replicate_consensus() of df is computed unless given."""
+    if consensus is None:
+        consensus = replicate_consensus(df, spike_in_probes)
+    for sample, probe, channel in zip(*np.nonzero(consensus.discordant)):
+        print("WARNING: Replicates disagree for probe %s in %s (%s): %d of %d replicates saturated" % (
+            consensus.probes[probe], consensus.samples[sample], SATURATION_FIELDS[channel],
+            consensus.counts[sample, probe, channel], consensus.replicates[sample, probe, channel]))
+    # Format data as probes x (channel, sample):
+    columns = pandas.MultiIndex.from_product([list(SATURATION_FIELDS), consensus.samples])
+    summarised_df = pandas.DataFrame(consensus.counts.transpose(1, 2, 0).reshape(len(consensus.probes), -1),
+                                     index=pandas.Index(consensus.probes, name='ProbeName'),
+                                     columns=columns)
     return summarised_df
 
 
@@ -116,17 +332,43 @@ def write_log(dataframe, prefix, directory_path):  # TODO get run ID from MOKA a
     return log_file_path
 
 
+def find_log(output_path, prefix):
+    """Return the latest log of the given prefix saved by write_log() in the output directories created under
+    output_path by create_output_directory(), or None if there is none"""
+    log_files = glob.glob(os.path.join(output_path, "array_spiker_output_*", "%s_*_spikeInLog.txt" % prefix))
+    return max(log_files, key=os.path.getmtime) if log_files else None
+
+
 def make_pretty_label(x_label):  # TODO Make this function fail gracefully
     """Return shortened file name string to make it easier to read in tables and on plots."""
     pretty_label = os.path.basename(x_label)  # Extract basename
+    if pretty_label.endswith(COMPRESSED_SUFFIXES):
+        pretty_label = os.path.splitext(pretty_label)[0]  # Remove compression suffix
     pretty_label = os.path.splitext(pretty_label)[0]  # Remove file suffix
     # Split file name on "_", keep first and last 3 fields and create new label
     pretty_label = pretty_label.split("_")[0] + "_" + "_".join(pretty_label.split("_")[slice(-3, None)])
     return pretty_label
 
 
+def read_log(log_file_path):
+    """Read a log file written by write_log() for a dataframe with two levels of column labels, e.g. the output of
+    summarise_array_replicates() or summarise_signals()"""
+    return pandas.read_csv(log_file_path, header=[0, 1], index_col=0)
+
+
+def _pyplot():
+    """Import pyplot using a backend which renders plots without a display. Plotting modules are only imported when
+    plots are rendered as they are slow to import and not needed for the analysis"""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+
 def heatmap_spike_ins(df, figure_name, directory_path):
     """Visualise results as heatmap to aid in debugging and testing:"""
+    plt = _pyplot()
+    import seaborn as sns  # Produces heatmap of results which are useful for debugging
     fig = sns.heatmap(df, annot=True, vmin=0, vmax=3, cbar=False,
                       # Custom colour map, 0=white, TODO
                       cmap=["White", "#fc9272", "#fc9272", "#2ca25f"], square=True, linewidths=.5)
@@ -140,26 +382,54 @@ def heatmap_spike_ins(df, figure_name, directory_path):
     plt.subplots_adjust(top=0.60)
     output_file_path = os.path.join(directory_path, figure_name)
     plt.savefig(output_file_path)
-    plt.clf()
+    plt.close(fig.figure)
+
+
+# Signal fields plotted by plot_values() for the green and red channels:
+SIGNAL_FIELDS = ('gMedianSignal', 'rMedianSignal')
+
 
+def summarise_signals(df):
+    """Returns dataframe of the minimum, median and maximum signal of each probe (rows) in each channel (columns),
+    across all replicates and FE files. Used by plot_values() so that the plot does not grow with the number of rows"""
+    return df.groupby('ProbeName')[list(SIGNAL_FIELDS)].agg(['min', 'median', 'max'])
 
-def plot_values(dataframe, figure_name, directory_path):
-    """Plots red/green channels for all probes on the same axis"""
+
+def plot_values(signal_df, figure_name, directory_path):
+    """Plots the range and median of the red/green channel signal for each probe on the same axis. Takes the output of
+    summarise_signals()"""
+    plt = _pyplot()
     fig, axarr = plt.subplots(2, sharex="all")
     plt.ylabel("Median Signal")
-    axarr[0].scatter(dataframe['ProbeName'], dataframe['gMedianSignal'], color='green', marker='_')
-    axarr[0].set_ylim([0, 70000])
-    axarr[0].axhline(y=65527, alpha=0.5, dashes=[1, 1], color='grey')
-    axarr[0].tick_params(axis='y', which='major', labelsize=6)
-    axarr[1].scatter(dataframe['ProbeName'], dataframe['rMedianSignal'], color='red', marker='_')
-    axarr[1].set_ylim([0, 70000])
-    axarr[1].axhline(y=65527, alpha=0.5, dashes=[1, 1], color='grey')
-    axarr[1].tick_params(axis='y', which='major', labelsize=6)
-    plt.xticks(rotation='vertical')
+    positions = np.arange(len(signal_df))
+    for ax, field, colour in zip(axarr, SIGNAL_FIELDS, ('green', 'red')):
+        ax.vlines(positions, signal_df[(field, 'min')], signal_df[(field, 'max')], color=colour, alpha=0.5)
+        ax.scatter(positions, signal_df[(field, 'median')], color=colour, marker='_')
+        ax.set_ylim([0, 70000])
+        ax.axhline(y=65527, alpha=0.5, dashes=[1, 1], color='grey')
+        ax.tick_params(axis='y', which='major', labelsize=6)
+    plt.xticks(positions, signal_df.index, rotation='vertical')
     # Create space for x labels
     plt.subplots_adjust(bottom=0.30)
     plt.tick_params(axis='x', which='major', labelsize=6)
     plt.xlabel("Probe Names")
     output_file_path = os.path.join(directory_path, figure_name)
     plt.savefig(output_file_path, format='pdf')
-    plt.clf()
+    plt.close(fig)
+
+
+def render_reports(summary_log, signals_log, directory_path):
+    """Render the heatmap and signal plot from the summary and signal logs saved by array_spiker.py. Allows the plots
+    to be produced after, or in a separate process from, the analysis"""
+    heatmap_spike_ins(read_log(summary_log), "results_heatmap", directory_path)
+    plot_values(read_log(signals_log), "results_plot.pdf", directory_path)
+
+
+def call_safely(function, *args, **kwargs):
+    """Call function, returning (result, None), or (None, error message) if it raised. Used where one process analyses
+    many runs (batch_spiker.py, watch_spiker.py and qc_service.py) so that a failed run does not stop the others.
+    array_spiker.py argument errors raise SystemExit so are also caught."""
+    try:
+        return function(*args, **kwargs), None
+    except (Exception, SystemExit) as exc:
+        return None, "%s: %s" % (type(exc).__name__, exc)
@@ -0,0 +1,109 @@
+"""Helper functions for arraySpiker which read FE files directly from compressed files and slide archives.
+
+FE files may be gzip (.gz) or zstandard (.zst, requires the optional zstandard package) compressed, or archived with
+the other subarrays of their slide as a tarball (.tar, .tar.gz, .tgz or .tar.zst). Files are decompressed in chunks as
+they are read, so the spike in rows are extracted without writing the decompressed file to disk or holding it in
+memory. Archives are read in a single pass, each FE file named as in naming_helpers.create_sample_filename() becoming a
+subarray in the results labelled <archive path>/<FE file name>."""
+
+from __future__ import print_function
+import contextlib
+import gzip
+import io
+import os
+import tarfile
+from naming_helpers import create_sample_filename
+
+COMPRESSED_SUFFIXES = ('.gz', '.zst')
+ARCHIVE_SUFFIXES = ('.tar', '.tar.gz', '.tgz', '.tar.zst')
+
+# Subarray positions on a slide in MOKA format, see naming_helpers.subarray_id_translator():
+SUBARRAYS = range(1, 9)
+
+
+def _zstandard():
+    """Import zstandard, which is only needed to read .zst files"""
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("Reading .zst files requires zstandard, install it with: pip install zstandard")
+    return zstandard
+
+
+def is_archive(path):
+    return path.lower().endswith(ARCHIVE_SUFFIXES)
+
+
+@contextlib.contextmanager
+def open_fe_file(fe_file):
+    """Open an FE file, decompressing .gz and .zst files as they are read. Yields a binary file object which can be
+    iterated over by line"""
+    with open(fe_file, "rb") as raw:
+        if fe_file.lower().endswith('.gz'):
+            with gzip.GzipFile(fileobj=raw) as f:
+                yield f
+        elif fe_file.lower().endswith('.zst'):
+            with _zstandard().ZstdDecompressor().stream_reader(raw) as reader:
+                yield io.BufferedReader(reader)
+        else:
+            yield raw
+
+
+def fe_file_subarray(file_name):
+    """Return the subarray position (MOKA format, 1-8) of an FE file named as by create_sample_filename(), or None if
+    the file is not named in that way"""
+    barcode = file_name.split("_")[0]
+    for subarray in SUBARRAYS:
+        if file_name == create_sample_filename(barcode, subarray):
+            return subarray
+    return None
+
+
+def is_fe_file(path):
+    """Return True for FE files named as by create_sample_filename() (optionally compressed) and slide
+    archives"""
+    file_name = os.path.basename(path)
+    if is_archive(file_name):
+        return True
+    if file_name.endswith(COMPRESSED_SUFFIXES):
+        file_name = os.path.splitext(file_name)[0]
+    return fe_file_subarray(file_name) is not None
+
+
+def iter_archive_fe_files(archive):
+    """Read a slide archive in a single pass, yielding the name and a binary file object for each FE file in it. File
+    objects are only valid until the next file is yielded."""
+    with open(archive, "rb") as raw:
+        fileobj = raw
+        if archive.lower().endswith('.tar.zst'):
+            fileobj = _zstandard().ZstdDecompressor().stream_reader(raw)
+        # Stream mode reads members in order without seeking, decompressing gzip archives as it goes:
+        with tarfile.open(fileobj=fileobj, mode="r|" if fileobj is not raw else "r|*") as tar:
+            for member in tar:
+                file_name = os.path.basename(member.name)
+                if member.isfile() and fe_file_subarray(file_name) is not None:
+                    yield file_name, tar.extractfile(member)
+
+
+def locate_fe_file(fe_directory, fe_file_name):
+    """Return the path of an FE file in fe_directory, looking for a compressed copy or a slide archive (named by its
+    barcode) if the file itself is not present. Returns the expected path if none is found."""
+    fe_file = os.path.join(fe_directory, fe_file_name)
+    candidates = [fe_file + suffix for suffix in ('',) + COMPRESSED_SUFFIXES]
+    barcode = fe_file_name.split("_")[0]
+    candidates.extend(os.path.join(fe_directory, barcode + suffix) for suffix in ARCHIVE_SUFFIXES)
+    for candidate in candidates:
+        if os.path.exists(candidate):
+            return candidate
+    return fe_file
+
+
+def locate_fe_files(fe_directory, fe_file_names):
+    """Return the paths of FE files in fe_directory (see locate_fe_file()), each path once as a slide archive may hold
+    several of the FE files"""
+    fe_files = []
+    for fe_file_name in sorted(set(fe_file_names)):
+        fe_file = locate_fe_file(fe_directory, fe_file_name)
+        if fe_file not in fe_files:
+            fe_files.append(fe_file)
+    return fe_files
@@ -11,100 +11,338 @@ See project requirement doc - https://github.com/moka-guys/project_requirements/
 from __future__ import print_function
 import argparse
 import datetime
-import itertools
-import matplotlib
-import matplotlib.pyplot as plt
-import numpy as np
 import os
-import pandas
-import re
-import seaborn as sns  # Produces heatmap of results which are useful for debugging
-import yaml  # pyYAML
-from analysis_helpers import *
-from moka_helpers import *
-
-""" 
-Import Arguments from command line
-"""
-parser = argparse.ArgumentParser(
-    description='Detect spiked-in probes from Agilent CGH FE extraction files and summarise results')
-parser.add_argument('-file', '-f',
-                    nargs='+',
-                    help='Import single or multiple Agilent Feature Extraction files',
-                    required=True)
-parser.add_argument('-output_dir', '-o',
-                    type=str,
-                    help='File path to output directory',
-                    required=True)
-parser.add_argument('-spike_in_info', '-s',
-                    type=str,
-                    help='Optional file providing experimental design info which is used rather than MOKA. '
-                         'Useful for testing or running script in a standalone mode.  Requires comma-delimited '
-                         'file with 3 fields, ProbeName plus gSpike and rSpike where 0 or 1 indicates whether' 
-                         'a spike should be expected on that channel',
-                     required=False)
-args = parser.parse_args()
+import subprocess
+import sys
 
-"""
-Get user specified arguments from commandline
-"""
 
-# User specified FE Files - List of strings as multiple FE files may relate to a single run.
-testFiles = args.file
+def get_arguments(argv=None):
+    """Import Arguments from command line"""
+    parser = argparse.ArgumentParser(
+        description='Detect spiked-in probes from Agilent CGH FE extraction files and summarise results')
+    parser.add_argument('-file', '-f',
+                        nargs='+',
+                        help='Import single or multiple Agilent Feature Extraction files, which may be gzip (.gz) or '
+                             'zstandard (.zst) compressed, or slide archives (.tar, .tar.gz, .tgz, .tar.zst) holding '
+                             'the FE files for each subarray. If omitted the FE files for -run_id are found in '
+                             'feDirectory (config.yaml) using file names from MOKA',
+                        required=False)
+    parser.add_argument('-output_dir', '-o',
+                        type=str,
+                        help='File path to output directory',
+                        required=True)
+    parser.add_argument('-spike_in_info', '-s',
+                        type=str,
+                        help='Optional file providing experimental design info which is used rather than MOKA. '
+                             'Useful for testing or running script in a standalone mode.  Requires comma-delimited '
+                             'file with 4 fields, Sample (FE file label e.g. 258503010103_2_1_3), ProbeName plus '
+                             'gSpike and rSpike where 0 or 1 indicates whether a spike should be expected on that '
+                             'channel',
+                        required=False)
+    parser.add_argument('-spike_in_set',
+                        choices=['A', 'B'],
+                        default='A',
+                        help='Plate layout used to spike in probes. Set A uses the first 48 trios for the red '
+                             'channel and the second 48 for the green channel, set B swaps the channels',
+                        required=False)
+    parser.add_argument('-run_id', '-r',
+                        type=int,
+                        help='MOKA run ID. Expected spike ins are read from MOKA (unless -spike_in_info is given) '
+                             'and QC results written back to MOKA table ArrayLabelling. The database connection '
+                             'string is read from the MOKA_CONNECTION_STRING environment variable',
+                        required=False)
+    parser.add_argument('-layout',
+                        type=str,
+                        help='Optional plate layout CSV produced by design_spike_ins.py. Defaults to the first 96 '
+                             'combinations of the probes in config.yaml',
+                        required=False)
+    parser.add_argument('-plots',
+                        choices=['inline', 'background', 'none'],
+                        default='inline',
+                        help='Render the heatmap and intensity plot once results are saved (inline), in a separate '
+                             'process so the script returns as soon as results are saved (background), or not at all '
+                             '(none). Plots can be rendered later from the saved logs with render_reports.py',
+                        required=False)
+    parser.add_argument('-jobs', '--jobs', '-j',
+                        type=int,
+                        default=1,
+                        help='Number of worker processes used to parse FE files in parallel (0 uses all available '
+                             'cores)',
+                        required=False)
+    parser.add_argument('-cache_dir',
+                        type=str,
+                        help='Directory used to cache spike in rows extracted from FE files. Defaults to cacheDir in '
+                             'config.yaml',
+                        required=False)
+    parser.add_argument('-no_cache',
+                        action='store_true',
+                        help='Always re-parse FE files rather than using cached results')
+    parser.add_argument('-scoring',
+                        choices=['saturation', 'zscore'],
+                        default='saturation',
+                        help='Call probes present from their saturation flags (saturation) or from the z-score of '
+                             'their background corrected signal against a running baseline of unspiked signals '
+                             '(zscore), which also detects weak contamination. The baseline is updated after each run',
+                        required=False)
+    parser.add_argument('-baseline_file',
+                        type=str,
+                        help='Signal baseline used by -scoring zscore. Defaults to baselineFile in config.yaml',
+                        required=False)
+    parser.add_argument('-store_dir',
+                        type=str,
+                        help='Columnar results store (requires pyarrow) the per-replicate signals and per-sample calls '
+                             'are appended to. Defaults to storeDir in config.yaml, if set',
+                        required=False)
+    parser.add_argument('-verbose_log',
+                        action='store_true',
+                        help='Also export the per-replicate results as a CSV log when they are saved in the results '
+                             'store (always exported if no store is used)')
+    parser.add_argument('-profile', '--profile',
+                        nargs='?',
+                        const='json',
+                        choices=['json', 'table'],
+                        help='Record wall time, CPU time, peak memory, bytes read and rows matched for each stage and '
+                             'FE file, saved as JSON alongside the logs. -profile table also prints a summary table',
+                        required=False)
+    args = parser.parse_args(argv)
+    if args.file is None and args.run_id is None:
+        parser.error("Either -file or -run_id is required")
+    return args
+
+
+def main(argv=None, df=None, trio_indices=None):
+    """Run the spike in QC for the FE files of one run. Returns True if the QC step has been passed, False if it has
+    failed and None if there is no expected spike in profile to check against. If df is given it
+    holds the rows of the FE files already parsed by import_data() (e.g. by watch_spiker.py as each file arrived),
+    which are used rather than parsing the files again. trio_indices is an optional dictionary of (layout, spike in
+    set) -> trio index, used and added to so that a long running caller (e.g. qc_service.py) builds each index once."""
+    args = get_arguments(argv)
+
+    # Profiler does nothing unless -profile is given:
+    from profiling_helpers import Profiler
+    profiler = Profiler(enabled=args.profile is not None)
+
+    # Analysis modules are only imported once the arguments are valid so that -h and argument errors return quickly.
+    # Plotting modules are imported by analysis_helpers when plots are rendered and SQLAlchemy only if MOKA is used.
+    with profiler.stage("import_modules"):
+        import pandas
+        from analysis_helpers import (bitmask_to_calls, calculate_spiked_probes_combinations, calls_to_bitmask,
+                                      create_output_directory, import_data, load_config, make_pretty_label,
+                                      parse_config_file, render_reports, replicate_consensus,
+                                      summarise_array_replicates, summarise_signals, write_log)
+        from archive_helpers import is_archive, locate_fe_files
+        from cache_helpers import evict_cache
+        from trio_helpers import (NOT_DETECTED, PASS, PLATE_WELLS, align_bitmasks, build_trio_index,
+                                  check_sample_identity, expected_bitmasks, read_trio_layout)
+        if args.run_id is not None:
+            import moka_helpers
+        if args.scoring == 'zscore':
+            from baseline_helpers import (corrected_log_signals, read_baseline, read_merged_samples,
+                                          record_merged_samples, score_signals, scores_to_dataframe, update_baseline,
+                                          write_baseline)
+
+    # Load settings and a list of all spike in probes available from config.yaml file:
+    config = load_config()
+    spike_in_probes = parse_config_file()
+
+    # Fetch records for all samples in the run from MOKA in a single query:
+    moka_records = None
+    if args.run_id is not None:
+        with profiler.stage("moka_run_records") as stage:
+            moka_records = moka_helpers.get_run_records(args.run_id)
+            stage['rows'] = len(moka_records)
+
+    # User specified FE Files - List of strings as multiple FE files may relate to a single run.
+    testFiles = args.file
+    if testFiles is None:
+        fe_file_names = moka_helpers.get_fe_file_name(args.run_id, records=moka_records).values()
+        # Archived FE files are read from their compressed copy or slide archive, which may hold several subarrays:
+        testFiles = locate_fe_files(config["feDirectory"], fe_file_names)
+        if not testFiles:
+            raise ValueError("No FE files found in MOKA for run %s (FE directory %s)" % (args.run_id,
+                                                                                        config["feDirectory"]))
+
+    # User specified output directory for results/logs to be saved to. Directory will be created if it does not exist.
+    output_path = args.output_dir
+
+    # Flag to indicate whether this QC step has been passed, None unless there is an expected spike in profile.
+    QC_passed = None
+    identity_df = None
+    analysis_time = datetime.datetime.now()
+
+    # Results store the run is appended to, per-replicate results are then only exported as CSV if requested:
+    store_dir = args.store_dir or config.get("storeDir")
+    if store_dir is not None:
+        store_dir = os.path.expanduser(store_dir)
+
+    # Create output directory in user specified directory for saving results:
+    output_directory = create_output_directory(output_path)
+
+    # Cache of previously parsed FE files, entries are invalidated when the file or the spike in probe list changes:
+    cache_dir = None
+    if not args.no_cache:
+        cache_dir = os.path.expanduser(args.cache_dir or config["cacheDir"])
+
+    if df is None:
+        with profiler.stage("import_data") as stage:
+            df = import_data(testFiles, spike_in_probes, jobs=args.jobs, cache_dir=cache_dir, profiler=profiler)
+            stage['files'] = len(testFiles)
+            stage['rows'] = len(df)
+    else:
+        df = df.copy()  # FE_filename is replaced with labels below
+    if cache_dir is not None:
+        with profiler.stage("evict_cache"):
+            evict_cache(cache_dir, config.get("cacheMaxMegabytes"), config.get("cacheMaxAgeDays"))
+    #df['label'] = df['FE_filename'].apply(make_pretty_label)
+    df['FE_filename'] = df['FE_filename'].apply(make_pretty_label)
 
-# User specified output directory for results/logs to be saved to. Directory will be created if it does not exist.
-output_path = args.output_dir
+    # Save output to log file and print location to screen:
+    if store_dir is None or args.verbose_log:
+        with profiler.stage("write_verbose_log"):
+            output_location = write_log(df, "verbose_results", output_directory)
 
-# Flag to indicate whether this QC step has been passed.
-QC_passed = False
+        print("Output saved in: %s" % output_location)
 
-# Create output directory in user specified directory for saving results:
-output_directory = create_output_directory(output_path)
+    with profiler.stage("summarise_array_replicates"):
+        consensus = replicate_consensus(df, spike_in_probes)
+        summarised_df = summarise_array_replicates(df, spike_in_probes, consensus)
+        # Sort so that log/visualizations will show probes in same order each time
+        summarised_df = summarised_df.sort_index(axis=1, level=1)
 
-# Load a list of all spike in probes available from config.yaml file:
-spike_in_probes = parse_config_file()
+    with profiler.stage("write_summary_logs"):
+        summary_location = write_log(summarised_df, "summary", output_directory)
 
-df = import_data(testFiles)
-#df['label'] = df['FE_filename'].apply(make_pretty_label)
-df['FE_filename'] = df['FE_filename'].apply(make_pretty_label)
+        # Save range of intensities for each probe, used to plot intensities to aid in troubleshooting:
+        signals_location = write_log(summarise_signals(df), "signal_summary", output_directory)
 
-# Save output to log file and print location to screen:
-output_location = write_log(df, "verbose_results", output_directory)
+    detected_masks = consensus.bitmask
 
-print("Output saved in: %s" % output_location)
+    # Score each probe by its signal against the running baseline of unspiked signals for the probe:
+    if args.scoring == 'zscore':
+        with profiler.stage("score_signals"):
+            baseline_file = os.path.expanduser(args.baseline_file or config["baselineFile"])
+            baseline = read_baseline(baseline_file, spike_in_probes)
+            signal_samples, signals = corrected_log_signals(df, spike_in_probes)
+            scores = score_signals(baseline, signals, consensus.calls)
+            signal_calls = scores >= config["zScoreThreshold"]
+            detected_masks = calls_to_bitmask(signal_calls)
+            write_log(scores_to_dataframe(consensus.samples, spike_in_probes, scores), "signal_scores",
+                      output_directory)
 
+    # Compare the expected/detected probes in each sample highlighting mismatches or situations
+    # where a probe failed.
+    expected_df = None
+    expected_masks = None
+    with profiler.stage("expected_spike_ins"):
+        if args.spike_in_info is not None:  # If file has been passed as argument do not query Moka database
+            # Read in expected spike in profile:
+            expected_df = pandas.read_csv(args.spike_in_info)
+        elif moka_records is not None:
+            # Obtain the trio assigned to each sample from MOKA:
+            expected_df = pandas.DataFrame(
+                moka_helpers.get_expected_spike_ins(args.run_id, spike_in_probes, records=moka_records),
+                columns=['Sample', 'ProbeName', 'gSpike', 'rSpike'])
+            expected_df['Sample'] = expected_df['Sample'].apply(make_pretty_label)
 
-summarised_df = summarise_array_replicates(df, spike_in_probes)
-# Sort so that log/visualizations will show probes in same order each time
-summarised_df = summarised_df.sort_index(axis=1, level=1)
+    if expected_df is not None:
+        # Decode the trio detected in each sample/channel to its well using the plate layout for the spike in set:
+        with profiler.stage("check_sample_identity") as stage:
+            index_key = (args.layout, args.spike_in_set)
+            trio_index = (trio_indices or {}).get(index_key)
+            if trio_index is None:
+                if args.layout is not None:
+                    trios = read_trio_layout(args.layout)
+                else:
+                    trios = calculate_spiked_probes_combinations(spike_in_probes)[:len(PLATE_WELLS)]
+                trio_index = build_trio_index(spike_in_probes, trios, args.spike_in_set)
+                if trio_indices is not None:
+                    trio_indices[index_key] = trio_index
+            # Every FE file given and every sample on the sample sheet is checked, including those with no spike in
+            # probe rows (consensus.samples only holds samples found in the FE data), which are reported as MISSING:
+            samples = list(consensus.samples)
+            for sample in ([make_pretty_label(fe_file) for fe_file in testFiles if not is_archive(fe_file)] +
+                           list(expected_df['Sample'].astype(str))):
+                if sample not in samples:
+                    samples.append(sample)
+            expected_masks = expected_bitmasks(expected_df, samples, spike_in_probes)
+            detected_masks = align_bitmasks(detected_masks, consensus.samples, samples)
+            identity_df = check_sample_identity(trio_index, samples, detected_masks, expected_masks)
+            stage['rows'] = len(identity_df)
+        with profiler.stage("write_qc_results"):
+            write_log(identity_df, "qc_results", output_directory)
+        failed_df = identity_df[identity_df['Status'] != PASS]
+        QC_passed = failed_df.empty
+        if QC_passed:
+            print("QC PASSED: Detected spike in probes match the sample sheet for all samples")
+        else:
+            print("QC FAILED: Detected spike in probes do not match the sample sheet for %d sample channel(s):"
+                  % len(failed_df))
+            print(failed_df.to_string(index=False))
 
-# Save heatmap showing probes present in each sample:
-heatmap_spike_ins(summarised_df, "results_heatmap", output_directory)
+        if moka_records is not None:
+            # Record the result for each subarray in MOKA - a subarray passes if both of its channels pass:
+            results = []
+            fe_file_names = moka_helpers.get_fe_file_name(args.run_id, records=moka_records)
+            for array_labelling_id, fe_file_name in fe_file_names.items():
+                sample_df = identity_df[identity_df['Sample'] == make_pretty_label(fe_file_name)]
+                results.append({'ArrayLabellingID': array_labelling_id,
+                                'passed': len(sample_df) > 0 and (sample_df['Status'] == PASS).all(),
+                                'result': ";".join("%s:%s" % (channel, status) for channel, status in
+                                                   zip(sample_df['Channel'], sample_df['Status'])) or NOT_DETECTED})
+            with profiler.stage("moka_write_results") as stage:
+                moka_helpers.write_results_to_moka(results)
+                stage['rows'] = len(results)
+            print("QC results recorded in MOKA for %d subarray(s)" % len(results))
 
-# Save plot of intensities to aid in troubleshooting:
-plot_values(df, "results_plot.pdf",output_directory)
+    if args.scoring == 'zscore':
+        # Add the signals of probes neither detected nor expected in this run to the baseline:
+        unspiked = ~signal_calls
+        if expected_masks is not None:
+            # Samples found in the FE data come first in expected_masks, in the order of signals:
+            unspiked &= ~bitmask_to_calls(expected_masks[:len(signal_samples)], len(spike_in_probes))
+        with profiler.stage("update_baseline"):
+            # Samples already in the baseline, i.e. a run analysed again, are not counted twice:
+            merged = read_merged_samples(baseline_file, signal_samples)
+            unspiked[[s for s, sample in enumerate(signal_samples) if sample in merged]] = False
+            write_baseline(update_baseline(baseline, signals, unspiked), baseline_file)
+            record_merged_samples(baseline_file, [sample for sample in signal_samples if sample not in merged])
+        print("Signal baseline updated: %s (%d sample(s) already in the baseline not added again)"
+              % (baseline_file, len(merged)))
 
-write_log(summarised_df, "summary", output_directory)
+    if store_dir is not None:
+        from store_helpers import append_results, calls_table, probe_flags, signals_table
+        with profiler.stage("results_store") as stage:
+            # Flag whether each probe was called and expected so that trends separate spiked and unspiked signals:
+            flags = probe_flags(consensus.samples, spike_in_probes,
+                                signal_calls if args.scoring == 'zscore' else consensus.calls,
+                                None if expected_masks is None else expected_masks[:len(consensus.samples)])
+            append_results(store_dir, 'signals', signals_table(df, args.run_id, analysis_time, flags))
+            stage['rows'] = len(df)
+            if identity_df is not None:
+                append_results(store_dir, 'calls', calls_table(identity_df, args.run_id, analysis_time))
+                stage['rows'] += len(identity_df)
+        print("Results appended to store: %s" % store_dir)
 
-# Function compares the expected/detected probes in each sample highlighting mismatches or situations
-# where a probe failed.
+    # Plots are rendered from the saved logs once results have been reported:
+    if args.plots == 'inline':
+        with profiler.stage("render_reports"):
+            render_reports(summary_location, signals_location, output_directory)
+    elif args.plots == 'background':
+        subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "render_reports.py"),
+                          "-summary", summary_location, "-signals", signals_location, "-output_dir", output_directory],
+                         # Detach from this process so rendering continues after the script exits. A new session
+                         # rather than preexec_fn, which is not safe when main() runs in a thread (qc_service.py):
+                         start_new_session=True, close_fds=True)
+        print("Rendering plots in the background to: %s" % output_directory)
 
-# TODO Finish and create function for below code:
+    if profiler.enabled:
+        print("Profile saved in: %s" % profiler.write(output_directory))
+        if args.profile == 'table':
+            print(profiler.summary_table())
 
-if args.spike_in_info is not None:  # If file has been passed as argument do not query Moka database
-    # Read in expected spike in profile:
-    expected_df = pandas.read_csv(args.spike_in_info)
-    # Function to logically test whether spike ins/sample sheet match:
-        # Compare summarised_df to expected_df
-    # Are 3 spike in probes detected for each sample:
-    # Throw error
-    # Do the spike in probes detected match the sample sheet:
-    # Throw error
+    return QC_passed
 
-    # Write out log file recording results:
-    # Function to import the 3 probes added to each sample from MOKA:
-else:
-    # Pseudocode - obtain this info from Moka using moka_helpers.py functions
-    # Pseudocode - create expected_df as above
-    pass
 
+if __name__ == '__main__':
+    # A failed QC step exits with an error so that the caller (e.g. MOKA) is alerted:
+    sys.exit(1 if main() is False else 0)
@@ -0,0 +1,166 @@
+"""Helper functions for arraySpiker which score spike in probes by their signal rather than their saturation flags.
+
+The background corrected median signal of each probe is compared to a baseline of that probe's signal when it has not
+been spiked in, held separately for each channel. The baseline is a running count, mean and sum of squared deviations
+(M2) of the log2 signal, updated after each run by merging in the statistics of the run's unspiked probes (Chan et
+al.'s parallel form of Welford's algorithm). The samples merged are recorded in one small file per slide, so that
+re-analysing a run does not count its signals twice without reading the record of every earlier run. Scoring and
+updating a run therefore take the same time however much history the baseline holds. A probe whose z-score against
+its baseline reaches the threshold is called present, so weak contamination and spikes that fail to saturate are still
+detected."""
+
+from __future__ import print_function
+import collections
+import os
+import re
+import warnings
+import numpy as np
+import pandas
+from analysis_helpers import SIGNAL_FIELDS, build_replicate_array
+from trio_helpers import CHANNELS
+
+# Background signal fields for the green and red channels, in the order of CHANNELS (as SIGNAL_FIELDS):
+BACKGROUND_FIELDS = ('gBGMedianSignal', 'rBGMedianSignal')
+
+# A probe/channel with fewer observations in its baseline is scored against the median and median absolute deviation
+# of the unsaturated signals of the current run, so that scoring can start with no history:
+MIN_BASELINE_COUNT = 20
+
+# Scales the median absolute deviation to the standard deviation of normally distributed values:
+MAD_SCALE = 1.4826
+
+# Arrays are indexed [probe, channel]:
+SignalBaseline = collections.namedtuple('SignalBaseline', [
+    'probes',  # Spike in probe names
+    'count',  # Number of unspiked observations of each probe
+    'mean',  # Mean log2 background corrected signal
+    'm2',  # Sum of squared deviations from the mean
+])
+
+
+def corrected_log_signals(df, spike_in_probes):
+    """Return the sample labels and a samples x probes x channels array of the log2 background corrected median
+    signal of each probe, taking the median over its replicates. Missing probes are NaN. Signals at or below the
+    background are set to log2(1) = 0"""
+    samples, data = build_replicate_array(df, spike_in_probes, fields=SIGNAL_FIELDS + BACKGROUND_FIELDS,
+                                          fill=np.nan, dtype=float)
+    corrected = np.log2(np.maximum(data[..., :len(CHANNELS)] - data[..., len(CHANNELS):], 1.0))
+    with warnings.catch_warnings():
+        # Probes missing from an FE file have only NaN replicates, their median is NaN:
+        warnings.simplefilter('ignore', RuntimeWarning)
+        return samples, np.nanmedian(corrected, axis=2)
+
+
+def empty_baseline(spike_in_probes):
+    """Return a baseline with no observations"""
+    shape = (len(spike_in_probes), len(CHANNELS))
+    return SignalBaseline(list(spike_in_probes), np.zeros(shape, dtype=np.int64), np.zeros(shape), np.zeros(shape))
+
+
+def merged_samples_file(baseline_file, sample):
+    """Return the path of the file listing the samples of a slide (the first part of the sample label, i.e. the slide
+    barcode) merged into a baseline, kept in a directory alongside the baseline"""
+    return os.path.join(baseline_file + ".merged", "%s.txt" % re.sub(r'[^\w.-]', '_', sample.split("_")[0]))
+
+
+def read_merged_samples(baseline_file, samples):
+    """Return the set of samples already merged into the baseline. Only the files of the slides of samples are read."""
+    merged = set()
+    for path in set(merged_samples_file(baseline_file, sample) for sample in samples):
+        if os.path.exists(path):
+            with open(path) as f:
+                merged.update(line.strip() for line in f)
+    return merged.intersection(samples)
+
+
+def record_merged_samples(baseline_file, samples):
+    """Add samples to the record of the samples merged into the baseline"""
+    slides = collections.defaultdict(list)
+    for sample in samples:
+        slides[merged_samples_file(baseline_file, sample)].append(sample)
+    for path, slide_samples in slides.items():
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, "a") as f:
+            f.writelines("%s\n" % sample for sample in slide_samples)
+
+
+def read_baseline(baseline_file, spike_in_probes):
+    """Read the baseline saved by write_baseline(), aligned to spike_in_probes. Probes (or a file) not yet in the
+    baseline have no observations."""
+    baseline = empty_baseline(spike_in_probes)
+    if not os.path.exists(baseline_file):
+        return baseline
+    saved = pandas.read_csv(baseline_file)
+    probe_index = pandas.Index(spike_in_probes).get_indexer(saved['ProbeName'])
+    channel_index = pandas.Index(CHANNELS).get_indexer(saved['Channel'])
+    keep = (probe_index >= 0) & (channel_index >= 0)
+    for array, column in zip((baseline.count, baseline.mean, baseline.m2), ('Count', 'Mean', 'M2')):
+        array[probe_index[keep], channel_index[keep]] = saved[column].values[keep]
+    return baseline
+
+
+def write_baseline(baseline, baseline_file):
+    """Save the baseline as CSV with one row per probe and channel. Written to a temporary file then renamed so that
+    an interrupted run never leaves a partial baseline"""
+    rows = []
+    for p, probe in enumerate(baseline.probes):
+        for c, channel in enumerate(CHANNELS):
+            rows.append({'ProbeName': probe, 'Channel': channel, 'Count': int(baseline.count[p, c]),
+                         'Mean': baseline.mean[p, c], 'M2': baseline.m2[p, c]})
+    temp_file = "%s.%d.tmp" % (baseline_file, os.getpid())
+    pandas.DataFrame(rows, columns=['ProbeName', 'Channel', 'Count', 'Mean', 'M2']).to_csv(temp_file, index=False)
+    os.replace(temp_file, baseline_file)
+    return baseline_file
+
+
+def update_baseline(baseline, values, use):
+    """Return the baseline updated with the values (samples x probes x channels) where use is True. The statistics of
+    the new values are computed in one pass then merged with the baseline, so earlier values are never needed."""
+    use = use & ~np.isnan(values)
+    count = use.sum(axis=0)
+    total = np.where(use, values, 0).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.where(count > 0, total / count, 0)
+    m2 = np.where(use, (values - mean) ** 2, 0).sum(axis=0)
+    # Merge the two sets of statistics:
+    merged_count = baseline.count + count
+    delta = mean - baseline.mean
+    with np.errstate(invalid='ignore', divide='ignore'):
+        merged_mean = np.where(merged_count > 0, baseline.mean + delta * count / merged_count, 0)
+        merged_m2 = baseline.m2 + m2 + np.where(merged_count > 0, delta ** 2 * baseline.count * count / merged_count, 0)
+    return SignalBaseline(baseline.probes, merged_count, merged_mean, merged_m2)
+
+
+def score_signals(baseline, values, saturated_calls=None):
+    """Return the z-score of each value (samples x probes x channels) against the baseline for its probe/channel.
+    Where the baseline has fewer than MIN_BASELINE_COUNT observations the values are instead scored against the median
+    and scaled median absolute deviation of the run's values not called present by saturation (saturated_calls), or
+    all values if not given. Unlike the mean and standard deviation these are not raised by the few contaminated
+    values in a run, including the value being scored. Scores are NaN where a probe/channel has fewer than 2
+    observations or no spread."""
+    mean, count = baseline.mean, baseline.count
+    with np.errstate(invalid='ignore', divide='ignore'):
+        std = np.sqrt(baseline.m2 / (baseline.count - 1))
+    few = baseline.count < MIN_BASELINE_COUNT
+    if few.any():
+        unsaturated = np.ones(values.shape, dtype=bool) if saturated_calls is None else ~saturated_calls
+        run_values = np.where(unsaturated, values, np.nan)
+        with warnings.catch_warnings():
+            # Probes with no unsaturated values in the run have a NaN median:
+            warnings.simplefilter('ignore', RuntimeWarning)
+            median = np.nanmedian(run_values, axis=0)
+            deviation = MAD_SCALE * np.nanmedian(np.abs(run_values - median), axis=0)
+        mean = np.where(few, median, mean)
+        std = np.where(few, deviation, std)
+        count = np.where(few, (~np.isnan(run_values)).sum(axis=0), count)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        std = np.where((count > 1) & (std > 0), std, np.nan)
+        return (values - mean[np.newaxis]) / std[np.newaxis]
+
+
+def scores_to_dataframe(samples, probes, scores):
+    """Format a samples x probes x channels array of scores as probes x (channel, sample), as in the summary log"""
+    columns = pandas.MultiIndex.from_product([list(SIGNAL_FIELDS), samples])
+    return pandas.DataFrame(scores.transpose(1, 2, 0).reshape(len(probes), -1),
+                            index=pandas.Index(probes, name='ProbeName'), columns=columns)
@@ -0,0 +1,159 @@
+"""Helper functions for batch_spiker.py which re-analyse many archived runs with array_spiker.py.
+
+Runs are read from a manifest or found in a directory tree, each run's FE files ordered by slide and subarray. Runs
+are analysed by a pool of worker processes, each run by a single call to array_spiker.main(). The result of each
+finished run is appended to a checkpoint file so that an interrupted batch resumes where it stopped. A run is only
+skipped if it finished with the same FE files, settings and spike in probes, so changing the probe panel or the
+settings re-analyses every run."""
+
+from __future__ import print_function
+import collections
+import glob
+import hashlib
+import json
+import os
+import sys
+import time
+import pandas
+from analysis_helpers import call_safely, find_log, make_pretty_label
+from archive_helpers import is_archive, is_fe_file
+from naming_helpers import subarray_id_translator
+from trio_helpers import AMBIGUOUS, CONTAMINATION, MISMATCH, NOT_DETECTED, PARTIAL_MATCH, PASS
+
+STATUSES = [PASS, PARTIAL_MATCH, AMBIGUOUS, MISMATCH, CONTAMINATION, NOT_DETECTED]
+
+SUMMARY_COLUMNS = ['Run', 'Files', 'Slides', 'QCPassed'] + STATUSES + ['Seconds', 'OutputDir', 'Error']
+
+# File in a run directory giving the expected spike in profile (as written by generate_test_files.py and
+# design_spike_ins.py):
+EXPECTED_FILE_PATTERN = "expected_spike_ins*.csv"
+
+
+def slide_and_subarray(fe_file):
+    """Return the slide barcode and subarray position (MOKA format, 0 for a slide archive) of an FE file"""
+    if is_archive(fe_file):
+        return os.path.basename(fe_file).split(".")[0], 0
+    label = make_pretty_label(fe_file)  # e.g. 258503010103_2_1_3
+    fields = label.split("_")
+    return fields[0], subarray_id_translator("_".join(fields[-2:]), 1)
+
+
+def sort_fe_files(fe_files):
+    """Order FE files by slide then subarray position"""
+    return sorted(fe_files, key=lambda fe_file: slide_and_subarray(fe_file) + (fe_file,))
+
+
+def discover_runs(input_dir):
+    """Find runs in a directory tree, each directory containing FE files being one run named by its path relative to
+    input_dir. A run uses the expected spike in profile in its directory if there is exactly one. Returns an ordered
+    dictionary of run name -> {'files': [...], 'spike_in_info': path or None}"""
+    runs = collections.OrderedDict()
+    for directory, sub_directories, file_names in os.walk(input_dir):
+        sub_directories.sort()
+        fe_files = [os.path.join(directory, file_name) for file_name in file_names if is_fe_file(file_name)]
+        if not fe_files:
+            continue
+        expected_files = glob.glob(os.path.join(directory, EXPECTED_FILE_PATTERN))
+        run = os.path.relpath(directory, input_dir).replace(os.sep, "/")
+        runs[run] = {'files': sort_fe_files(fe_files),
+                     'spike_in_info': expected_files[0] if len(expected_files) == 1 else None}
+    return runs
+
+
+def read_manifest(manifest_file):
+    """Read runs from a manifest CSV with one row per FE file and columns Run and FEFile, plus optionally SpikeInInfo
+    (expected spike in profile for the run). Relative paths are relative to the manifest. Returns the same dictionary
+    as discover_runs()"""
+    manifest = pandas.read_csv(manifest_file, dtype=str)
+    missing = set(['Run', 'FEFile']) - set(manifest.columns)
+    if missing:
+        raise ValueError("Manifest %s is missing column(s): %s" % (manifest_file, ", ".join(sorted(missing))))
+    base_dir = os.path.dirname(os.path.abspath(manifest_file))
+    runs = collections.OrderedDict()
+    for run, run_df in manifest.groupby('Run', sort=False):
+        spike_in_info = None
+        if 'SpikeInInfo' in run_df.columns and run_df['SpikeInInfo'].notnull().any():
+            spike_in_info = os.path.join(base_dir, run_df['SpikeInInfo'].dropna().iloc[0])
+        runs[run] = {'files': sort_fe_files([os.path.join(base_dir, fe_file) for fe_file in run_df['FEFile']]),
+                     'spike_in_info': spike_in_info}
+    return runs
+
+
+def run_signature(run, spike_in_probes, settings):
+    """Return a hash identifying the inputs of a run: its FE files (path, size and modification time), expected spike
+    in profile, the spike in probes and the array_spiker.py settings"""
+    inputs = [run['spike_in_info'], list(spike_in_probes), list(settings)]
+    for path in run['files'] + ([run['spike_in_info']] if run['spike_in_info'] else []):
+        stat = os.stat(path) if os.path.exists(path) else None
+        inputs.append([path, stat and stat.st_size, stat and int(stat.st_mtime)])
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def read_checkpoint(checkpoint_file):
+    """Return a dictionary of run name -> last record appended to the checkpoint for that run. A partially written
+    final line (e.g. from an interrupted batch) is ignored."""
+    records = {}
+    if not os.path.exists(checkpoint_file):
+        return records
+    with open(checkpoint_file) as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            records[record['Run']] = record
+    return records
+
+
+def append_checkpoint(checkpoint_file, record):
+    """Append the record of a finished run to the checkpoint, flushed to disk before returning"""
+    with open(checkpoint_file, "a") as f:
+        f.write(json.dumps(record, sort_keys=True) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def count_statuses(qc_results_file):
+    """Return the number of sample channels with each status in a qc_results log"""
+    status_counts = pandas.read_csv(qc_results_file, index_col=0)['Status'].value_counts()
+    return dict((status, int(status_counts.get(status, 0))) for status in STATUSES)
+
+
+def process_run(task):
+    """Analyse one run with array_spiker.py, run by the worker processes of batch_spiker.py. Output, including the
+    messages printed by array_spiker.py (saved in array_spiker.log), is written to the run's output directory.
+    Returns the record of the run for the checkpoint and summary."""
+    import array_spiker
+    start = time.time()
+    run_dir = task['output_dir']
+    if not os.path.exists(run_dir):
+        os.makedirs(run_dir)
+    argv = ['-file'] + task['files'] + ['-output_dir', run_dir] + task['settings']
+    if task['spike_in_info'] is not None:
+        argv += ['-spike_in_info', task['spike_in_info']]
+    record = {'Run': task['run'], 'Signature': task['signature'], 'Files': len(task['files']), 'OutputDir': run_dir,
+              'Slides': len(set(slide_and_subarray(fe_file)[0] for fe_file in task['files'])), 'Error': None}
+    stdout = sys.stdout
+    with open(os.path.join(run_dir, "array_spiker.log"), "w") as log:
+        sys.stdout = log
+        try:
+            passed, record['Error'] = call_safely(array_spiker.main, argv)
+        finally:
+            sys.stdout = stdout
+    record['QCPassed'] = None
+    if record['Error'] is None and task['spike_in_info'] is not None:
+        record['QCPassed'] = bool(passed)
+        qc_results_file = find_log(run_dir, "qc_results")
+        if qc_results_file is not None:
+            record.update(count_statuses(qc_results_file))
+    record['Seconds'] = round(time.time() - start, 2)
+    return record
+
+
+def write_batch_summary(records, summary_file):
+    """Save one row per run, in the order of records, as CSV"""
+    summary_df = pandas.DataFrame(records, columns=SUMMARY_COLUMNS)
+    # Status counts are missing for runs with no expected spike in profile or an error:
+    summary_df[STATUSES] = summary_df[STATUSES].astype('Int64')
+    summary_df.to_csv(summary_file, index=False)
+    return summary_df
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+
+"""
+This script re-runs the spike in QC (array_spiker.py) for many archived runs, for example after the probe panel or
+decision rules change. Runs are listed in a manifest or found in a directory tree and analysed in parallel by a pool of
+worker processes, one run per process. Each run is saved in its own folder under <output_dir>/runs and a consolidated
+summary of all runs is saved as batch_summary.csv. Finished runs are recorded in batch_checkpoint.jsonl so that an
+interrupted batch can be restarted with the same command and only the remaining runs are analysed. See batch_helpers.py.
+"""
+
+from __future__ import print_function
+import argparse
+import os
+
+
+def get_arguments(argv=None):
+    """Import Arguments from command line"""
+    parser = argparse.ArgumentParser(description='Re-run spike in QC for a batch of archived runs')
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument('-manifest', '-m',
+                        type=str,
+                        help='CSV with one row per FE file giving Run and FEFile, plus optionally SpikeInInfo (the '
+                             'expected spike in profile for the run)')
+    inputs.add_argument('-input_dir', '-i',
+                        type=str,
+                        help='Directory tree of runs. Each directory holding FE files (or slide archives) is a run, '
+                             'using the expected_spike_ins*.csv file in the directory if there is one')
+    parser.add_argument('-output_dir', '-o',
+                        type=str,
+                        help='Directory the per-run folders, summary and checkpoint are saved to',
+                        required=True)
+    parser.add_argument('-jobs', '--jobs', '-j',
+                        type=int,
+                        default=0,
+                        help='Number of runs analysed in parallel (default 0 uses all available cores)',
+                        required=False)
+    parser.add_argument('-spike_in_set',
+                        choices=['A', 'B'],
+                        default='A',
+                        help='Plate layout used to spike in probes, see array_spiker.py',
+                        required=False)
+    parser.add_argument('-layout',
+                        type=str,
+                        help='Optional plate layout CSV produced by design_spike_ins.py',
+                        required=False)
+    parser.add_argument('-plots',
+                        choices=['inline', 'none'],
+                        default='none',
+                        help='Render the plots for each run (default none)',
+                        required=False)
+    parser.add_argument('-cache_dir',
+                        type=str,
+                        help='FE file cache directory. Defaults to cacheDir in config.yaml',
+                        required=False)
+    parser.add_argument('-no_cache',
+                        action='store_true',
+                        help='Always re-parse FE files rather than using cached results')
+    parser.add_argument('-store_dir',
+                        type=str,
+                        help='Results store each run is appended to. Defaults to storeDir in config.yaml, if set',
+                        required=False)
+    parser.add_argument('-restart',
+                        action='store_true',
+                        help='Ignore the checkpoint and analyse every run again')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Analyse each run of the batch not already finished. Returns the summary of all runs as a dataframe."""
+    args = get_arguments(argv)
+    # Imported once arguments are valid so that -h returns without loading pandas
+    import multiprocessing
+    from analysis_helpers import parse_config_file
+    from batch_helpers import (append_checkpoint, discover_runs, process_run, read_checkpoint, read_manifest,
+                               run_signature, write_batch_summary)
+
+    runs = read_manifest(args.manifest) if args.manifest else discover_runs(args.input_dir)
+    if not runs:
+        raise ValueError("No runs found in %s" % (args.manifest or args.input_dir))
+
+    # Settings passed to array_spiker.py for every run, part of the signature identifying a finished run:
+    settings = ['-spike_in_set', args.spike_in_set, '-plots', args.plots, '-jobs', '1']
+    if args.layout:
+        settings += ['-layout', os.path.abspath(args.layout)]
+    if args.no_cache:
+        settings += ['-no_cache']
+    elif args.cache_dir:
+        settings += ['-cache_dir', args.cache_dir]
+    if args.store_dir:
+        settings += ['-store_dir', args.store_dir]
+    spike_in_probes = parse_config_file()
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    checkpoint_file = os.path.join(args.output_dir, "batch_checkpoint.jsonl")
+    if args.restart and os.path.exists(checkpoint_file):
+        os.remove(checkpoint_file)
+    finished = read_checkpoint(checkpoint_file)
+
+    tasks = []
+    for run_name, run in runs.items():
+        signature = run_signature(run, spike_in_probes, settings)
+        record = finished.get(run_name)
+        if record is not None and record['Signature'] == signature and record['Error'] is None:
+            continue  # Finished with the same inputs
+        tasks.append({'run': run_name, 'files': run['files'], 'spike_in_info': run['spike_in_info'],
+                      'settings': settings, 'signature': signature,
+                      'output_dir': os.path.join(args.output_dir, "runs", *run_name.split("/"))})
+    print("%d run(s) found, %d already finished, %d to analyse" % (len(runs), len(runs) - len(tasks), len(tasks)))
+
+    if tasks:
+        jobs = min(args.jobs or multiprocessing.cpu_count(), len(tasks))
+        pool = multiprocessing.Pool(jobs)
+        try:
+            # Results are checkpointed as each run finishes, in whatever order the runs finish:
+            for done, record in enumerate(pool.imap_unordered(process_run, tasks, chunksize=1), 1):
+                append_checkpoint(checkpoint_file, record)
+                finished[record['Run']] = record
+                outcome = record['Error'] or {True: "PASSED", False: "FAILED", None: "NO EXPECTED SPIKE INS"}[
+                    record['QCPassed']]
+                print("[%d/%d] %s: %s (%.1fs)" % (done, len(tasks), record['Run'], outcome, record['Seconds']))
+        finally:
+            pool.close()
+            pool.join()
+
+    summary_file = os.path.join(args.output_dir, "batch_summary.csv")
+    summary_df = write_batch_summary([finished[run_name] for run_name in runs if run_name in finished], summary_file)
+    print("QC passed for %d of %d run(s), %d run(s) with errors" % (
+        sum(summary_df['QCPassed'] == True), len(summary_df), summary_df['Error'].notnull().sum()))  # noqa: E712
+    print("Summary saved in: %s" % summary_file)
+    return summary_df
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""Helper functions for arraySpiker which maintain an on-disk cache of the spike in rows extracted from each FE file.
+
+Entries are keyed by a hash of the FE file's size, modification time and header plus the list of spike in probes, so an
+edited FE file or a change to the probes in config.yaml automatically misses the cache. The key is found without
+reading the whole file, so a miss costs little more than not using the cache. Each entry is a compressed numpy .npz
+archive holding the columns returned by analysis_helpers.read_fe_columns()."""
+
+from __future__ import print_function
+import hashlib
+import os
+import time
+import numpy as np
+
+CACHE_SUFFIX = ".npz"
+
+# Bytes from the start of each file hashed into its cache key:
+SIGNATURE_BYTES = 1 << 16
+
+
+def file_signature(file_path, header_size=SIGNATURE_BYTES):
+    """Return the SHA-1 hex digest of a file's size, modification time and first header_size bytes (the FEPARAMS and
+    STATS tables of an FE file, which identify the scan)"""
+    stat = os.stat(file_path)
+    digest = hashlib.sha1(("%d:%d:" % (stat.st_size, stat.st_mtime_ns)).encode('ascii'))
+    with open(file_path, "rb") as f:
+        digest.update(f.read(header_size))
+    return digest.hexdigest()
+
+
+def cache_key(fe_file, spike_in_probes):
+    """Return the cache key for an FE file: a hash of the file's signature combined with the spike in probe list"""
+    key = hashlib.sha1(file_signature(fe_file).encode('ascii'))
+    key.update("\n".join(spike_in_probes).encode('ascii'))
+    return key.hexdigest()
+
+
+def cache_file_path(cache_dir, key):
+    """Return the path of the cache entry stored under key"""
+    return os.path.join(cache_dir, key + CACHE_SUFFIX)
+
+
+def load_cached_columns(cache_dir, key):
+    """Return the dictionary of columns stored under key, or None if there is no entry"""
+    cache_file = cache_file_path(cache_dir, key)
+    try:
+        with np.load(cache_file, allow_pickle=False) as archive:
+            data = dict((name, archive[name]) for name in archive.files)
+    except (IOError, OSError, ValueError):
+        # Missing or unreadable (e.g. truncated) entries are treated as a cache miss:
+        return None
+    # Update modification time so that age based eviction removes least recently used entries first:
+    os.utime(cache_file, None)
+    return data
+
+
+def save_cached_columns(cache_dir, key, data):
+    """Store a dictionary of columns under key. The entry is written to a temporary file then renamed so that
+    concurrent readers never see a partially written entry"""
+    if not os.path.exists(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            # Directory may have been created by another worker process
+            if not os.path.isdir(cache_dir):
+                raise
+    cache_file = cache_file_path(cache_dir, key)
+    temp_file = "%s.%d.tmp" % (cache_file, os.getpid())
+    with open(temp_file, "wb") as f:
+        np.savez_compressed(f, **data)
+    os.replace(temp_file, cache_file)
+    return cache_file
+
+
+def evict_cache(cache_dir, max_megabytes=None, max_age_days=None):
+    """Remove cache entries not used within max_age_days, then remove least recently used entries until the cache is
+    no larger than max_megabytes. Returns the number of entries removed"""
+    if not os.path.isdir(cache_dir):
+        return 0
+    entries = []
+    for name in os.listdir(cache_dir):
+        if name.endswith(CACHE_SUFFIX):
+            path = os.path.join(cache_dir, name)
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()  # Least recently used first
+    removed = []
+    if max_age_days is not None:
+        oldest_allowed = time.time() - max_age_days * 24 * 60 * 60
+        removed.extend(entry for entry in entries if entry[0] < oldest_allowed)
+        entries = [entry for entry in entries if entry[0] >= oldest_allowed]
+    if max_megabytes is not None:
+        total_bytes = sum(size for _, size, _ in entries)
+        while entries and total_bytes > max_megabytes * 1024 * 1024:
+            entry = entries.pop(0)
+            total_bytes -= entry[1]
+            removed.append(entry)
+    for _, _, path in removed:
+        try:
+            os.remove(path)
+        except OSError:
+            pass  # Already removed by another process
+    return len(removed)
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+
+"""
+This script designs a plate layout of spike in probe trios for a panel of candidate probes. Trios are chosen to
+maximise the minimum Hamming distance between any two trios (so that a failed probe is least likely to make one sample
+look like another) while using each probe a similar number of times. The layout is saved along with the expected
+spike in profile that array_spiker.py reads with -spike_in_info.
+"""
+
+from __future__ import print_function
+import argparse
+import os
+
+
+def get_arguments(argv=None):
+    """Import Arguments from command line"""
+    parser = argparse.ArgumentParser(description='Design a plate layout of spike in probe trios')
+    parser.add_argument('-probes', '-p',
+                        nargs='+',
+                        help='Candidate spike in probes. Defaults to spikeInProbes in config.yaml',
+                        required=False)
+    parser.add_argument('-output_dir', '-o',
+                        type=str,
+                        help='File path to output directory',
+                        required=True)
+    parser.add_argument('-num_trios', '-n',
+                        type=int,
+                        default=96,
+                        help='Number of trios in the layout, half for each channel (default 96)',
+                        required=False)
+    parser.add_argument('-spike_in_set',
+                        choices=['A', 'B'],
+                        default='A',
+                        help='Set used to assign trios to channels when writing the expected spike in profile',
+                        required=False)
+    parser.add_argument('-samples',
+                        nargs='+',
+                        help='Optional FE file labels (e.g. 258503010103_2_1_3) for each sample in plate order, used '
+                             'in the Sample field of the expected spike in profile. Defaults to 1, 2, 3 ...',
+                        required=False)
+    parser.add_argument('-restarts',
+                        type=int,
+                        default=20,
+                        help='Number of randomised searches, the best layout found is kept',
+                        required=False)
+    parser.add_argument('-seed',
+                        type=int,
+                        help='Random seed to make the design reproducible',
+                        required=False)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = get_arguments(argv)
+    # Imported once arguments are valid so that -h returns without loading pandas
+    from analysis_helpers import num_spiked_probes_combinations, parse_config_file
+    from trio_helpers import (design_trio_layout, layout_min_distance, layout_to_expected_spike_ins, probes_to_bitmask,
+                              write_trio_layout)
+
+    spike_in_probes = args.probes or parse_config_file()
+
+    print("%d candidate probes give %d unique trios" % (len(spike_in_probes),
+                                                         num_spiked_probes_combinations(spike_in_probes)))
+
+    trios = design_trio_layout(spike_in_probes, args.num_trios, args.restarts, args.seed)
+
+    # Summarise the quality of the layout:
+    trio_masks = [probes_to_bitmask(trio, spike_in_probes) for trio in trios]
+    usage = dict((probe, sum(probe in trio for trio in trios)) for probe in spike_in_probes)
+    print("Minimum Hamming distance between trios: %d" % layout_min_distance(trio_masks))
+    print("Trios per probe: %d - %d" % (min(usage.values()), max(usage.values())))
+
+    if not os.path.exists(args.output_dir):
+        os.makedirs(args.output_dir)
+    layout_file = write_trio_layout(trios, os.path.join(args.output_dir, "spike_in_layout.csv"))
+    print("Layout saved in: %s" % layout_file)
+
+    expected_df = layout_to_expected_spike_ins(trios, spike_in_probes, args.spike_in_set, args.samples)
+    expected_file = os.path.join(args.output_dir, "expected_spike_ins_set%s.csv" % args.spike_in_set)
+    expected_df.to_csv(expected_file, index=False)
+    print("Expected spike in profile saved in: %s" % expected_file)
+
+
+if __name__ == '__main__':
+    main()
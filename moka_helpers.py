@@ -2,64 +2,141 @@ from __future__ import print_function
 
 """Helper functions which reads and writes data from the MOKA LIMS for use with array_spiker.py"""
 
+import datetime
+import os
 import sqlalchemy
+from analysis_helpers import load_config
+# Re-exported as these were defined here before moving to naming_helpers:
+from naming_helpers import create_sample_filename, subarray_id_translator  # noqa: F401
 
 
-def get_well_ids():
-    """TODO Get IDs for the 3 spiked in probes assigned to each well from MOKA table ArrayLabelledDNA"""
-    # Pseudocode - get ArrayLabelledDNA.code
-    pass
-
-
-def get_fe_file_name():
-    """TODO Get & construct the FE extraction file name from ArrayID & Subarray fields in Moka table ArrayLabelling"""
-    # Pseudocode - get ArrayLabelling.ArrayID, get ArrayLabelling.Subarray
-    # Use create_sample_name() to construct FE file name
-    pass
-
-
-def write_results_to_moka():
-    """TODO Write results to relevant fields in the Moka table ArrayLabelling"""
-    # Pseudocode - upload results to ArrayLabelling
-    pass
-
-
-def subarray_id_translator(ref_string, direction=0):
-    """
-    Translates a subarray ID string between formats used in MOKA and Feature Extraction Filenames.
-    By default function translates a subarray position from the format used in MOKA into that used to name the FE file.
-    This allows the matching FE file to be imported for each record in MOKA.
-
-        Col   C1      C2
-    Row       ___________    __________
-    R1      | 1       5 |   | 1_1   2_1 | Mapping the subarray positions between MOKA and the FE file.
-    R2      | 2       6 |   | 1_2   2_2 | MOKA uses a sequential numbering system for the 8 arrays
-    R3      | 3       7 | = | 1_3   2_3 | present on a slide, while the FE file name uses the  Column
-    R4      | 4       8 |   | 1_4   2_4 | No. + the row number delimited by a _ .
-             ___________     ___________
-                Moka           FE File
-
-    Direction    0    ----------->        To calculate Col_Row format position from a 1-8 sequential
-                 1    <-----------        position set direction to 0, to reverse direction use 1.
-    """
-    subarray_id = None
-    # Define dictionary to map the array position between MOKA and the feature extraction file formats:
-    subarray_dict = {1: '1_1', 2: '1_2', 3: '1_3', 4: '1_4', 5: '2_1', 6: '2_2', 7: '2_3', 8: '2_4'}
-    if direction == 0:
-        # Return subarray position in FE file format from MOKA format
-        subarray_id = subarray_dict[ref_string]
-    elif direction == 1:
-        # Return subarray position in MOKA format from FE format
-        subarray_id = subarray_dict.keys()[subarray_dict.values().index(ref_string)]
-    else:
-        print("Unexpected input %s used as 'direction' in function mappArrayPosition - Use 0 or 1" % str(direction))
-    return subarray_id
-
-
-def create_sample_filename(dna_id, moka_subarray_id):
-    """Generate the Feature Extraction file name from moka data fields"""
-    subarray_id = subarray_id_translator(moka_subarray_id)  # Translate the subarray format-See subarray_id_translator()
-    sample_name = "%s_S01_Guys121919_CGH_1100_Jul11_2_%s.txt" % (dna_id, subarray_id)
-    # TODO specify "_S01_Guys121919_CGH_1100_Jul11_2_" in a config file to make it easier to change
-    return sample_name
+def moka_name(table, column=None):
+    """Return the name of a Moka table, or of one of its columns, set under mokaSchema in config.yaml. Names which are
+    not set default to those used in this module."""
+    names = (load_config().get("mokaSchema") or {}).get(table) or {}
+    if column is None:
+        return names.get('table', table)
+    return names.get(column, column)
 
+
+def moka_column(table, column, *args, **kwargs):
+    """Return a column of a Moka table named as set in config.yaml (see moka_name()), accessed by its name in this
+    module, e.g. ArrayLabelling.c.RunID"""
+    return sqlalchemy.Column(moka_name(table, column), *args, key=column, **kwargs)
+
+
+# Moka tables used by arraySpiker. Only the columns read or written by this module are defined. The same metadata is
+# used to create a local SQLite copy of the schema for testing (see create_moka_schema()). The table and column names
+# are PROVISIONAL - they have not been checked against the Moka schema - so are set under mokaSchema in config.yaml
+# where they can be corrected without changing this module.
+metadata = sqlalchemy.MetaData()
+
+ArrayLabelling = sqlalchemy.Table(
+    moka_name('ArrayLabelling'), metadata,
+    moka_column('ArrayLabelling', 'ArrayLabellingID', sqlalchemy.Integer, primary_key=True),
+    moka_column('ArrayLabelling', 'RunID', sqlalchemy.Integer, index=True),
+    moka_column('ArrayLabelling', 'ArrayID', sqlalchemy.String(50)),  # Slide barcode
+    moka_column('ArrayLabelling', 'Subarray', sqlalchemy.Integer),  # Position 1-8, see subarray_id_translator()
+    moka_column('ArrayLabelling', 'SpikeInQCRun', sqlalchemy.Boolean),
+    moka_column('ArrayLabelling', 'SpikeInQCPassed', sqlalchemy.Boolean),
+    moka_column('ArrayLabelling', 'SpikeInQCResult', sqlalchemy.String(255)),
+    moka_column('ArrayLabelling', 'SpikeInQCDate', sqlalchemy.DateTime))
+
+ArrayLabelledDNA = sqlalchemy.Table(
+    moka_name('ArrayLabelledDNA'), metadata,
+    moka_column('ArrayLabelledDNA', 'ArrayLabelledDNAID', sqlalchemy.Integer, primary_key=True),
+    moka_column('ArrayLabelledDNA', 'ArrayLabellingID', sqlalchemy.Integer,
+                sqlalchemy.ForeignKey(ArrayLabelling.c.ArrayLabellingID), index=True),
+    moka_column('ArrayLabelledDNA', 'DNANumber', sqlalchemy.String(50)),
+    moka_column('ArrayLabelledDNA', 'Channel', sqlalchemy.String(1)),  # 'g' or 'r'
+    moka_column('ArrayLabelledDNA', 'Code', sqlalchemy.String(100)))  # IDs of the 3 spiked in probes delimited by ;
+
+# All labelled DNA for a run in a single set based query. Columns are labelled with their names in this module:
+RUN_RECORD_COLUMNS = (ArrayLabelling.c.ArrayLabellingID, ArrayLabelling.c.ArrayID, ArrayLabelling.c.Subarray,
+                      ArrayLabelledDNA.c.DNANumber, ArrayLabelledDNA.c.Channel, ArrayLabelledDNA.c.Code)
+RUN_RECORDS_QUERY = (sqlalchemy.select(*[column.label(column.key) for column in RUN_RECORD_COLUMNS])
+                     .select_from(ArrayLabelling.join(ArrayLabelledDNA))
+                     .where(ArrayLabelling.c.RunID == sqlalchemy.bindparam('run_id'))
+                     .order_by(ArrayLabelling.c.ArrayID, ArrayLabelling.c.Subarray, ArrayLabelledDNA.c.Channel))
+
+# One pooled engine per connection string for the life of the process:
+_engines = {}
+
+
+def get_engine(connection_string=None):
+    """Return the pooled SQLAlchemy engine for the Moka database. The connection string defaults to the
+    MOKA_CONNECTION_STRING environment variable."""
+    if connection_string is None:
+        connection_string = os.environ.get("MOKA_CONNECTION_STRING")
+    if connection_string is None:
+        raise ValueError("No Moka connection string given - set MOKA_CONNECTION_STRING")
+    if connection_string not in _engines:
+        # pool_pre_ping replaces connections dropped by the server between runs:
+        _engines[connection_string] = sqlalchemy.create_engine(connection_string, pool_pre_ping=True)
+    return _engines[connection_string]
+
+
+def create_moka_schema(engine):
+    """Create the Moka tables used by arraySpiker, e.g. in a local SQLite database for testing"""
+    metadata.create_all(engine)
+
+
+def get_run_records(run_id, engine=None):
+    """Return a list of dictionaries, one per labelled DNA, holding the ArrayLabelling and ArrayLabelledDNA fields
+    for every sample in a run"""
+    engine = engine or get_engine()
+    with engine.connect() as connection:
+        result = connection.execute(RUN_RECORDS_QUERY, {"run_id": run_id})
+        keys = list(result.keys())
+        return [dict(zip(keys, row)) for row in result]
+
+
+def get_well_ids(run_id, engine=None, records=None):
+    """Get IDs for the 3 spiked in probes assigned to each labelled DNA in a run from MOKA table ArrayLabelledDNA.
+    Returns a dictionary of (FE file name, channel) -> tuple of probe IDs."""
+    records = records if records is not None else get_run_records(run_id, engine)
+    return dict(((create_sample_filename(record['ArrayID'], record['Subarray']), record['Channel']),
+                 tuple(record['Code'].split(";")))
+                for record in records if record['Code'])
+
+
+def get_fe_file_name(run_id, engine=None, records=None):
+    """Get & construct the FE extraction file name from ArrayID & Subarray fields in Moka table ArrayLabelling.
+    Returns a dictionary of ArrayLabellingID -> FE file name."""
+    records = records if records is not None else get_run_records(run_id, engine)
+    return dict((record['ArrayLabellingID'], create_sample_filename(record['ArrayID'], record['Subarray']))
+                for record in records)
+
+
+def get_expected_spike_ins(run_id, spike_in_probes, engine=None, records=None):
+    """Build the expected spike in profile for a run from MOKA table ArrayLabelledDNA, in the same format as the
+    -spike_in_info file read by array_spiker.py. The Sample field holds the FE file name."""
+    well_ids = get_well_ids(run_id, engine, records)
+    rows = []
+    for fe_file_name in sorted(set(fe_file_name for fe_file_name, _ in well_ids)):
+        green_trio = well_ids.get((fe_file_name, 'g'), ())
+        red_trio = well_ids.get((fe_file_name, 'r'), ())
+        for probe in spike_in_probes:
+            rows.append({'Sample': fe_file_name, 'ProbeName': probe,
+                         'gSpike': int(probe in green_trio), 'rSpike': int(probe in red_trio)})
+    return rows
+
+
+def write_results_to_moka(results, engine=None):
+    """Write results to relevant fields in the Moka table ArrayLabelling. results is a list of dictionaries with the
+    keys ArrayLabellingID, passed (bool) and result (str). All rows are updated in a single transaction."""
+    engine = engine or get_engine()
+    statement = ArrayLabelling.update().where(
+        ArrayLabelling.c.ArrayLabellingID == sqlalchemy.bindparam('b_id')).values(
+        SpikeInQCRun=True,
+        SpikeInQCPassed=sqlalchemy.bindparam('b_passed'),
+        SpikeInQCResult=sqlalchemy.bindparam('b_result'),
+        SpikeInQCDate=sqlalchemy.bindparam('b_date'))
+    now = datetime.datetime.now()
+    parameters = [{'b_id': result['ArrayLabellingID'], 'b_passed': bool(result['passed']),
+                   'b_result': result['result'], 'b_date': now} for result in results]
+    if parameters:
+        # engine.begin() commits on success and rolls back every update if any fail:
+        with engine.begin() as connection:
+            connection.execute(statement, parameters)
+    return len(parameters)
@@ -0,0 +1,129 @@
+"""Helper functions for arraySpiker which record the time and resources used by each stage of a run and by each FE
+file parsed (array_spiker.py -profile).
+
+Wall time and CPU time are sampled at the start and end of each stage, along with the process's maximum resident memory
+so far (the operating system only records the high-water mark over the life of a process, not per stage). FE files
+parsed by worker processes are measured in the worker and the measurements returned to the parent with the parsed data.
+When profiling is disabled Profiler.stage() does no measurement, so instrumented code runs at the same speed."""
+
+from __future__ import print_function
+import contextlib
+import datetime
+import json
+import os
+import sys
+import time
+
+try:
+    import resource  # POSIX only, peak memory is not recorded on Windows
+except ImportError:
+    resource = None
+
+
+def peak_rss_megabytes(who=None):
+    """Return the peak resident set size of this process (or of its largest finished child process if
+    who=resource.RUSAGE_CHILDREN) in MB, or None if it cannot be measured on this platform"""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF if who is None else who).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes on Linux:
+    return round(max_rss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0), 1)
+
+
+def resource_usage():
+    """Return a snapshot of the wall time, CPU time (of this process and of its finished child processes) in seconds"""
+    times = os.times()
+    return {'wall': time.time(), 'cpu': times[0] + times[1], 'children_cpu': times[2] + times[3]}
+
+
+def usage_since(start):
+    """Return the wall time and CPU time used since the resource_usage() snapshot start, and the maximum resident
+    memory of the process so far"""
+    end = resource_usage()
+    usage = {'wall_seconds': round(end['wall'] - start['wall'], 4),
+             'cpu_seconds': round(end['cpu'] - start['cpu'], 4),
+             'max_rss_mb': peak_rss_megabytes()}
+    # Time spent in worker processes, e.g. when FE files are parsed in parallel:
+    children_cpu = end['children_cpu'] - start['children_cpu']
+    if children_cpu > 0:
+        usage['children_cpu_seconds'] = round(children_cpu, 4)
+        usage['children_max_rss_mb'] = peak_rss_megabytes(resource.RUSAGE_CHILDREN) if resource else None
+    return usage
+
+
+def profile_call(function, fe_file):
+    """Call function(fe_file, stats) where stats is a dictionary the function may add counts to (e.g. bytes_read).
+    Returns the result of the function and the measurements for the file. Used by worker processes, so measurements
+    are returned rather than recorded in a Profiler."""
+    stats = {}
+    start = resource_usage()
+    result = function(fe_file, stats=stats)
+    metrics = {'file': fe_file}
+    metrics.update(usage_since(start))
+    metrics.update(stats)
+    return result, metrics
+
+
+class Profiler(object):
+    """Records the resources used by each named stage of a run, and by each FE file, when enabled"""
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.started = datetime.datetime.now()
+        self.stages = []
+        self.files = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager measuring the enclosed code as stage name. Yields a dictionary to which counts for the
+        stage (e.g. rows) can be added."""
+        record = {'stage': name}
+        if not self.enabled:
+            yield record
+            return
+        start = resource_usage()
+        try:
+            yield record
+        finally:
+            record.update(usage_since(start))
+            self.stages.append(record)
+
+    def add_file(self, metrics):
+        """Record the measurements for one FE file (see profile_call())"""
+        if self.enabled:
+            self.files.append(metrics)
+
+    def to_dict(self):
+        return {'started': self.started.isoformat(), 'python': sys.version.split()[0], 'pid': os.getpid(),
+                'max_rss_mb': peak_rss_megabytes(), 'stages': self.stages, 'files': self.files}
+
+    def write(self, directory_path, prefix="profile"):
+        """Save the measurements as JSON, named in the same way as the logs written by analysis_helpers.write_log().
+        Returns the path of the file written."""
+        today = datetime.date.today().strftime('%d%b%Y')
+        profile_file_path = os.path.join(directory_path, "%s_%s_spikeInLog.json" % (prefix, today))
+        with open(profile_file_path, "w") as f:
+            json.dump(self.to_dict(), f, indent=2, sort_keys=True)
+        return profile_file_path
+
+    def summary_table(self, slowest_files=5):
+        """Return the stage measurements, and those of the slowest FE files, as a printable table. Memory is the
+        process's maximum resident memory at the end of each stage, so shows the stage at which memory grew."""
+        from analysis_helpers import make_pretty_label  # Imported here as analysis_helpers imports this module
+        from archive_helpers import is_archive
+        lines = ["%-28s %10s %10s %18s %10s" % ("Stage", "Wall (s)", "CPU (s)", "Max RSS so far MB", "Rows")]
+        for record in self.stages:
+            cpu = record['cpu_seconds'] + record.get('children_cpu_seconds', 0)
+            lines.append("%-28s %10.3f %10.3f %18s %10s" % (record['stage'], record['wall_seconds'], cpu,
+                                                            record['max_rss_mb'], record.get('rows', "")))
+        if self.files:
+            lines.append("")
+            lines.append("%-28s %10s %10s %18s %10s" % ("Slowest FE files", "Wall (s)", "CPU (s)", "MB read", "Rows"))
+            for metrics in sorted(self.files, key=lambda m: m['wall_seconds'], reverse=True)[:slowest_files]:
+                # Labelled by slide barcode and subarray, as in the logs:
+                label = os.path.basename(metrics['file']) if is_archive(metrics['file']) else make_pretty_label(
+                    metrics['file'])
+                lines.append("%-28s %10.3f %10.3f %18.1f %10d" % (
+                    label, metrics['wall_seconds'], metrics['cpu_seconds'],
+                    metrics.get('bytes_read', 0) / 1024.0 / 1024.0, metrics.get('rows_matched', 0)))
+        return "\n".join(lines)
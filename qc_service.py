@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+
+"""
+This script runs the spike in QC (array_spiker.py) as a long running local service, so that MOKA (or any other client)
+can request the verdict for a run without starting a new Python process, re-importing the analysis modules and
+re-parsing FE files each time. See service_helpers.py for what is kept in memory between requests.
+
+The service listens on a local TCP port (127.0.0.1 only) or a Unix socket and answers:
+    GET  /status  state of the service
+    POST /qc      analyse a run, the JSON body giving either {"run_id": 123} for a MOKA run or
+                  {"files": ["/path/to/FE file", ...], "spike_in_info": "/path/to/expected.csv"}, plus optionally
+                  name, spike_in_set, layout, scoring and plots (none or background). Returns the verdict as JSON.
+For example:
+    curl -d '{"run_id": 123}' http://127.0.0.1:8765/qc
+"""
+
+from __future__ import print_function
+import argparse
+import os
+
+
+def get_arguments(argv=None):
+    """Import Arguments from command line"""
+    parser = argparse.ArgumentParser(description='Serve spike in QC verdicts over HTTP from a warm process')
+    parser.add_argument('-output_dir', '-o',
+                        type=str,
+                        help='Directory the results of each request are saved to',
+                        required=True)
+    listen = parser.add_mutually_exclusive_group()
+    listen.add_argument('-port', '-p',
+                        type=int,
+                        default=8765,
+                        help='Local TCP port to listen on (default 8765)')
+    listen.add_argument('-socket',
+                        type=str,
+                        help='Listen on this Unix socket rather than a TCP port')
+    parser.add_argument('-workers',
+                        type=int,
+                        default=2,
+                        help='Maximum number of runs analysed at once, further requests wait (default 2)',
+                        required=False)
+    parser.add_argument('-queue_timeout',
+                        type=float,
+                        default=60.0,
+                        help='Seconds a request waits for a free worker before the service answers 503 busy '
+                             '(default 60)',
+                        required=False)
+    parser.add_argument('-cache_dir',
+                        type=str,
+                        help='FE file cache directory used for files not yet held in memory. Defaults to cacheDir in '
+                             'config.yaml',
+                        required=False)
+    parser.add_argument('-memory_files',
+                        type=int,
+                        default=5000,
+                        help='Number of parsed FE files held in memory (default 5000)',
+                        required=False)
+    return parser.parse_args(argv)
+
+
+def make_handler(service):
+    """Return the request handler class for a QCService"""
+    import json
+    from http.server import BaseHTTPRequestHandler
+    from service_helpers import ServiceBusy
+
+    class QCRequestHandler(BaseHTTPRequestHandler):
+
+        def send_json(self, code, body):
+            content = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(content)))
+            self.end_headers()
+            self.wfile.write(content)
+
+        def do_GET(self):
+            if self.path.rstrip('/') == '/status':
+                self.send_json(200, service.status())
+            else:
+                self.send_json(404, {'error': "Unknown path %s" % self.path})
+
+        def do_POST(self):
+            if self.path.rstrip('/') != '/qc':
+                self.send_json(404, {'error': "Unknown path %s" % self.path})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))).decode('utf-8'))
+                if not isinstance(request, dict):
+                    raise ValueError("Request body must be a JSON object")
+                verdict = service.run_qc(request)
+            except ValueError as exc:
+                self.send_json(400, {'error': str(exc)})
+            except ServiceBusy as exc:
+                self.send_json(503, {'error': str(exc)})
+            else:
+                self.send_json(200 if verdict['error'] is None else 500, verdict)
+
+        def address_string(self):
+            # Clients of a Unix socket have no address:
+            return self.client_address[0] if self.client_address else self.server.server_address
+
+    return QCRequestHandler
+
+
+def make_server(service, port=8765, socket_path=None):
+    """Return a threaded HTTP server for a QCService, listening on a local port or a Unix socket"""
+    import socketserver
+    from http.server import HTTPServer
+
+    if socket_path is None:
+        class QCServer(socketserver.ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+        return QCServer(('127.0.0.1', port), make_handler(service))
+
+    class UnixQCServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+    if os.path.exists(socket_path):
+        os.remove(socket_path)  # Left by a previous service
+    return UnixQCServer(socket_path, make_handler(service))
+
+
+def main(argv=None):
+    """Start the service, serving requests until interrupted"""
+    args = get_arguments(argv)
+    # Imported once arguments are valid so that -h returns without loading pandas
+    from service_helpers import QCService
+
+    service = QCService(args.output_dir, workers=args.workers, queue_timeout=args.queue_timeout,
+                        cache_dir=args.cache_dir, memory_files=args.memory_files)
+    server = make_server(service, args.port, args.socket)
+    print("Spike in QC service listening on %s with %d worker(s)" % (
+        args.socket or "http://127.0.0.1:%d" % server.server_address[1], args.workers))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if args.socket and os.path.exists(args.socket):
+            os.remove(args.socket)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+"""
+This script queries the columnar results store that array_spiker.py appends each run to (-store_dir or storeDir in
+config.yaml, see store_helpers.py). Rows of the signals table (per-replicate signals) or calls table (per-sample QC
+calls) can be filtered by probe, run, slide, subarray and date, then printed, saved as CSV or summarised by month to
+follow the trend in a probe's signal over time, signals from samples the probe was spiked into and from those it was
+not being summarised separately, e.g.
+
+    query_results.py -probes A_18_P12844310 -start 2018-01-01 -trend
+"""
+
+from __future__ import print_function
+import argparse
+import datetime
+import os
+import sys
+
+
+def parse_date(value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError("Dates should be given as YYYY-MM-DD, not %s" % value)
+
+
+def get_arguments(argv=None):
+    """Import Arguments from command line"""
+    parser = argparse.ArgumentParser(description='Query the results store written by array_spiker.py')
+    parser.add_argument('-store_dir',
+                        type=str,
+                        help='Results store directory. Defaults to storeDir in config.yaml',
+                        required=False)
+    parser.add_argument('-table', '-t',
+                        choices=['signals', 'calls'],
+                        default='signals',
+                        help='Per-replicate signals or per-sample QC calls (default signals)',
+                        required=False)
+    parser.add_argument('-probes', '-p',
+                        nargs='+',
+                        help='Probe names to return',
+                        required=False)
+    parser.add_argument('-runs', '-r',
+                        nargs='+',
+                        type=int,
+                        help='MOKA run IDs to return',
+                        required=False)
+    parser.add_argument('-slides',
+                        nargs='+',
+                        help='Slide barcodes to return',
+                        required=False)
+    parser.add_argument('-subarrays',
+                        nargs='+',
+                        help='Subarrays to return in FE file format e.g. 1_3',
+                        required=False)
+    parser.add_argument('-start',
+                        type=parse_date,
+                        help='Earliest analysis date (YYYY-MM-DD)',
+                        required=False)
+    parser.add_argument('-end',
+                        type=parse_date,
+                        help='Latest analysis date (YYYY-MM-DD)',
+                        required=False)
+    parser.add_argument('-columns', '-c',
+                        nargs='+',
+                        help='Columns to return. Defaults to all columns',
+                        required=False)
+    parser.add_argument('-all_analyses',
+                        action='store_true',
+                        help='Return rows from every analysis of a subarray rather than only the latest')
+    parser.add_argument('-trend',
+                        action='store_true',
+                        help='Summarise signals as the median and number of replicates per probe, channel and month, '
+                             'spiked (expected, or called if not on the sample sheet) and unspiked signals separately')
+    parser.add_argument('-output', '-o',
+                        type=str,
+                        help='CSV file the results are saved to. Results are printed if omitted',
+                        required=False)
+    args = parser.parse_args(argv)
+    if args.trend and args.table != 'signals':
+        parser.error("-trend summarises the signals table, not the %s table" % args.table)
+    return args
+
+
+def main(argv=None):
+    args = get_arguments(argv)
+    # Imported once arguments are valid so that -h returns without loading pandas
+    from analysis_helpers import load_config
+    from store_helpers import query_store, trend_signals
+
+    store_dir = args.store_dir or load_config().get("storeDir")
+    if store_dir is None:
+        sys.exit("No results store given, use -store_dir or set storeDir in config.yaml")
+    store_dir = os.path.expanduser(store_dir)
+
+    df = query_store(store_dir, args.table, probes=args.probes, runs=args.runs, slides=args.slides,
+                     subarrays=args.subarrays, start=args.start, end=args.end,
+                     columns=None if args.trend else args.columns,
+                     latest_only=not args.all_analyses)
+    if df.empty:
+        print("No matching rows found in: %s" % store_dir)
+        return
+    if args.trend:
+        df = trend_signals(df)
+
+    if args.output:
+        df.to_csv(args.output, index=False)
+        print("%d rows saved in: %s" % (len(df), args.output))
+    else:
+        print(df.to_string(index=False))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+
+"""
+This script renders the heatmap and intensity plot for a run of array_spiker.py from the summary and signal summary
+logs it saved. Used by array_spiker.py to render plots in the background, or to produce plots after the analysis.
+"""
+
+from __future__ import print_function
+import argparse
+
+
+def get_arguments(argv=None):
+    """Import Arguments from command line"""
+    parser = argparse.ArgumentParser(description='Render plots from the logs saved by array_spiker.py')
+    parser.add_argument('-summary', '-s',
+                        type=str,
+                        help='Summary log (summary_<date>_spikeInLog.txt)',
+                        required=True)
+    parser.add_argument('-signals', '-g',
+                        type=str,
+                        help='Signal summary log (signal_summary_<date>_spikeInLog.txt)',
+                        required=True)
+    parser.add_argument('-output_dir', '-o',
+                        type=str,
+                        help='Directory the plots are saved to',
+                        required=True)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = get_arguments(argv)
+    # Imported once arguments are valid so that -h returns without loading pandas
+    from analysis_helpers import render_reports
+    render_reports(args.summary, args.signals, args.output_dir)
+    print("Plots saved in: %s" % args.output_dir)
+
+
+if __name__ == '__main__':
+    main()
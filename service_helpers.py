@@ -0,0 +1,185 @@
+"""Helper functions for qc_service.py, a long running process which runs the spike in QC (array_spiker.py) on request,
+e.g. from MOKA, without starting a new Python process for each run.
+
+The analysis modules, config.yaml, the trio decoding index of each plate layout and the pooled MOKA connection are
+loaded once and kept for the life of the service. The parsed rows of each FE file are held in memory (keyed by the
+file's path, size and modification time, so a changed file is parsed again), so a run whose FE files have been parsed
+before is analysed without reading them. Files not held in memory are read through the FE file cache, which is evicted
+after each run that reads files, as array_spiker.py does. Requests are handled concurrently, at most workers runs being
+analysed at once."""
+
+from __future__ import print_function
+import collections
+import json
+import os
+import re
+import threading
+import time
+import pandas
+from analysis_helpers import (call_safely, calculate_spiked_probes_combinations, find_log, load_config,
+                              parse_config_file, parse_data_file)
+from archive_helpers import locate_fe_files
+from cache_helpers import evict_cache
+from trio_helpers import PASS, PLATE_WELLS, build_trio_index
+
+# Settings a request may give, with their array_spiker.py argument. Plots may not be rendered inline by the service
+# as matplotlib is not thread safe.
+REQUEST_OPTIONS = collections.OrderedDict([('spike_in_set', ('A', 'B')), ('layout', None),
+                                           ('scoring', ('saturation', 'zscore')), ('plots', ('none', 'background'))])
+
+
+class ServiceBusy(Exception):
+    """Raised when no worker becomes free to analyse a run within the queue timeout"""
+    pass
+
+
+class QCService(object):
+    """Warm state shared by the requests handled by qc_service.py"""
+
+    def __init__(self, output_dir, workers=2, queue_timeout=60.0, cache_dir=None, memory_files=5000):
+        import array_spiker  # Imported here so that the analysis modules are loaded before the first request
+        self.array_spiker = array_spiker
+        self.output_dir = output_dir
+        self.workers = workers
+        self.queue_timeout = queue_timeout
+        self.memory_files = memory_files
+        self.config = load_config()
+        self.spike_in_probes = parse_config_file()
+        self.cache_dir = cache_dir
+        if self.cache_dir is None and self.config.get("cacheDir"):
+            self.cache_dir = os.path.expanduser(self.config["cacheDir"])
+        # Decoding index of the default layout for each spike in set, other layouts are added as they are requested:
+        trios = calculate_spiked_probes_combinations(self.spike_in_probes)[:len(PLATE_WELLS)]
+        self.trio_indices = dict(((None, spike_in_set), build_trio_index(self.spike_in_probes, trios, spike_in_set))
+                                 for spike_in_set in REQUEST_OPTIONS['spike_in_set'])
+        self.moka = None
+        if os.environ.get("MOKA_CONNECTION_STRING"):
+            import moka_helpers
+            moka_helpers.get_engine()  # Created now so that the connection pool is shared by every request
+            self.moka = moka_helpers
+        self._rows = collections.OrderedDict()  # (path, size, mtime) -> parsed rows, least recently used first
+        self._rows_lock = threading.Lock()
+        self._baseline_lock = threading.Lock()  # zscore scoring updates the baseline file
+        self._workers = threading.BoundedSemaphore(workers)
+        self._counter_lock = threading.Lock()
+        self.busy = 0
+        self.requests = 0
+        self.started = time.time()
+
+    def status(self):
+        """Return a dictionary describing the state of the service"""
+        return {'status': 'ok', 'workers': self.workers, 'busy': self.busy, 'requests': self.requests,
+                'parsed_files': len(self._rows), 'moka': self.moka is not None,
+                'uptime_seconds': round(time.time() - self.started, 1)}
+
+    def parsed_rows(self, fe_files):
+        """Return the parsed rows of the FE files, reading only those not held in memory. Returns the rows and the
+        number of files read."""
+        frames = []
+        files_read = 0
+        for fe_file in fe_files:
+            stat = os.stat(fe_file)
+            key = (os.path.abspath(fe_file), stat.st_size, stat.st_mtime)
+            with self._rows_lock:
+                df = self._rows.pop(key, None)
+                if df is not None:
+                    self._rows[key] = df  # Most recently used
+            if df is None:
+                df = parse_data_file(fe_file, self.spike_in_probes, self.cache_dir)
+                files_read += 1
+                with self._rows_lock:
+                    self._rows[key] = df
+                    while len(self._rows) > self.memory_files:
+                        self._rows.popitem(last=False)
+            frames.append(df)
+        return pandas.concat(frames, ignore_index=True), files_read
+
+    def fe_files(self, request):
+        """Return the name of the run and its FE files: those given by the request, or found in feDirectory for the
+        MOKA run"""
+        if request.get('files'):
+            files = list(request['files'])
+            missing = [fe_file for fe_file in files if not os.path.exists(fe_file)]
+            if missing:
+                raise ValueError("FE file(s) not found: %s" % ", ".join(missing))
+            # The name is part of the output directory, so must not contain a path:
+            return re.sub(r'[^\w.-]', '_', str(request.get('name') or "request")), files
+        if self.moka is None:
+            raise ValueError("run_id requires MOKA, set MOKA_CONNECTION_STRING before starting the service")
+        files = locate_fe_files(self.config["feDirectory"], self.moka.get_fe_file_name(request['run_id']).values())
+        missing = [fe_file for fe_file in files if not os.path.exists(fe_file)]
+        if missing:
+            raise ValueError("FE file(s) not found for run %s: %s" % (request['run_id'], ", ".join(missing)))
+        return "run_%d" % request['run_id'], files
+
+    def run_qc(self, request):
+        """Analyse the run described by a request dictionary, giving either run_id (MOKA run) or files (FE file paths)
+        and optionally spike_in_info (expected spike in profile), name and the settings in REQUEST_OPTIONS. Returns
+        the verdict as a dictionary which can be serialised as JSON. Raises ValueError for an invalid request and
+        ServiceBusy if the run is not started within the queue timeout."""
+        if bool(request.get('run_id') is not None) == bool(request.get('files')):
+            raise ValueError("Give either run_id or files")
+        if request.get('run_id') is not None and not isinstance(request['run_id'], int):
+            raise ValueError("run_id must be an integer")
+        settings = []
+        for option, choices in REQUEST_OPTIONS.items():
+            if request.get(option) is not None:
+                if choices is not None and request[option] not in choices:
+                    raise ValueError("%s must be one of: %s" % (option, ", ".join(choices)))
+                settings += ['-' + option, str(request[option])]
+        if request.get('spike_in_info') is not None:
+            if not os.path.exists(request['spike_in_info']):
+                raise ValueError("Expected spike in profile not found: %s" % request['spike_in_info'])
+            settings += ['-spike_in_info', request['spike_in_info']]
+        if request.get('run_id') is not None:
+            settings += ['-run_id', str(request['run_id'])]
+        if '-plots' not in settings:
+            settings += ['-plots', 'none']
+
+        start = time.time()
+        name, fe_files = self.fe_files(request)
+        if not self._workers.acquire(timeout=self.queue_timeout):
+            raise ServiceBusy("All %d workers busy for %.0f seconds" % (self.workers, self.queue_timeout))
+        try:
+            with self._counter_lock:
+                self.busy += 1
+                self.requests += 1
+                request_number = self.requests
+            # Each request has its own output directory, as logs are named by date:
+            output_dir = os.path.join(self.output_dir, "%s_%s_%d" % (name, time.strftime("%Y%m%d%H%M%S"),
+                                                                     request_number))
+            argv = ['-file'] + fe_files + ['-output_dir', output_dir, '-no_cache'] + settings
+            result, error = call_safely(self.analyse, argv, fe_files, request.get('scoring') == 'zscore')
+        finally:
+            with self._counter_lock:
+                self.busy -= 1
+            self._workers.release()
+        passed, files_read = result or (None, None)
+        return make_verdict(name, passed, output_dir, len(fe_files), files_read, time.time() - start, error)
+
+    def analyse(self, argv, fe_files, zscore=False):
+        """Analyse a run with array_spiker.py using the parsed rows of its FE files. Returns True if the QC step has
+        been passed and the number of FE files read."""
+        df, files_read = self.parsed_rows(fe_files)
+        if files_read and self.cache_dir is not None:
+            # array_spiker.py is given the parsed rows (and -no_cache) so does not evict the entries added here:
+            evict_cache(self.cache_dir, self.config.get("cacheMaxMegabytes"), self.config.get("cacheMaxAgeDays"))
+        if zscore:
+            with self._baseline_lock:
+                return self.array_spiker.main(argv, df=df, trio_indices=self.trio_indices), files_read
+        return self.array_spiker.main(argv, df=df, trio_indices=self.trio_indices), files_read
+
+
+def make_verdict(name, passed, output_dir, num_files, files_read, seconds, error=None):
+    """Return the verdict of a run from its qc_results log, if it had an expected spike in profile and was analysed
+    without error"""
+    verdict = collections.OrderedDict([('run', name), ('passed', None), ('failed_channels', None),
+                                       ('channels', []), ('files', num_files), ('files_read', files_read),
+                                       ('seconds', round(seconds, 3)), ('output_dir', output_dir), ('error', error)])
+    qc_results_file = find_log(output_dir, "qc_results")
+    if qc_results_file is not None and error is None:
+        identity_df = pandas.read_csv(qc_results_file, index_col=0)
+        verdict['passed'] = bool(passed)
+        verdict['failed_channels'] = int((identity_df['Status'] != PASS).sum())
+        verdict['channels'] = json.loads(identity_df.to_json(orient='records'))
+    return verdict
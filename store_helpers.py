@@ -0,0 +1,184 @@
+"""Helper functions for arraySpiker which append the results of each run to a columnar results store and query it.
+
+The store is a directory of Parquet files (requires the optional pyarrow package) holding two tables:
+
+    signals - one row per replicate of each spike in probe in each FE file (the rows of the verbose results log),
+              flagged by whether the probe was called (gCalled/rCalled) and expected (gExpected/rExpected) in the sample
+    calls   - one row per sample and channel with the expected and detected trio and QC status (the qc_results log)
+
+Rows are keyed by Run (MOKA run ID), Slide (array barcode), Subarray (FE file format e.g. 1_3) and ProbeName, and
+stamped with the time of the analysis. Each analysis is written as new files and existing files are never modified, so
+a run that is re-analysed is appended again; queries return the latest analysis of each subarray by default. Files are
+partitioned by month of analysis and rows sorted by probe so that queries on a date range or a few probes only read
+the matching files and row groups."""
+
+from __future__ import print_function
+import datetime
+import os
+import numpy as np
+import pandas
+from trio_helpers import CHANNELS
+
+STORE_TABLES = ('signals', 'calls')
+
+# Columns identifying the source of each row, added to both tables:
+KEY_COLUMNS = ['Run', 'Slide', 'Subarray', 'AnalysisTime']
+
+PARTITION_COLUMN = 'Month'
+
+
+def _pyarrow():
+    """Import pyarrow, which is only needed when the results store is used"""
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("The results store requires pyarrow, install it with: pip install pyarrow")
+    return pyarrow
+
+
+def split_sample_label(label):
+    """Return the slide barcode and subarray from an FE file label, e.g. 258503010103_2_1_3 -> (258503010103, 1_3)"""
+    fields = label.split("_")
+    return fields[0], "_".join(fields[-2:])
+
+
+def add_key_columns(df, run_id, analysis_time, sample_column):
+    """Return a copy of df with the key columns added, Slide and Subarray taken from the FE file labels in
+    sample_column"""
+    df = df.reset_index(drop=True)
+    slides, subarrays = zip(*df[sample_column].map(split_sample_label)) if len(df) else ((), ())
+    keys = pandas.DataFrame({'Run': pandas.array([run_id] * len(df), dtype='Int64'),
+                             'Slide': list(slides), 'Subarray': list(subarrays),
+                             'AnalysisTime': pandas.Series([analysis_time] * len(df), dtype='datetime64[us]')},
+                            columns=KEY_COLUMNS)
+    return pandas.concat([keys, df], axis=1)
+
+
+def probe_flags(samples, probes, calls, expected_masks=None):
+    """Return one row per sample and probe flagging whether the probe was called present in each channel (gCalled,
+    rCalled from the samples x probes x channels array of calls) and expected from the sample sheet (gExpected,
+    rExpected from the samples x channels array of bitmasks aligned with samples). Expected flags are missing (NA)
+    for samples not on the sample sheet, or for every sample if there is no sample sheet."""
+    flags = pandas.DataFrame({'Sample': np.repeat(np.asarray(samples, dtype=object), len(probes)),
+                              'ProbeName': np.tile(np.asarray(probes, dtype=object), len(samples))})
+    probe_bits = np.left_shift(1, np.arange(len(probes), dtype=np.int64))
+    for c, channel in enumerate(CHANNELS):
+        flags[channel + 'Called'] = np.asarray(calls)[:, :, c].ravel()
+        expected = pandas.array([pandas.NA] * len(flags), dtype='boolean')
+        if expected_masks is not None:
+            masks = np.asarray(expected_masks, dtype=np.int64)[:, c]
+            expected = pandas.array((np.bitwise_and(masks[:, np.newaxis], probe_bits) > 0).ravel(), dtype='boolean')
+            expected[np.repeat(masks < 0, len(probes))] = pandas.NA
+        flags[channel + 'Expected'] = expected
+    return flags
+
+
+def signals_table(df, run_id, analysis_time, flags=None):
+    """Convert the verbose results (one row per FE file row, FE_filename holding the FE file label) to the signals
+    table. Replicates are numbered in the order they appear in each FE file. flags (from probe_flags()) adds whether
+    each probe was called and expected in the sample."""
+    signals = df.rename(columns={'FE_filename': 'Sample'})
+    signals.insert(0, 'Replicate', signals.groupby(['Sample', 'ProbeName'], sort=False).cumcount())
+    if flags is not None:
+        signals = signals.merge(flags, on=['Sample', 'ProbeName'], how='left')
+    return add_key_columns(signals, run_id, analysis_time, 'Sample')
+
+
+def calls_table(identity_df, run_id, analysis_time):
+    """Convert the results of trio_helpers.check_sample_identity() to the calls table"""
+    return add_key_columns(identity_df, run_id, analysis_time, 'Sample')
+
+
+def append_results(store_dir, table_name, df, sort_columns=('ProbeName', 'Slide', 'Subarray')):
+    """Append rows (from signals_table() or calls_table()) to a table in the store. Rows are written to a new file in
+    the partition for the month of their AnalysisTime. Returns the paths of the files written."""
+    pyarrow = _pyarrow()
+    if table_name not in STORE_TABLES:
+        raise ValueError("Unknown results store table %s, expected one of %s" % (table_name, ", ".join(STORE_TABLES)))
+    df = df.sort_values([column for column in sort_columns if column in df.columns], kind='mergesort')
+    written = []
+    months = df['AnalysisTime'].dt.strftime('%Y-%m')
+    for month, month_df in df.groupby(months, sort=True):
+        partition_dir = os.path.join(store_dir, table_name, "%s=%s" % (PARTITION_COLUMN, month))
+        if not os.path.exists(partition_dir):
+            try:
+                os.makedirs(partition_dir)
+            except OSError:
+                # Directory may have been created by a concurrent run
+                if not os.path.isdir(partition_dir):
+                    raise
+        run = month_df['Run'].iloc[0]
+        file_name = "run-%s-%s-%d.parquet" % ("none" if pandas.isnull(run) else run,
+                                               month_df['AnalysisTime'].iloc[0].strftime('%Y%m%dT%H%M%S%f'),
+                                               os.getpid())
+        file_path = os.path.join(partition_dir, file_name)
+        table = pyarrow.Table.from_pandas(month_df, preserve_index=False)
+        # Written to a temporary name then renamed so that queries never read a partially written file:
+        temp_path = file_path + ".tmp"
+        pyarrow.parquet.write_table(table, temp_path, row_group_size=10000)
+        os.replace(temp_path, file_path)
+        written.append(file_path)
+    return written
+
+
+def query_store(store_dir, table_name, probes=None, runs=None, slides=None, subarrays=None, start=None, end=None,
+                columns=None, latest_only=True):
+    """Return the rows of a results store table matching all of the given filters as a dataframe. probes, runs,
+    slides and subarrays are lists of values to match, start and end are dates limiting the AnalysisTime. Filters are
+    applied while reading so that only matching partitions and row groups are read. If latest_only, rows from earlier
+    analyses of the same subarray are dropped."""
+    pyarrow = _pyarrow()
+    dataset_dir = os.path.join(store_dir, table_name)
+    if not os.path.isdir(dataset_dir):
+        return pandas.DataFrame(columns=columns)
+    partitioning = pyarrow.dataset.partitioning(pyarrow.schema([(PARTITION_COLUMN, pyarrow.string())]),
+                                                flavor='hive')
+    dataset = pyarrow.dataset.dataset(dataset_dir, format='parquet', partitioning=partitioning,
+                                      exclude_invalid_files=False, ignore_prefixes=['.', '_'])
+    field = pyarrow.dataset.field
+    conditions = []
+    for column, values in (('ProbeName', probes), ('Run', runs), ('Slide', slides), ('Subarray', subarrays)):
+        if values:
+            conditions.append(field(column).isin(list(values)))
+    if start is not None:
+        conditions.append(field(PARTITION_COLUMN) >= start.strftime('%Y-%m'))
+        conditions.append(field('AnalysisTime') >= pyarrow.scalar(datetime.datetime.combine(start, datetime.time()),
+                                                                  pyarrow.timestamp('us')))
+    if end is not None:
+        conditions.append(field(PARTITION_COLUMN) <= end.strftime('%Y-%m'))
+        conditions.append(field('AnalysisTime') < pyarrow.scalar(
+            datetime.datetime.combine(end + datetime.timedelta(days=1), datetime.time()), pyarrow.timestamp('us')))
+    condition = None
+    for expression in conditions:
+        condition = expression if condition is None else condition & expression
+    read_columns = None
+    if columns is not None:
+        # Key columns are needed to select the latest analysis:
+        read_columns = list(columns) + [column for column in KEY_COLUMNS if latest_only and column not in columns]
+    df = dataset.to_table(columns=read_columns, filter=condition).to_pandas()
+    if latest_only and len(df):
+        latest = df.groupby(['Run', 'Slide', 'Subarray'], dropna=False)['AnalysisTime'].transform('max')
+        df = df[df['AnalysisTime'] == latest]
+    if columns is not None:
+        df = df[list(columns)]
+    return df.reset_index(drop=True)
+
+
+def trend_signals(signals):
+    """Summarise rows of the signals table as the median signal and number of replicates per probe, channel and month
+    of analysis. Spiked signals (the probe expected in the sample, or called if the sample is not on the sample sheet)
+    and unspiked signals are summarised separately, Spiked being missing for rows stored without these flags."""
+    months = signals['AnalysisTime'].dt.strftime('%Y-%m')
+    channels = []
+    for channel in CHANNELS:
+        flags = signals.reindex(columns=[channel + 'Expected', channel + 'Called'])
+        channels.append(pandas.DataFrame({'ProbeName': signals['ProbeName'], 'Channel': channel,
+                                          'Spiked': flags[channel + 'Expected'].fillna(flags[channel + 'Called']),
+                                          'Month': months, 'MedianSignal': signals[channel + 'MedianSignal']}))
+    grouped = pandas.concat(channels, ignore_index=True).groupby(['ProbeName', 'Channel', 'Spiked', 'Month'],
+                                                                  dropna=False)['MedianSignal']
+    trend = grouped.median().to_frame()
+    trend['Replicates'] = grouped.size()
+    return trend.reset_index()
@@ -1,8 +1,86 @@
 """Contains tests for array_spiker.py and associate scripts"""
 
-import unittest2 as unittest
-from analysis_helpers import *
-from moka_helpers import *
+import unittest
+import datetime
+import gzip
+import json
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+import threading
+import numpy as np
+import pandas
+from analysis_helpers import (bitmask_to_calls, calculate_spiked_probes_combinations, calls_to_bitmask,
+                              create_output_directory, find_log, import_data, load_config, make_pretty_label,
+                              num_spiked_probes_combinations, parse_config_file, parse_data_file, read_log,
+                              render_reports, replicate_consensus, summarise_array_replicates, summarise_signals,
+                              write_log)
+from archive_helpers import locate_fe_file
+from baseline_helpers import (empty_baseline, read_baseline, read_merged_samples, record_merged_samples, score_signals,
+                              update_baseline, write_baseline)
+from batch_helpers import discover_runs, read_checkpoint
+from cache_helpers import SIGNATURE_BYTES, cache_file_path, cache_key, evict_cache, load_cached_columns
+from moka_helpers import (ArrayLabelledDNA, ArrayLabelling, create_moka_schema, get_engine, get_expected_spike_ins,
+                          get_fe_file_name, get_run_records, get_well_ids, moka_name, write_results_to_moka)
+from naming_helpers import create_sample_filename, subarray_id_translator
+from profiling_helpers import Profiler
+from service_helpers import QCService
+from store_helpers import append_results, probe_flags, query_store, signals_table
+from trio_helpers import (CONTAMINATION, MAX_TABLE_PROBES, MISMATCH, MISSING, NOT_DETECTED, PARTIAL_MATCH, PASS,
+                          align_bitmasks, build_trio_index, check_sample_identity, decode_trio, design_trio_layout,
+                          expected_bitmasks, layout_min_distance, layout_to_expected_spike_ins, nearest_trios,
+                          probes_to_bitmask)
+from watch_helpers import PollingWatcher, RunState, create_watcher, parse_arrived_file
+import generate_test_files
+import array_spiker
+import batch_spiker
+import qc_service
+import query_results
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
+# Minimal Feature Extraction file: FEPARAMS and STATS tables followed by a FEATURES table holding two replicates of
+# one spike in probe and one unrelated probe.
+FE_FILE_TEMPLATE = "\n".join([
+    "TYPE\ttext\tint",
+    "FEPARAMS\tProtocol_Name\tScan_NumChannels",
+    "DATA\tCGH_1100_Jul11\t2",
+    "*",
+    "TYPE\tint\tfloat",
+    "STATS\tgDarkOffsetAverage\trDarkOffsetAverage",
+    "DATA\t24.5\t30.1",
+    "*",
+    "TYPE\tinteger\tinteger\ttext\ttext\tfloat\tfloat\tfloat\tfloat\tfloat\tfloat\tboolean\tboolean",
+    "FEATURES\tFeatureNum\tRow\tProbeName\tSystematicName\tgProcessedSignal\trProcessedSignal\tgMedianSignal"
+    "\trMedianSignal\tgBGMedianSignal\trBGMedianSignal\tgIsSaturated\trIsSaturated",
+    "DATA\t1\t1\tA_16_P02153618\tchr1:1-60\t65000.5\t120.2\t65527\t150\t40\t41\t1\t0",
+    "DATA\t2\t1\tA_14_P000000\tchr2:1-60\t300.1\t250.2\t320\t260\t42\t43\t0\t0",
+    "DATA\t3\t2\tA_16_P02153618\tchr1:1-60\t64000.5\t110.2\t65527\t140\t39\t40\t1\t0",
+    ""])
+
+
+class TempDirTestCase(unittest.TestCase):
+    """Base class for tests which write files, each test having its own temporary directory."""
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def write_fe_files(self, barcode, subarrays, directory=None):
+        """Write FE_FILE_TEMPLATE as the FE file of each MOKA subarray number of a slide, in directory (default the
+        temporary directory). Returns the FE file paths."""
+        fe_files = [os.path.join(directory or self.temp_dir, create_sample_filename(barcode, subarray))
+                    for subarray in subarrays]
+        for fe_file in fe_files:
+            with open(fe_file, "w") as f:
+                f.write(FE_FILE_TEMPLATE)
+        return fe_files
 
 
 class ArraySpikerTest(unittest.TestCase):
@@ -10,43 +88,542 @@ class ArraySpikerTest(unittest.TestCase):
 
     def test_label_maker(self):
         """Is file name string shortened correctly for use as a label in plot"""
-        self.assertEquals(make_pretty_label("258503010103_S01_Guys121919_CGH_1100_Jul11_2_1_3.txt"),
-                          "258503010103_2_1_3",
-                          msg="ERROR: string returned by make_pretty_label() does not match expected output")
+        self.assertEqual(make_pretty_label("258503010103_S01_Guys121919_CGH_1100_Jul11_2_1_3.txt"),
+                         "258503010103_2_1_3",
+                         msg="ERROR: string returned by make_pretty_label() does not match expected output")
 
     def test_creation_of_output_directory(self):
         """Test that output directory name is processed correctly"""
         cwd = os.getcwd()
         test_regex = r"^" + re.escape(cwd) + "/array_spiker_output_"
-        self.assertRegexpMatches(create_output_directory(cwd),
-                                 test_regex,
-                                 msg="ERROR: str returned by create_output_directory() does not match expected output")
+        self.assertRegex(create_output_directory(cwd),
+                         test_regex,
+                         msg="ERROR: str returned by create_output_directory() does not match expected output")
 
     def test_create_sample_name(self):
         """Test that FE file name is created correctly"""
         message = "ERROR: string returned by create_sample_name() does not match expected output"
-        self.assertEquals(create_sample_filename("258503010062", 1),
-                          "258503010062_S01_Guys121919_CGH_1100_Jul11_2_1_1",
-                          msg=message)
-        self.assertEquals(create_sample_filename("258503010062", 2),
-                          "258503010062_S01_Guys121919_CGH_1100_Jul11_2_1_2",
-                          msg=message)
-        self.assertEquals(create_sample_filename("258503010062", 8),
-                          "258503010062_S01_Guys121919_CGH_1100_Jul11_2_2_4",
-                          msg=message)
+        self.assertEqual(create_sample_filename("258503010062", 1),
+                         "258503010062_S01_Guys121919_CGH_1100_Jul11_2_1_1.txt",
+                         msg=message)
+        self.assertEqual(create_sample_filename("258503010062", 2),
+                         "258503010062_S01_Guys121919_CGH_1100_Jul11_2_1_2.txt",
+                         msg=message)
+        self.assertEqual(create_sample_filename("258503010062", 8),
+                         "258503010062_S01_Guys121919_CGH_1100_Jul11_2_2_4.txt",
+                         msg=message)
 
     def test_subarray_id_translator(self):
         """Test that translation between MOKA and FE filename subarray IDs is correct"""
         message = "ERROR: string returned by test_subarray_id_translator() does not match expected output"
-        self.assertEquals(subarray_id_translator(3), "1_3", msg=message)
-        self.assertEquals(subarray_id_translator(4), "1_4", msg=message)
-        self.assertEquals(subarray_id_translator(5), "2_1", msg=message)
-        self.assertEquals(subarray_id_translator(6), "2_2", msg=message)
-        self.assertEquals(subarray_id_translator(7), "2_3", msg=message)
-        self.assertEquals(subarray_id_translator(3), subarray_id_translator(3, 0), msg=message)
+        self.assertEqual(subarray_id_translator(3), "1_3", msg=message)
+        self.assertEqual(subarray_id_translator(4), "1_4", msg=message)
+        self.assertEqual(subarray_id_translator(5), "2_1", msg=message)
+        self.assertEqual(subarray_id_translator(6), "2_2", msg=message)
+        self.assertEqual(subarray_id_translator(7), "2_3", msg=message)
+        self.assertEqual(subarray_id_translator(3), subarray_id_translator(3, 0), msg=message)
         # Check that translation works from FE File IDs ---> Moka IDs
-        self.assertEquals(subarray_id_translator("2_3", 1), 7, msg=message)
-        self.assertEquals(subarray_id_translator("1_2", 1), 2, msg=message)
+        self.assertEqual(subarray_id_translator("2_3", 1), 7, msg=message)
+        self.assertEqual(subarray_id_translator("1_2", 1), 2, msg=message)
+
+
+class FEFileImportTest(TempDirTestCase):
+    """Tests for reading, caching and profiling FE files."""
+
+    def test_parse_data_file(self):
+        """Test that only spike in probe rows are extracted and typed using the FEATURES header"""
+        fe_file = self.write_fe_files("258503010103", [3])[0]
+        df = parse_data_file(fe_file, ["A_16_P02153618", "A_16_P16375641"])
+        self.assertEqual(list(df['FeatureNum']), [1, 3])
+        self.assertEqual(list(df['ProbeName']), ["A_16_P02153618", "A_16_P02153618"])
+        self.assertEqual(list(df['gIsSaturated']), [1, 1])
+        self.assertEqual(list(df['rMedianSignal']), [150.0, 140.0])
+        self.assertEqual(df['gProcessedSignal'].dtype, np.float64)
+        self.assertTrue((df['FE_filename'] == fe_file).all())
+
+    def test_compressed_and_archived_fe_files(self):
+        """Test that gzip compressed FE files and slide archives are read without decompressing them to disk, each FE
+        file in an archive giving a subarray in the results"""
+        fe_files = self.write_fe_files("258503010103", [5, 3])
+        with open(fe_files[0], "rb") as f, gzip.open(fe_files[0] + ".gz", "wb") as compressed:
+            compressed.write(f.read())
+        expected_df = parse_data_file(fe_files[0], ["A_16_P02153618"])
+        gzip_df = parse_data_file(fe_files[0] + ".gz", ["A_16_P02153618"])
+        self.assertTrue(gzip_df.drop(columns='FE_filename').equals(expected_df.drop(columns='FE_filename')))
+        self.assertEqual(make_pretty_label(fe_files[0] + ".gz"), "258503010103_2_2_1")
+        archive = os.path.join(self.temp_dir, "258503010103.tar.gz")
+        with tarfile.open(archive, "w:gz") as tar:
+            for fe_file in fe_files:
+                tar.add(fe_file, arcname="258503010103/" + os.path.basename(fe_file))
+            tar.add(fe_files[0] + ".gz", arcname="notes.txt.gz")  # Not an FE file name, ignored
+        archive_df = import_data([archive], ["A_16_P02153618"])
+        # Files are returned in order of subarray position (2_1 is position 5, 1_3 is position 3):
+        self.assertEqual(list(archive_df['FE_filename'].apply(make_pretty_label)),
+                         ["258503010103_2_1_3"] * 2 + ["258503010103_2_2_1"] * 2)
+        self.assertEqual(list(archive_df['FeatureNum']), [1, 3, 1, 3])
+        # Archives may hold the same FE file twice, e.g. rescanned into a second folder:
+        duplicate_archive = os.path.join(self.temp_dir, "258503010104.tar")
+        with tarfile.open(duplicate_archive, "w") as tar:
+            for folder in ["scan_1", "scan_2"]:
+                tar.add(fe_files[0], arcname=folder + "/" + os.path.basename(fe_files[0]))
+        self.assertEqual(len(import_data([duplicate_archive], ["A_16_P02153618"])), 4)
+        self.assertEqual(locate_fe_file(self.temp_dir, "258503010103_S01_Guys121919_CGH_1100_Jul11_2_2_4.txt"),
+                         archive)
+
+    def test_import_data_parallel_order(self):
+        """Test that parallel import returns the same rows, in the same order, as a serial import"""
+        fe_files = self.write_fe_files("258503010103", [1, 2, 3, 4])
+        serial_df = import_data(fe_files, ["A_16_P02153618"], jobs=1)
+        parallel_df = import_data(fe_files, ["A_16_P02153618"], jobs=3)
+        self.assertEqual(list(serial_df['FE_filename']), [f for f in fe_files for _ in range(2)])
+        self.assertTrue(serial_df.equals(parallel_df))
+        with self.assertRaisesRegex(ValueError, "No FE files"):
+            import_data([], ["A_16_P02153618"])
+
+    def test_profile_import_data(self):
+        """Test that an enabled profiler records each FE file parsed, including files parsed by worker processes"""
+        fe_files = self.write_fe_files("258503010103", [1, 2])
+        disabled = Profiler()
+        with disabled.stage("import_data"):
+            import_data(fe_files, ["A_16_P02153618"], profiler=disabled)
+        self.assertEqual((disabled.stages, disabled.files), ([], []))
+        profiler = Profiler(enabled=True)
+        with profiler.stage("import_data") as stage:
+            df = import_data(fe_files, ["A_16_P02153618"], jobs=2, profiler=profiler)
+            stage['rows'] = len(df)
+        self.assertEqual([record['stage'] for record in profiler.stages], ["import_data"])
+        self.assertEqual(profiler.stages[0]['rows'], 4)
+        self.assertEqual([metrics['file'] for metrics in profiler.files], fe_files)
+        self.assertEqual([metrics['rows_matched'] for metrics in profiler.files], [2, 2])
+        self.assertEqual(profiler.files[0]['bytes_read'], os.path.getsize(fe_files[0]))
+        # Files are labelled with their slide barcode and subarray:
+        self.assertIn("258503010103_2_1_2", profiler.summary_table())
+        profile = json.load(open(profiler.write(self.temp_dir)))
+        self.assertEqual(len(profile['files']), 2)
+
+    def test_fe_file_cache(self):
+        """Test that cached rows are reused and that changing the file or probe list invalidates the entry"""
+        cache_dir = os.path.join(self.temp_dir, "cache")
+        fe_file = self.write_fe_files("258503010103", [3])[0]
+        probes = ["A_16_P02153618"]
+        miss_stats, hit_stats = {}, {}
+        parsed_df = parse_data_file(fe_file, probes, cache_dir=cache_dir, stats=miss_stats)
+        self.assertIsNotNone(load_cached_columns(cache_dir, cache_key(fe_file, probes)))
+        self.assertTrue(parsed_df.equals(parse_data_file(fe_file, probes, cache_dir=cache_dir, stats=hit_stats)))
+        # A cache hit reads the start of the FE file, to find its key, and the cache entry rather than the whole file:
+        signature_bytes = min(os.path.getsize(fe_file), SIGNATURE_BYTES)
+        self.assertEqual((miss_stats['cache_hit'], hit_stats['cache_hit']), (False, True))
+        self.assertEqual(miss_stats['bytes_read'], signature_bytes + os.path.getsize(fe_file))
+        self.assertEqual(hit_stats['bytes_read'],
+                         signature_bytes + os.path.getsize(cache_file_path(cache_dir, cache_key(fe_file, probes))))
+        self.assertIsNone(load_cached_columns(cache_dir, cache_key(fe_file, probes + ["A_14_P000000"])))
+        with open(fe_file, "w") as f:
+            f.write(FE_FILE_TEMPLATE.replace("\t1\t0\n", "\t0\t0\n"))
+        self.assertIsNone(load_cached_columns(cache_dir, cache_key(fe_file, probes)))
+        self.assertEqual(list(parse_data_file(fe_file, probes, cache_dir=cache_dir)['gIsSaturated']), [0, 0])
+        # Both entries are removed once the cache is limited to zero bytes:
+        self.assertEqual(evict_cache(cache_dir, max_megabytes=0), 2)
+
+
+class ReplicateAnalysisTest(TempDirTestCase):
+    """Tests for replicate consensus, signal baselines and the reports rendered from them."""
+
+    def test_replicate_consensus(self):
+        """Test that probe calls, discordant replicates and bitmasks are derived from the saturation flags"""
+        probes = ["A_16_P02153618", "A_16_P16375641", "A_16_P18442814"]
+        df = pandas.DataFrame({
+            'FE_filename': ["s1"] * 6 + ["s2"] * 3,
+            'ProbeName': [probes[0]] * 3 + [probes[2]] * 3 + [probes[1]] * 3,
+            'gIsSaturated': [1, 1, 1, 1, 0, 1, 0, 0, 0],
+            'rIsSaturated': [0, 0, 0, 0, 0, 1, 1, 1, 1]})
+        consensus = replicate_consensus(df, probes)
+        self.assertEqual(consensus.samples, ["s1", "s2"])
+        self.assertEqual(consensus.saturation.shape, (2, 3, 3, 2))
+        self.assertEqual(consensus.counts[0, :, 0].tolist(), [3, 0, 2])
+        self.assertEqual(consensus.discordant[0].tolist(), [[False, False], [False, False], [True, True]])
+        # s1 green: probes 0 and 2 present, s1 red: none (1 of 3 replicates), s2 red: probe 1
+        self.assertEqual(consensus.bitmask.tolist(), [[5, 0], [0, 2]])
+        summarised_df = summarise_array_replicates(df, probes)
+        self.assertEqual(summarised_df.loc[probes[2], ('gIsSaturated', 's1')], 2)
+        self.assertEqual(summarised_df.loc[probes[1], ('rIsSaturated', 's2')], 3)
+
+    def test_signal_baseline(self):
+        """Test that a baseline updated run by run matches the statistics of all runs together, and that a raised but
+        unsaturated signal scores above the threshold, including in the first run scored"""
+        random_state = np.random.RandomState(0)
+        runs = [random_state.normal(8, 0.5, (30, 2, 2)) for _ in range(3)]
+        baseline = empty_baseline(["P0", "P1"])
+        for values in runs:
+            baseline = update_baseline(baseline, values, np.ones(values.shape, dtype=bool))
+        history = np.concatenate(runs)
+        self.assertTrue((baseline.count == 90).all())
+        self.assertTrue(np.allclose(baseline.mean, history.mean(axis=0)))
+        self.assertTrue(np.allclose(baseline.m2 / (baseline.count - 1), history.var(axis=0, ddof=1)))
+        values = random_state.normal(8, 0.5, (4, 2, 2))
+        values[1, 0, 1] = 12.0  # Weak contamination, 1/8 of saturation
+        scores = score_signals(baseline, values)
+        self.assertEqual(list(zip(*np.nonzero(scores >= 4))), [(1, 0, 1)])
+        self.assertEqual(calls_to_bitmask(scores >= 4).tolist(), [[0, 0], [0, 1], [0, 0], [0, 0]])
+        self.assertEqual(bitmask_to_calls(calls_to_bitmask(scores >= 4), 2).tolist(), (scores >= 4).tolist())
+        baseline_file = write_baseline(baseline, os.path.join(self.temp_dir, "baseline.csv"))
+        saved = read_baseline(baseline_file, ["P1", "P0", "P2"])
+        self.assertTrue(np.allclose(saved.mean[:2], baseline.mean[::-1]))
+        self.assertEqual(saved.count[2].tolist(), [0, 0])
+        # Samples merged into the baseline are recorded by slide, so a run analysed again is not merged twice:
+        samples = ["258503010103_2_1_1", "258503010103_2_1_2", "258503010104_2_1_1", "s3"]
+        self.assertEqual(read_merged_samples(baseline_file, samples), set())
+        record_merged_samples(baseline_file, samples[:3])
+        self.assertEqual(read_merged_samples(baseline_file, samples), set(samples[:3]))
+        self.assertEqual(read_merged_samples(baseline_file, ["258503010103_2_1_3"]), set())
+        self.assertEqual(len(os.listdir(baseline_file + ".merged")), 2)
+        # With no history, several contaminated values in one run are scored against the rest of the run:
+        values = random_state.normal(8, 0.5, (48, 2, 2))
+        values[[2, 9, 17], 1, 0] = 11.0
+        scores = score_signals(empty_baseline(["P0", "P1"]), values)
+        self.assertEqual(list(zip(*np.nonzero(scores >= 4))), [(2, 1, 0), (9, 1, 0), (17, 1, 0)])
+
+    def test_render_reports_from_logs(self):
+        """Test that plots are rendered from the saved summary logs"""
+        df = pandas.DataFrame({'FE_filename': ["s1"] * 3 + ["s2"] * 3, 'ProbeName': ["P0", "P0", "P1"] * 2,
+                               'gIsSaturated': [1, 1, 0, 1, 1, 0], 'rIsSaturated': [0] * 6,
+                               'gMedianSignal': [65527., 65000., 80., 65527., 64000., 95.],
+                               'rMedianSignal': [70., 75., 60., 72., 71., 66.]})
+        signal_df = summarise_signals(df)
+        self.assertEqual(signal_df.loc["P0", ('gMedianSignal', 'min')], 64000.)
+        self.assertEqual(signal_df.loc["P1", ('rMedianSignal', 'max')], 66.)
+        summary_log = write_log(summarise_array_replicates(df, ["P0", "P1"]), "summary", self.temp_dir)
+        signals_log = write_log(signal_df, "signal_summary", self.temp_dir)
+        self.assertTrue(read_log(signals_log).equals(signal_df))
+        render_reports(summary_log, signals_log, self.temp_dir)
+        self.assertTrue(os.path.exists(os.path.join(self.temp_dir, "results_heatmap.png")))
+        self.assertTrue(os.path.exists(os.path.join(self.temp_dir, "results_plot.pdf")))
+
+
+class SampleIdentityTest(TempDirTestCase):
+    """Tests for spike in trio layouts and sample identity checks."""
+
+    def test_check_sample_identity(self):
+        """Test that the trios detected in each channel are decoded to wells assigned to that channel and mismatches,
+        partial, excess and missing detections flagged"""
+        probes = ["P%d" % i for i in range(6)]
+        trios = [("P0", "P1", "P2"), ("P0", "P3", "P4"), ("P1", "P3", "P5"), ("P2", "P4", "P5")]
+        index = build_trio_index(probes, trios, "B")
+        self.assertEqual(index.wells, ["A1", "B1", "C1", "D1"])
+        # Set B uses the first half of the trios for the green channel:
+        self.assertEqual(index.channels, ["g", "g", "r", "r"])
+        self.assertEqual(decode_trio(index, probes_to_bitmask(("P1", "P3", "P5"), probes), "r"), 2)
+        self.assertIsNone(decode_trio(index, probes_to_bitmask(("P1", "P3", "P5"), probes), "g"))
+        self.assertEqual(nearest_trios(index, probes_to_bitmask(("P0",), probes), "g"), (2, [0, 1]))
+        self.assertEqual(nearest_trios(index, probes_to_bitmask(("P0",), probes), "r"), (4, [2, 3]))
+        expected_df = pandas.DataFrame({'Sample': ["s1"] * 3 + ["s2"] * 3,
+                                        'ProbeName': ["P0", "P1", "P2", "P1", "P3", "P5"],
+                                        'gSpike': [1, 1, 1, 0, 0, 0],
+                                        'rSpike': [0, 0, 0, 1, 1, 1]})
+        expected = expected_bitmasks(expected_df, ["s1", "s2", "s3"], probes)
+        self.assertEqual(expected[:, 0].tolist(), [7, 0, -1])
+        detected = np.array([[7, 0b101010], [0b11111, 0b1010], [0b110100, 0]])
+        identity_df = check_sample_identity(index, ["s1", "s2", "s3"], detected, expected)
+        self.assertEqual(list(identity_df['Status']),
+                         [PASS, MISMATCH, CONTAMINATION, PARTIAL_MATCH, MISMATCH, NOT_DETECTED])
+        self.assertEqual(identity_df.loc[1, 'DetectedWell'], "C1")
+        self.assertEqual(identity_df.loc[3, 'NearestWells'], "C1")
+        # Panels too large for a lookup table are decoded directly, with the same result:
+        large_probes = probes + ["P%d" % i for i in range(6, MAX_TABLE_PROBES + 1)]
+        large_index = build_trio_index(large_probes, trios, "B")
+        self.assertIsNone(large_index.nearest_distance)
+        self.assertTrue(identity_df.equals(check_sample_identity(large_index, ["s1", "s2", "s3"], detected, expected)))
+        # With set A the channels are swapped, so the red trios detected no longer decode to red wells:
+        set_a_df = check_sample_identity(build_trio_index(probes, trios, "A"), ["s1", "s2", "s3"], detected, expected)
+        self.assertEqual(list(set_a_df['Status']), [PASS, MISMATCH, CONTAMINATION, MISMATCH, MISMATCH, NOT_DETECTED])
+        self.assertEqual(set_a_df.loc[1, 'DetectedWell'], "")
+        # Samples with no spike in probe rows are reported as missing:
+        aligned = align_bitmasks(detected[:2], ["s1", "s2"], ["s1", "s2", "s3"])
+        self.assertEqual(aligned[2].tolist(), [-1, -1])
+        missing_df = check_sample_identity(index, ["s1", "s2", "s3"], aligned, expected)
+        self.assertEqual(list(missing_df['Status'])[4:], [MISSING, MISSING])
+        self.assertEqual(list(missing_df['DetectedProbes'])[4:], ["", ""])
+
+    def test_missing_fe_files_fail_qc(self):
+        """Test that the QC step fails when a sample on the sample sheet has no FE file"""
+        probes = parse_config_file()
+        template = generate_test_files.build_synthetic_template(probes, num_features=2000, seed=1)
+        layout = generate_test_files.plate_layout(probes, half_plate=True)
+        fe_files, expected_df, _ = generate_test_files.generate_test_files(template, self.temp_dir, layout, {}, seed=1)
+        expected_file = os.path.join(self.temp_dir, "expected_spike_ins.csv")
+        expected_df.to_csv(expected_file, index=False)
+        settings = ['-spike_in_info', expected_file, '-plots', 'none', '-no_cache']
+        output_dir = os.path.join(self.temp_dir, "all_files")
+        self.assertTrue(array_spiker.main(['-file'] + fe_files + ['-output_dir', output_dir] + settings))
+        output_dir = os.path.join(self.temp_dir, "some_files")
+        self.assertFalse(array_spiker.main(['-file'] + fe_files[:9] + ['-output_dir', output_dir] + settings))
+        identity_df = pandas.read_csv(find_log(output_dir, "qc_results"), index_col=0)
+        self.assertEqual(len(identity_df), 2 * len(fe_files))
+        self.assertEqual((identity_df['Status'] == MISSING).sum(), 2 * (len(fe_files) - 9))
+
+    def test_num_spiked_probes_combinations(self):
+        """Test that the closed form count matches the number of combinations generated"""
+        probes = ["P%d" % i for i in range(12)]
+        self.assertEqual(num_spiked_probes_combinations(probes[:10]), 120)
+        self.assertEqual(num_spiked_probes_combinations(probes), len(calculate_spiked_probes_combinations(probes)))
+        self.assertEqual(num_spiked_probes_combinations(probes[:2]), 0)
+
+    def test_design_trio_layout(self):
+        """Test that a designed layout has unique, well separated trios and converts to an expected spike in profile"""
+        probes = ["P%d" % i for i in range(30)]
+        trios = design_trio_layout(probes, seed=1, restarts=2)
+        self.assertEqual(len(set(trios)), 96)
+        # 30 probes allow trios to share at most one probe:
+        self.assertEqual(layout_min_distance([probes_to_bitmask(trio, probes) for trio in trios]), 4)
+        expected_df = layout_to_expected_spike_ins(trios, probes, "B")
+        self.assertEqual(len(expected_df), 48 * 30)
+        first_sample_df = expected_df[expected_df['Sample'] == "1"]
+        self.assertEqual(set(first_sample_df['ProbeName'][first_sample_df['gSpike'] == 1]), set(trios[0]))
+        self.assertEqual(set(first_sample_df['ProbeName'][first_sample_df['rSpike'] == 1]), set(trios[48]))
+
+
+class MokaTest(TempDirTestCase):
+    """Tests for reading from and writing to MOKA."""
+
+    def test_moka_run_records(self):
+        """Test bulk reads from, and batched writes to, a local SQLite copy of the MOKA schema"""
+        engine = get_engine("sqlite:///%s" % os.path.join(self.temp_dir, "moka.db"))
+        self.assertIs(engine, get_engine("sqlite:///%s" % os.path.join(self.temp_dir, "moka.db")))
+        create_moka_schema(engine)
+        with engine.begin() as connection:
+            connection.execute(ArrayLabelling.insert(), [
+                {'ArrayLabellingID': 1, 'RunID': 10, 'ArrayID': "258503010103", 'Subarray': 3},
+                {'ArrayLabellingID': 2, 'RunID': 11, 'ArrayID': "258503010104", 'Subarray': 1}])
+            connection.execute(ArrayLabelledDNA.insert(), [
+                {'ArrayLabellingID': 1, 'DNANumber': "D1", 'Channel': "g", 'Code': "P0;P1;P2"},
+                {'ArrayLabellingID': 1, 'DNANumber': "D2", 'Channel': "r", 'Code': "P1;P3;P4"},
+                {'ArrayLabellingID': 2, 'DNANumber': "D3", 'Channel': "g", 'Code': "P2;P3;P4"}])
+        records = get_run_records(10, engine)
+        self.assertEqual(len(records), 2)
+        fe_file_name = "258503010103_S01_Guys121919_CGH_1100_Jul11_2_1_3.txt"
+        self.assertEqual(get_fe_file_name(10, records=records), {1: fe_file_name})
+        self.assertEqual(get_well_ids(10, records=records)[(fe_file_name, "r")], ("P1", "P3", "P4"))
+        expected = get_expected_spike_ins(10, ["P0", "P1", "P5"], records=records)
+        self.assertEqual([(row['gSpike'], row['rSpike']) for row in expected], [(1, 0), (1, 1), (0, 0)])
+        self.assertEqual(write_results_to_moka([{'ArrayLabellingID': 1, 'passed': True, 'result': "PASS"}],
+                                               engine), 1)
+        with engine.connect() as connection:
+            rows = list(connection.execute(ArrayLabelling.select().order_by(ArrayLabelling.c.ArrayLabellingID)))
+        self.assertEqual([(row[4], row[5], row[6]) for row in rows], [(True, True, "PASS"), (None, None, None)])
+        engine.dispose()
+
+    def test_moka_names(self):
+        """Test that MOKA table and column names are read from mokaSchema in config.yaml, defaulting to the names used
+        in moka_helpers.py"""
+        schema = load_config()['mokaSchema']
+        self.assertEqual(ArrayLabelling.name, schema['ArrayLabelling']['table'])
+        self.assertEqual(ArrayLabelling.c.SpikeInQCPassed.name, schema['ArrayLabelling']['SpikeInQCPassed'])
+        self.assertEqual(ArrayLabelledDNA.c.Code.name, schema['ArrayLabelledDNA']['Code'])
+        self.assertEqual(moka_name('ArrayLabelling', 'NotInSchema'), 'NotInSchema')
+        self.assertEqual(moka_name('NotInSchema'), 'NotInSchema')
+
+
+class BatchSpikerTest(TempDirTestCase):
+    """Tests for batch_spiker.py."""
+
+    def test_batch_resume(self):
+        """Test that a batch analyses each run in a directory tree, orders FE files by slide and subarray, and that a
+        restarted batch only analyses runs which are not finished"""
+        input_dir = os.path.join(self.temp_dir, "runs")
+        for run, barcodes in (("2017/run_1", ["258503010104", "258503010103"]), ("2017/run_2", ["258503010105"])):
+            os.makedirs(os.path.join(input_dir, run))
+            for barcode in barcodes:
+                self.write_fe_files(barcode, [5, 2], os.path.join(input_dir, run))
+        runs = discover_runs(input_dir)
+        self.assertEqual(list(runs), ["2017/run_1", "2017/run_2"])
+        self.assertEqual([make_pretty_label(fe_file) for fe_file in runs["2017/run_1"]['files']],
+                         ["258503010103_2_1_2", "258503010103_2_2_1", "258503010104_2_1_2", "258503010104_2_2_1"])
+        output_dir = os.path.join(self.temp_dir, "output")
+        summary_df = batch_spiker.main(['-input_dir', input_dir, '-output_dir', output_dir, '-jobs', '2',
+                                        '-no_cache'])
+        self.assertEqual(list(summary_df['Files']), [4, 2])
+        self.assertEqual(list(summary_df['Slides']), [2, 1])
+        self.assertTrue(summary_df['Error'].isnull().all())
+        checkpoint_file = os.path.join(output_dir, "batch_checkpoint.jsonl")
+        with open(checkpoint_file, "a") as f:
+            f.write('{"Run": "2017/ru')  # Interrupted while checkpointing
+        os.remove(os.path.join(input_dir, "2017/run_2", create_sample_filename("258503010105", 2)))
+        batch_spiker.main(['-input_dir', input_dir, '-output_dir', output_dir, '-jobs', '2', '-no_cache'])
+        # Only run_2, whose files changed, is analysed again:
+        with open(checkpoint_file) as f:
+            self.assertEqual(f.read().count('"Run": "2017/run_2"'), 2)
+        self.assertEqual(len(read_checkpoint(checkpoint_file)), 2)
+
+
+class WatchSpikerTest(TempDirTestCase):
+    """Tests for watch_spiker.py."""
+
+    def test_watch_run_state(self):
+        """Test that a polled FE file is reported once written, and a run is complete once all its FE files have
+        been parsed"""
+        watcher = PollingWatcher(self.temp_dir, interval=0, settle=0)
+        run = RunState("run", ["258503010103_2_1_3", "258503010103_2_1_4"], [])
+        for subarray in [3, 4]:
+            fe_file = self.write_fe_files("258503010103", [subarray])[0]
+            self.assertEqual(watcher.poll(), [])  # First seen, may still be being written
+            self.assertEqual(watcher.poll(), [fe_file])
+            self.assertFalse(run.complete)
+            self.assertEqual(run.add(fe_file, parse_arrived_file(fe_file, ["A_16_P02153618"])),
+                             [make_pretty_label(fe_file)])
+        self.assertTrue(run.complete)
+        self.assertEqual(len(run.data_frame()), 4)
+        self.assertEqual(watcher.poll(), [])  # Each file is only reported once
+
+    def test_watch_partially_written_file(self):
+        """Test that a file closed before it has been completely written is not reported until it has settled, and
+        that a truncated FE file is not parsed"""
+        watcher = create_watcher(self.temp_dir, interval=0.05, settle=0.5)
+        fe_file = os.path.join(self.temp_dir, create_sample_filename("258503010103", 1))
+        cut = FE_FILE_TEMPLATE.index("\t65527")  # Part way through a spike in row
+        with open(fe_file, "w") as f:
+            f.write(FE_FILE_TEMPLATE[:cut])
+        self.assertEqual(watcher.poll(0.05), [])
+        self.assertIsNone(parse_arrived_file(fe_file, ["A_16_P02153618"]))
+        with open(fe_file, "a") as f:
+            f.write(FE_FILE_TEMPLATE[cut:])
+        completed = []
+        for _ in range(30):
+            completed += watcher.poll(0.05)
+        self.assertEqual(completed, [fe_file])
+        self.assertEqual(len(parse_arrived_file(fe_file, ["A_16_P02153618"])), 2)
+        watcher.close()
+
+
+class QCServiceTest(TempDirTestCase):
+    """Tests for qc_service.py."""
+
+    def test_qc_service(self):
+        """Test that the QC service returns the verdict for a run as JSON, only parsing FE files it has not already
+        parsed, and evicts the FE file cache it reads them through"""
+        import urllib.request
+        fe_files = self.write_fe_files("258503010103", [1, 2])
+        stale_entry = os.path.join(self.temp_dir, "stale.npz")
+        open(stale_entry, "w").close()
+        os.utime(stale_entry, (0, 0))
+        expected_file = os.path.join(self.temp_dir, "expected_spike_ins.csv")
+        pandas.DataFrame({'Sample': ["258503010103_2_1_1", "258503010103_2_1_2"], 'ProbeName': "A_16_P02153618",
+                          'gSpike': 1, 'rSpike': 0}).to_csv(expected_file, index=False)
+        service = QCService(os.path.join(self.temp_dir, "output"), workers=1, cache_dir=self.temp_dir)
+        server = qc_service.make_server(service, port=0)
+        threading.Thread(target=server.serve_forever).start()
+        try:
+            url = "http://127.0.0.1:%d/qc" % server.server_address[1]
+            for files_read in [2, 0]:
+                body = json.dumps({'files': fe_files, 'spike_in_info': expected_file}).encode('utf-8')
+                verdict = json.loads(urllib.request.urlopen(url, body).read().decode('utf-8'))
+                self.assertEqual(verdict['files_read'], files_read)
+                self.assertTrue(verdict['passed'])
+                self.assertEqual(verdict['failed_channels'], 0)
+                self.assertEqual(len(verdict['channels']), 4)
+            self.assertFalse(os.path.exists(stale_entry))
+            self.assertEqual(len([name for name in os.listdir(self.temp_dir) if name.endswith(".npz")]), 2)
+            with self.assertRaises(ValueError):
+                service.run_qc({'files': fe_files, 'plots': 'inline'})
+            # Names are made safe to use in the output directory:
+            verdict = service.run_qc({'files': fe_files, 'name': "../../run/1"})
+            self.assertEqual(os.path.dirname(verdict['output_dir']), os.path.join(self.temp_dir, "output"))
+            self.assertTrue(os.path.basename(verdict['output_dir']).startswith(".._.._run_1_"))
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class ResultsStoreTest(TempDirTestCase):
+    """Tests for the results store."""
+
+    @unittest.skipIf(pyarrow is None, "results store requires pyarrow")
+    def test_results_store(self):
+        """Test that runs appended to the results store are queried by probe, slide and date, the latest analysis of
+        each subarray replacing earlier ones"""
+        df = pandas.DataFrame({'FE_filename': ["258503010103_2_1_3"] * 3 + ["258503010104_2_2_1"] * 3,
+                               'ProbeName': ["P0", "P0", "P1"] * 2, 'gMedianSignal': [1., 2., 3., 4., 5., 6.]})
+        first = datetime.datetime(2018, 1, 10, 9, 0)
+        append_results(self.temp_dir, 'signals', signals_table(df, 5, first))
+        df['gMedianSignal'] *= 10
+        append_results(self.temp_dir, 'signals', signals_table(df, 5, first + datetime.timedelta(days=40)))
+        self.assertEqual(len(os.listdir(os.path.join(self.temp_dir, "signals"))), 2)  # One partition for each month
+        latest = query_store(self.temp_dir, 'signals', probes=["P0"], slides=["258503010103"])
+        self.assertEqual(list(latest['Subarray']), ["1_3", "1_3"])
+        self.assertEqual(list(latest['Replicate']), [0, 1])
+        self.assertEqual(list(latest['gMedianSignal']), [10., 20.])
+        self.assertEqual(len(query_store(self.temp_dir, 'signals', latest_only=False)), 12)
+        january = query_store(self.temp_dir, 'signals', end=datetime.date(2018, 1, 31), columns=['gMedianSignal'])
+        self.assertEqual(sorted(january['gMedianSignal']), [1., 2., 3., 4., 5., 6.])
+        self.assertTrue(query_store(self.temp_dir, 'calls').empty)
+
+    @unittest.skipIf(pyarrow is None, "results store requires pyarrow")
+    def test_signal_trend(self):
+        """Test that the monthly trend summarises the spiked and unspiked signals of each probe and channel separately,
+        and that -trend is rejected for the calls table before the store is queried"""
+        samples = ["258503010103_2_1_1", "258503010103_2_1_2"]
+        df = pandas.DataFrame({'FE_filename': [samples[0]] * 4 + [samples[1]] * 4,
+                               'ProbeName': ["P0", "P0", "P1", "P1"] * 2,
+                               'gMedianSignal': [100., 200., 5., 7., 9., 11., 300., 500.],
+                               'rMedianSignal': [1., 3., 400., 600., 2., 4., 6., 8.]})
+        calls = np.zeros((2, 2, 2), dtype=bool)
+        calls[1, 1, 0] = True  # P1 called in the green channel of the second sample, which is not on the sample sheet
+        flags = probe_flags(samples, ["P0", "P1"], calls, np.array([[1, 2], [-1, -1]]))
+        self.assertEqual(list(flags['gExpected'].isna()), [False, False, True, True])
+        append_results(self.temp_dir, 'signals', signals_table(df, 5, datetime.datetime(2018, 1, 10, 9, 0), flags))
+        trend_file = os.path.join(self.temp_dir, "trend.csv")
+        query_results.main(['-store_dir', self.temp_dir, '-trend', '-output', trend_file])
+        trend = pandas.read_csv(trend_file).set_index(['ProbeName', 'Channel', 'Spiked'])
+        self.assertEqual(trend['MedianSignal'].to_dict(),
+                         {("P0", "g", True): 150., ("P0", "g", False): 10., ("P0", "r", False): 2.5,
+                          ("P1", "g", True): 400., ("P1", "g", False): 6., ("P1", "r", True): 500.,
+                          ("P1", "r", False): 7.})
+        self.assertEqual(trend.loc[("P0", "r", False), 'Replicates'], 4)
+        with self.assertRaises(SystemExit):
+            query_results.main(['-store_dir', os.path.join(self.temp_dir, "missing"), '-table', 'calls', '-trend'])
+
+
+class GenerateTestFilesTest(TempDirTestCase):
+    """Tests for tests/generate_test_files.py."""
+
+    def test_generate_test_files(self):
+        """Test that a generated half plate parses back with the injected scenarios detected"""
+        probes = parse_config_file()
+        template = generate_test_files.build_synthetic_template(probes, num_features=2000, seed=1)
+        layout = generate_test_files.plate_layout(probes, half_plate=True)
+        fe_files, expected_df, scenarios_df = generate_test_files.generate_test_files(
+            template, self.temp_dir, layout, {'probe_failure': 1, 'contamination': 1}, seed=1)
+        self.assertEqual(len(fe_files), 24)
+        self.assertEqual(list(scenarios_df['Scenario']), ['probe_failure', 'contamination'])
+        df = import_data(fe_files, probes)
+        self.assertEqual(len(df), 24 * len(probes) * 3)
+        df['FE_filename'] = df['FE_filename'].apply(make_pretty_label)
+        consensus = replicate_consensus(df, probes)
+        identity_df = check_sample_identity(
+            build_trio_index(probes, calculate_spiked_probes_combinations(probes)[:96]), consensus.samples,
+            consensus.bitmask, expected_bitmasks(expected_df, consensus.samples, probes))
+        failed_df = identity_df[identity_df['Status'] != PASS]
+        self.assertEqual(sorted(zip(failed_df['Sample'], failed_df['Channel'])),
+                         sorted(zip(scenarios_df['Sample'], scenarios_df['Channel'])))
+
+    def test_generated_scenarios_cover_changed_samples(self):
+        """Test that every sample channel whose spike in profile was changed, including both samples of a switch, is
+        recorded in the injected scenarios"""
+        probes = parse_config_file()
+        template = generate_test_files.build_synthetic_template(probes, num_features=2000, seed=1)
+        layout = generate_test_files.plate_layout(probes, half_plate=True)
+        fe_files, expected_df, scenarios_df = generate_test_files.generate_test_files(
+            template, self.temp_dir, layout, {'switch': 2, 'probe_failure': 1, 'contamination': 1}, seed=3)
+        df = import_data(fe_files, probes)
+        df['FE_filename'] = df['FE_filename'].apply(make_pretty_label)
+        consensus = replicate_consensus(df, probes)
+        expected_masks = expected_bitmasks(expected_df, consensus.samples, probes)
+        changed = set((consensus.samples[s], "gr"[c]) for s, c in
+                      zip(*np.nonzero(consensus.bitmask != expected_masks)))
+        self.assertEqual(len(scenarios_df), 6)
+        self.assertTrue(changed <= set(zip(scenarios_df['Sample'], scenarios_df['Channel'])))
+        self.assertEqual(len(changed), 6)
+        # Each sample of a switch names the other:
+        switches = scenarios_df[scenarios_df['Scenario'] == 'switch']
+        self.assertEqual(sorted("with %s" % sample for sample in switches['Sample']), sorted(switches['Detail']))
 
 
 if __name__ == '__main__':
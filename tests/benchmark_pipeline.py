@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+
+"""
+Script benchmarks each stage of the arraySpiker pipeline on synthetic FE files (see generate_test_files.py) for runs of
+increasing size. Each stage is timed separately and its peak Python memory allocation measured with tracemalloc.
+Results are saved as JSON and can be compared to a saved baseline, the script exiting with an error if any stage is
+slower than the baseline by more than the given tolerance.
+"""
+
+from __future__ import print_function
+import argparse
+import glob
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+# Helper modules are in the repository root, one level above this script:
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+try:
+    import tracemalloc
+except ImportError:  # Python 2
+    tracemalloc = None
+
+from analysis_helpers import (calculate_spiked_probes_combinations, heatmap_spike_ins, import_data, make_pretty_label,
+                              parse_config_file, parse_data_file, plot_values, replicate_consensus,
+                              summarise_array_replicates, summarise_signals, write_log)
+from trio_helpers import PLATE_WELLS, build_trio_index, check_sample_identity, expected_bitmasks
+import generate_test_files
+import pandas
+
+STAGES = ['parse_data_file', 'import_data', 'summarise_array_replicates', 'compare_expected_detected', 'write_log',
+          'heatmap_spike_ins', 'plot_values']
+
+FILES_PER_PLATE = 48
+
+
+def build_corpus(corpus_dir, num_files, spike_in_probes, num_features, seed=0):
+    """Generate (or reuse) enough plates of synthetic FE files in corpus_dir for num_files files. Returns the FE files
+    and the expected spike in profile for them."""
+    num_plates = int(math.ceil(num_files / float(FILES_PER_PLATE)))
+    layout = generate_test_files.plate_layout(spike_in_probes)
+    template = None
+    fe_files, expected_dfs = [], []
+    for plate in range(num_plates):
+        plate_dir = os.path.join(corpus_dir, "plate_%d" % (plate + 1))
+        expected_file = os.path.join(plate_dir, "expected_spike_ins.csv")
+        if not os.path.exists(expected_file):
+            if template is None:
+                template = generate_test_files.build_synthetic_template(spike_in_probes, num_features, seed=seed)
+            if not os.path.exists(plate_dir):
+                os.makedirs(plate_dir)
+            _, expected_df, _ = generate_test_files.generate_test_files(
+                template, plate_dir, layout, first_barcode=258503010101 + plate * 10, seed=seed + plate)
+            expected_df.to_csv(expected_file, index=False)
+        fe_files.extend(sorted(glob.glob(os.path.join(plate_dir, "*.txt"))))
+        expected_dfs.append(pandas.read_csv(expected_file, dtype={'Sample': str}))
+    return fe_files[:num_files], pandas.concat(expected_dfs, ignore_index=True)
+
+
+def measure(stage_function, measure_memory=True):
+    """Run a stage, returning its result, wall time and (if measure_memory) the peak memory allocated in MB. Memory
+    is measured on a second run so that tracing does not slow down the timed run."""
+    start = time.time()
+    result = stage_function()
+    seconds = time.time() - start
+    peak_mb = None
+    if measure_memory and tracemalloc is not None:
+        tracemalloc.start()
+        stage_function()
+        peak_mb = tracemalloc.get_traced_memory()[1] / 1024.0 / 1024.0
+        tracemalloc.stop()
+    return result, seconds, peak_mb
+
+
+def benchmark_run(fe_files, expected_df, spike_in_probes, output_dir, jobs, measure_memory):
+    """Benchmark each pipeline stage for one set of FE files. Returns dictionary of stage -> measurements"""
+    results = {}
+
+    def record(stage, stage_function):
+        result, seconds, peak_mb = measure(stage_function, measure_memory)
+        results[stage] = {'seconds': round(seconds, 4), 'peak_mb': None if peak_mb is None else round(peak_mb, 2)}
+        return result
+
+    record('parse_data_file', lambda: [parse_data_file(fe_file, spike_in_probes) for fe_file in fe_files])
+    df = record('import_data', lambda: import_data(fe_files, spike_in_probes, jobs=jobs))
+    df['FE_filename'] = df['FE_filename'].apply(make_pretty_label)
+    summarised_df = record('summarise_array_replicates', lambda: summarise_array_replicates(df, spike_in_probes))
+    trio_index = build_trio_index(spike_in_probes, calculate_spiked_probes_combinations(spike_in_probes)[
+                                                   :len(PLATE_WELLS)])
+
+    def compare_expected_detected():
+        consensus = replicate_consensus(df, spike_in_probes)
+        return check_sample_identity(trio_index, consensus.samples, consensus.bitmask,
+                                     expected_bitmasks(expected_df, consensus.samples, spike_in_probes))
+    record('compare_expected_detected', compare_expected_detected)
+    record('write_log', lambda: (write_log(df, "verbose_results", output_dir),
+                                 write_log(summarised_df, "summary", output_dir)))
+    record('heatmap_spike_ins', lambda: heatmap_spike_ins(summarised_df, "results_heatmap", output_dir))
+    record('plot_values', lambda: plot_values(summarise_signals(df), "results_plot.pdf", output_dir))
+    return results
+
+
+def find_regressions(results, baseline, tolerance, min_seconds):
+    """Return a list of (size, stage, seconds, baseline seconds) for stages slower than the baseline by more than
+    tolerance (a fraction) and min_seconds"""
+    regressions = []
+    for size, stages in sorted(results['runs'].items(), key=lambda item: int(item[0])):
+        for stage in STAGES:
+            try:
+                baseline_seconds = baseline['runs'][size][stage]['seconds']
+            except KeyError:
+                continue  # Size or stage not in baseline
+            seconds = stages[stage]['seconds']
+            if seconds > baseline_seconds * (1 + tolerance) and seconds - baseline_seconds > min_seconds:
+                regressions.append((size, stage, seconds, baseline_seconds))
+    return regressions
+
+
+def get_arguments(argv=None):
+    """Import Arguments from command line"""
+    parser = argparse.ArgumentParser(description='Benchmark the stages of the arraySpiker pipeline')
+    parser.add_argument('-sizes', type=int, nargs='+', default=[1, 8, 96, 384],
+                        help='Numbers of FE files to benchmark (default 1 8 96 384)')
+    parser.add_argument('-corpus_dir', type=str,
+                        help='Directory holding (or to generate) the synthetic FE files. Reused between benchmarks. '
+                             'Defaults to a temporary directory which is removed afterwards')
+    parser.add_argument('-features', type=int, default=generate_test_files.NUM_FEATURES,
+                        help='Number of features in each synthetic FE file (default %d)' %
+                             generate_test_files.NUM_FEATURES)
+    parser.add_argument('-jobs', '-j', type=int, default=1, help='Worker processes used by import_data (default 1)')
+    parser.add_argument('-no_memory', action='store_true', help='Only measure wall time')
+    parser.add_argument('-output', '-o', type=str, help='JSON file the results are saved to')
+    parser.add_argument('-baseline', '-b', type=str, help='JSON results of an earlier benchmark to compare against')
+    parser.add_argument('-tolerance', type=float, default=0.25,
+                        help='Fractional slow down allowed relative to the baseline (default 0.25)')
+    parser.add_argument('-min_seconds', type=float, default=0.05,
+                        help='Slow downs smaller than this are ignored as noise (default 0.05)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = get_arguments(argv)
+    spike_in_probes = parse_config_file(os.path.join(REPO_DIR, "config.yaml"))
+    corpus_dir = args.corpus_dir or tempfile.mkdtemp()
+    output_dir = tempfile.mkdtemp()
+    results = {'python': sys.version.split()[0], 'features': args.features, 'jobs': args.jobs, 'runs': {}}
+    try:
+        for size in args.sizes:
+            fe_files, expected_df = build_corpus(corpus_dir, size, spike_in_probes, args.features)
+            print("Benchmarking %d FE files" % size)
+            results['runs'][str(size)] = benchmark_run(fe_files, expected_df, spike_in_probes, output_dir,
+                                                       args.jobs, not args.no_memory)
+    finally:
+        shutil.rmtree(output_dir)
+        if args.corpus_dir is None:
+            shutil.rmtree(corpus_dir)
+
+    print("%-28s" % "Stage" + "".join("%18s" % ("%s files" % size) for size in args.sizes))
+    for stage in STAGES:
+        cells = []
+        for size in args.sizes:
+            result = results['runs'][str(size)][stage]
+            memory = "" if result['peak_mb'] is None else " %6.1fMB" % result['peak_mb']
+            cells.append("%18s" % ("%.3fs%s" % (result['seconds'], memory)))
+        print("%-28s" % stage + "".join(cells))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Results saved in: %s" % args.output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = find_regressions(results, baseline, args.tolerance, args.min_seconds)
+        for size, stage, seconds, baseline_seconds in regressions:
+            print("REGRESSION: %s with %s files took %.3fs, baseline %.3fs" % (stage, size, seconds,
+                                                                                baseline_seconds))
+        if regressions:
+            sys.exit(1)
+        print("No stage slower than baseline by more than %d%%" % (args.tolerance * 100))
+
+
+if __name__ == '__main__':
+    main()
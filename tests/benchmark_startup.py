@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+"""
+Script measures the cold start time of the arraySpiker command line entry points and helper modules. Each is run in a
+fresh Python process several times and the minimum and median wall times recorded, along with which of the slow to
+import modules (pandas, matplotlib, seaborn, sqlalchemy ...) were loaded. Results are saved as JSON so cold start can
+be tracked as the tool grows, and the script exits with an error if an entry point exceeds -max_seconds.
+"""
+
+from __future__ import print_function
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Entry points are timed answering -h, which should not require any analysis modules:
+ENTRY_POINTS = ["array_spiker.py", "batch_spiker.py", "design_spike_ins.py", "query_results.py", "render_reports.py",
+                "qc_service.py", "watch_spiker.py"]
+
+HELPER_MODULES = ["analysis_helpers", "archive_helpers", "baseline_helpers", "batch_helpers", "cache_helpers",
+                  "moka_helpers", "naming_helpers", "profiling_helpers", "service_helpers", "store_helpers",
+                  "trio_helpers", "watch_helpers"]
+
+HEAVY_MODULES = ["numpy", "pandas", "yaml", "matplotlib", "matplotlib.pyplot", "seaborn", "sqlalchemy", "pyarrow"]
+
+# Run in the child process: execute the code under test then report which heavy modules were imported
+REPORT_MODULES = "import json, sys; print(json.dumps([m for m in %r if m in sys.modules]))" % HEAVY_MODULES
+RUN_ENTRY_POINT = ("import runpy, sys\n"
+                   "sys.argv = [%r, '-h']\n"
+                   "stdout, sys.stdout = sys.stdout, open('%s', 'w')\n"
+                   "try:\n"
+                   "    runpy.run_path(sys.argv[0], run_name='__main__')\n"
+                   "except SystemExit:\n"
+                   "    pass\n"
+                   "sys.stdout = stdout\n" + REPORT_MODULES)
+
+
+def time_python(code, repeats):
+    """Run code in a new Python process repeats times. Returns the wall time of each run and the heavy modules
+    loaded"""
+    timings = []
+    loaded = []
+    for _ in range(repeats):
+        start = time.time()
+        output = subprocess.check_output([sys.executable, "-c", code], cwd=REPO_DIR)
+        timings.append(time.time() - start)
+        loaded = json.loads(output.decode().strip().splitlines()[-1])
+    return timings, loaded
+
+
+def summarise(timings):
+    timings = sorted(timings)
+    return {'min_seconds': round(timings[0], 4), 'median_seconds': round(timings[len(timings) // 2], 4)}
+
+
+def get_arguments(argv=None):
+    """Import Arguments from command line"""
+    parser = argparse.ArgumentParser(description='Measure cold start time of arraySpiker entry points')
+    parser.add_argument('-output', '-o',
+                        type=str,
+                        help='JSON file the results are saved to',
+                        required=False)
+    parser.add_argument('-repeats', '-n',
+                        type=int,
+                        default=5,
+                        help='Number of times each entry point is started',
+                        required=False)
+    parser.add_argument('-max_seconds',
+                        type=float,
+                        help='Fail if the median start time of any entry point exceeds this',
+                        required=False)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = get_arguments(argv)
+    baseline_timings, _ = time_python("pass\n" + REPORT_MODULES, args.repeats)
+    results = {'python': sys.version.split()[0], 'interpreter': summarise(baseline_timings),
+               'entry_points': {}, 'modules': {}}
+    for entry_point in ENTRY_POINTS:
+        timings, loaded = time_python(RUN_ENTRY_POINT % (entry_point, os.devnull), args.repeats)
+        results['entry_points'][entry_point] = dict(summarise(timings), modules_loaded=loaded)
+    for module in HELPER_MODULES:
+        timings, loaded = time_python("import %s\n" % module + REPORT_MODULES, args.repeats)
+        results['modules'][module] = dict(summarise(timings), modules_loaded=loaded)
+
+    print("%-22s %10s %10s  %s" % ("", "min (s)", "median (s)", "heavy modules loaded"))
+    for group in ('entry_points', 'modules'):
+        for name, result in sorted(results[group].items()):
+            print("%-22s %10.3f %10.3f  %s" % (name, result['min_seconds'], result['median_seconds'],
+                                               ", ".join(result['modules_loaded'])))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print("Results saved in: %s" % args.output)
+
+    if args.max_seconds is not None:
+        slow = [name for name, result in results['entry_points'].items()
+                if result['median_seconds'] > args.max_seconds]
+        if slow:
+            print("ERROR: Start up time exceeds %.2f seconds for %s" % (args.max_seconds, ", ".join(sorted(slow))))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
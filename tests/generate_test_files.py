@@ -1,33 +1,84 @@
 #!/usr/bin/env python
 
 """
-Script generates simulated test files for use in development. Given a single feature extraction file
-and list of spike in probes it generates an in silico test set of files simulating expected data, including
-instances where multiple probes fail.
+Script generates simulated test files for use in development. Given a single feature extraction file (or a synthetic
+full size template) and list of spike in probes it generates an in silico test set of files simulating expected data
+for whole plates, including instances where replicates or whole probes fail and where samples are cross-contaminated
+or switched.
 """
 
+from __future__ import print_function
 import argparse
-from analysis_helpers import *
+import collections
+import os
+import sys
+import numpy as np
+import pandas
+
+# Helper modules are in the repository root, one level above this script:
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 '''This script uses a template to generate test files for arraySpiker so that a range of scenarios and edge cases
 can be tested'''
 
-"""Import Arguments from command line"""
-parser = argparse.ArgumentParser(
-    description='Generate test data FE files for testing array_spiker.py')
-parser.add_argument('-file', '-f', type=str, help='Import template file containing outline Feature Extraction data')
-parser.add_argument('-output_dir', '-o', type=str, help='File path to output directory')
-parser.add_argument('-create_template', action='store_true', help='Create template file from given FE file')
+# Number of features on an Agilent 180K CGH array:
+NUM_FEATURES = 180880
+
+# Columns of the FEATURES table of a synthetic FE file, with the type written on the TYPE line above the header:
+FE_COLUMNS = [
+    ('FeatureNum', 'integer'), ('Row', 'integer'), ('Col', 'integer'), ('SubTypeMask', 'integer'),
+    ('ControlType', 'integer'), ('ProbeName', 'text'), ('SystematicName', 'text'), ('PositionX', 'float'),
+    ('PositionY', 'float'), ('LogRatio', 'float'), ('LogRatioError', 'float'), ('PValueLogRatio', 'float'),
+    ('gProcessedSignal', 'float'), ('rProcessedSignal', 'float'), ('gProcessedSigError', 'float'),
+    ('rProcessedSigError', 'float'), ('gMedianSignal', 'float'), ('rMedianSignal', 'float'),
+    ('gBGMedianSignal', 'float'), ('rBGMedianSignal', 'float'), ('gBGPixSDev', 'float'), ('rBGPixSDev', 'float'),
+    ('gIsSaturated', 'boolean'), ('rIsSaturated', 'boolean'), ('gIsFeatNonUnifOL', 'boolean'),
+    ('rIsFeatNonUnifOL', 'boolean'), ('gIsBGNonUnifOL', 'boolean'), ('rIsBGNonUnifOL', 'boolean'),
+    ('gIsFeatPopnOL', 'boolean'), ('rIsFeatPopnOL', 'boolean'), ('gIsBGPopnOL', 'boolean'),
+    ('rIsBGPopnOL', 'boolean'), ('IsManualFlag', 'boolean'), ('gBGSubSignal', 'float'), ('rBGSubSignal', 'float'),
+    ('gIsPosAndSignif', 'boolean'), ('rIsPosAndSignif', 'boolean'), ('gIsWellAboveBG', 'boolean'),
+    ('rIsWellAboveBG', 'boolean'), ('SpotExtentX', 'float'), ('gBGMeanSignal', 'float'), ('rBGMeanSignal', 'float')]
+
+FE_HEADER = "\n".join([
+    "TYPE\ttext\ttext\ttext\ttext\ttext",
+    "FEPARAMS\tProtocol_Name\tScan_ScannerName\tScan_Date\tFeatureExtractor_Barcode\tGrid_Name",
+    "DATA\tCGH_1100_Jul11\tSG12345678\t01-01-2018 09:00:00\t%(barcode)s\t021924_D_F_20091001",
+    "*",
+    "TYPE\tfloat\tfloat\tinteger\tinteger",
+    "STATS\tgDarkOffsetAverage\trDarkOffsetAverage\tgNumSatFeat\trNumSatFeat",
+    "DATA\t24.5\t30.1\t%(g_saturated)d\t%(r_saturated)d",
+    "*",
+    "TYPE\t" + "\t".join(column_type for _, column_type in FE_COLUMNS),
+    "FEATURES\t" + "\t".join(name for name, _ in FE_COLUMNS),
+    ""])
 
-args = parser.parse_args()
+# Median signal reported for a saturated feature:
+SATURATED_SIGNAL = 65527.0
 
-filename = args.file
+# Scenarios that can be injected into a sample channel:
+SCENARIOS = [
+    'replicate_failure',  # One replicate of one of the sample's probes is not saturated
+    'probe_failure',  # All replicates of one of the sample's probes are not saturated
+    'contamination',  # A probe from another sample is saturated in addition to the sample's own trio
+    'weak_contamination',  # A probe from another sample has raised, but unsaturated, signal
+    'switch',  # The sample's trio is swapped with that of another sample
+]
+
+# Template of an FE file. Every generated file copies the template rows, only the rows of spike in probes are
+# regenerated for each file:
+FETemplate = collections.namedtuple('FETemplate', [
+    'header',  # Text preceding the FEATURES data rows, formatted with the slide barcode and saturation stats
+    'columns',  # Names of the FEATURES columns
+    'rows',  # FEATURES data rows as bytes
+    'spike_rows',  # Ordered dictionary of spike in probe -> positions of its replicates in rows
+])
 
 
 def down_sample_fe_file(fe_file):
     """Downsamples the provided file to provide a minimal user example of a Feature Extraction file for use
      in testing.It does this by only including lines in the file which correspond to spike in probes listed in the
      provide config.yaml file."""
+    from analysis_helpers import parse_config_file
     # Parse config.yaml file for all probes available to 'spike into' samples:
     spike_in_probes = parse_config_file()
     # Read in user selected Feature Extraction file which will form the template for all generated test files.
@@ -39,24 +90,239 @@ def down_sample_fe_file(fe_file):
     return df
 
 
-def generate_test_files(df):
-    """"Takes a dataframe from downSampleFEfile() and generates a range of test data for array_spiker.py. It does this
-    by replacing"""
+def build_synthetic_template(spike_in_probes, num_features=NUM_FEATURES, replicates=3, seed=0):
+    """Build a full size FE file template with background signal for num_features features, replicates of each spike
+    in probe being placed at random positions. Columns are generated as numpy arrays and written in one pass."""
+    random_state = np.random.RandomState(seed)
+    num_cols = min(num_features, 1068)  # Features per row of the array
+    feature_num = np.arange(1, num_features + 1)
+    row, col = (feature_num - 1) // num_cols + 1, (feature_num - 1) % num_cols + 1
+    probe_names = np.char.add("A_16_P", np.char.zfill(np.arange(num_features).astype(str), 8)).astype(object)
+    spike_positions = random_state.choice(num_features, len(spike_in_probes) * replicates, replace=False)
+    probe_names[spike_positions] = np.repeat(spike_in_probes, replicates)
+    g_signal = random_state.lognormal(5.5, 0.6, num_features)
+    r_signal = g_signal * random_state.lognormal(0, 0.15, num_features)
+    g_background = random_state.normal(45, 3, num_features)
+    r_background = random_state.normal(50, 3, num_features)
+    zeros = np.zeros(num_features, dtype=int)
+    data = collections.OrderedDict([
+        ('FeatureNum', feature_num), ('Row', row), ('Col', col),
+        ('SubTypeMask', zeros), ('ControlType', zeros), ('ProbeName', probe_names),
+        ('SystematicName', np.char.add("chr1:", (feature_num * 1000).astype(str)).astype(object)),
+        ('PositionX', col * 20.0 + 480), ('PositionY', row * 20.0 + 480),
+        ('LogRatio', np.log10(r_signal / g_signal)), ('LogRatioError', np.full(num_features, 0.05)),
+        ('PValueLogRatio', np.full(num_features, 0.5)),
+        ('gProcessedSignal', g_signal - g_background), ('rProcessedSignal', r_signal - r_background),
+        ('gProcessedSigError', np.sqrt(g_signal)), ('rProcessedSigError', np.sqrt(r_signal)),
+        ('gMedianSignal', g_signal), ('rMedianSignal', r_signal),
+        ('gBGMedianSignal', g_background), ('rBGMedianSignal', r_background),
+        ('gBGPixSDev', np.full(num_features, 8.0)), ('rBGPixSDev', np.full(num_features, 9.0)),
+        ('gBGSubSignal', g_signal - g_background), ('rBGSubSignal', r_signal - r_background),
+        ('SpotExtentX', np.full(num_features, 60.0)),
+        ('gBGMeanSignal', g_background), ('rBGMeanSignal', r_background)])
+    for name, column_type in FE_COLUMNS:
+        if column_type == 'boolean':
+            data[name] = zeros  # Flags are not set in the background
+    df = pandas.DataFrame(data, columns=[name for name, _ in FE_COLUMNS])
+    df.insert(0, 'DATA', "DATA")
+    rows = df.to_csv(sep="\t", header=False, index=False, float_format="%.5g").encode('ascii').splitlines(True)
+    spike_rows = collections.OrderedDict((probe, sorted(np.nonzero(probe_names == probe)[0].tolist()))
+                                         for probe in spike_in_probes)
+    return FETemplate(FE_HEADER, [name for name, _ in FE_COLUMNS], rows, spike_rows)
 
-    # Set IsSaturated flags to false
-    df['gIsSaturated'] = 0
-    df['rIsSaturated'] = 0
 
-    # Generate files a correctly run sample:
+def load_template(fe_file, spike_in_probes):
+    """Use an existing FE file as the template for generated files"""
+    with open(fe_file, "rb") as f:
+        lines = f.read().splitlines(True)
+    features = [i for i, line in enumerate(lines) if line.startswith(b"FEATURES")][0]
+    columns = lines[features].rstrip(b"\r\n").decode('ascii').split("\t")[1:]
+    header = b"".join(lines[:features + 1]).decode('ascii').replace("%", "%%")
+    rows = lines[features + 1:]
+    probe_col = columns.index('ProbeName') + 1
+    spike_rows = collections.OrderedDict((probe, []) for probe in spike_in_probes)
+    for i, row in enumerate(rows):
+        probe = row.split(b"\t", probe_col + 1)[probe_col].decode('ascii')
+        if probe in spike_rows:
+            spike_rows[probe].append(i)
+    return FETemplate(header, columns, rows, spike_rows)
 
-    # Generate files simulating failure of one or more replicates on the array:
 
-    # Generate files simulating failure of one or more probes:
+def write_fe_file(fe_file, template, saturated, signal, barcode, random_state):
+    """Write an FE file from the template. saturated and signal are probes x replicates x channels arrays (probes in
+    the order of template.spike_rows) giving the saturation flag and median signal of each spike in feature. Only
+    the spike in rows are formatted, all other rows are copied from the template."""
+    rows = list(template.rows)
+    column_index = dict((name, i + 1) for i, name in enumerate(template.columns))
+    for p, positions in enumerate(template.spike_rows.values()):
+        for r, position in enumerate(positions):
+            fields = rows[position].rstrip(b"\r\n").split(b"\t")
+            for c, channel in enumerate("gr"):
+                median_signal = SATURATED_SIGNAL if saturated[p, r, c] else signal[p, r, c]
+                background = float(fields[column_index[channel + 'BGMedianSignal']])
+                processed = median_signal - background
+                if saturated[p, r, c]:
+                    processed *= random_state.uniform(1.0, 2.5)  # Processed signal is not capped by saturation
+                fields[column_index[channel + 'MedianSignal']] = b"%.5g" % median_signal
+                fields[column_index[channel + 'ProcessedSignal']] = b"%.5g" % processed
+                fields[column_index[channel + 'IsSaturated']] = b"1" if saturated[p, r, c] else b"0"
+            rows[position] = b"\t".join(fields) + b"\n"
+    header = template.header % {'barcode': barcode, 'g_saturated': saturated[..., 0].sum(),
+                                'r_saturated': saturated[..., 1].sum()}
+    with open(fe_file, "wb") as f:
+        f.write(header.encode('ascii'))
+        f.writelines(rows)
 
-    # Save generated files:
-    return df
 
+def plate_layout(spike_in_probes, half_plate=False, spike_in_set="A", layout_file=None):
+    """Return the (green trio, red trio) spiked into each sample of a plate. A full plate has 48 samples (FE files),
+    a half plate (wells A-H:1-3 & A-H:7-9) has 24"""
+    from analysis_helpers import calculate_spiked_probes_combinations
+    from trio_helpers import PLATE_WELLS, assign_trios_to_wells, read_trio_layout
+    if layout_file is not None:
+        trios = read_trio_layout(layout_file)
+    else:
+        trios = calculate_spiked_probes_combinations(spike_in_probes)[:len(PLATE_WELLS)]
+    wells, channels = assign_trios_to_wells(trios, spike_in_set)
+    green = [trio for trio, well, channel in zip(trios, wells, channels) if channel == 'g' and
+             (not half_plate or int(well[1:]) in (1, 2, 3, 7, 8, 9))]
+    red = [trio for trio, well, channel in zip(trios, wells, channels) if channel == 'r' and
+           (not half_plate or int(well[1:]) in (1, 2, 3, 7, 8, 9))]
+    return list(zip(green, red))
+
+
+def generate_test_files(template, output_dir, layout, scenarios=None, first_barcode=258503010101, seed=0):
+    """"Takes a template from build_synthetic_template() or load_template() and generates the FE files for a plate
+    laid out as layout (see plate_layout()), 8 samples per slide. scenarios is a dictionary of scenario name (see
+    SCENARIOS) -> number of sample channels to inject it into, the affected sample channels being chosen at random.
+    Returns the FE files written, the expected spike in profile for array_spiker.py and a dataframe recording the
+    injected scenarios."""
+    from analysis_helpers import make_pretty_label
+    from naming_helpers import create_sample_filename
+    random_state = np.random.RandomState(seed)
+    probes = list(template.spike_rows)
+    num_replicates = max(len(rows) for rows in template.spike_rows.values())
+    num_samples = len(layout)
+    # FE file of each sample, 8 subarrays per slide:
+    samples = [os.path.join(output_dir, create_sample_filename(str(first_barcode + s // 8), s % 8 + 1))
+               for s in range(num_samples)]
+    labels = [make_pretty_label(fe_file) for fe_file in samples]
+    # Trio spiked into each sample channel, probes x channels, before any scenario is injected:
+    spiked = np.zeros((num_samples, len(probes), 2), dtype=bool)
+    for s, trios in enumerate(layout):
+        for c, trio in enumerate(trios):
+            spiked[s, [probes.index(probe) for probe in trio], c] = True
+    expected = spiked.copy()
+
+    # Set IsSaturated flags for the spiked probes, then inject scenarios:
+    saturated = np.repeat(spiked[:, :, np.newaxis, :], num_replicates, axis=2)
+    signal = random_state.lognormal(5.5, 0.5, saturated.shape)
+    events = []
+    sample_channels = [(s, c) for s in range(num_samples) for c in range(2)]
+    order = random_state.permutation(len(sample_channels))
+    chosen = 0
+    for scenario in SCENARIOS:
+        for _ in range((scenarios or {}).get(scenario, 0)):
+            s, c = sample_channels[order[chosen % len(order)]]
+            chosen += 1
+            own = np.nonzero(spiked[s, :, c])[0]
+            other = np.nonzero(~spiked[s, :, c])[0]
+            if scenario == 'replicate_failure':
+                p, r = random_state.choice(own), random_state.randint(num_replicates)
+                saturated[s, p, r, c] = False
+                detail = "%s replicate %d" % (probes[p], r + 1)
+            elif scenario == 'probe_failure':
+                p = random_state.choice(own)
+                saturated[s, p, :, c] = False
+                detail = probes[p]
+            elif scenario == 'contamination':
+                p = random_state.choice(other)
+                saturated[s, p, :, c] = True
+                detail = probes[p]
+            elif scenario == 'weak_contamination':
+                p = random_state.choice(other)
+                signal[s, p, :, c] = random_state.uniform(2000, 10000, num_replicates)
+                detail = probes[p]
+            else:  # switch
+                t = (s + 1 + random_state.randint(num_samples - 1)) % num_samples
+                saturated[[s, t], :, :, c] = saturated[[t, s], :, :, c]
+                detail = "with %s" % labels[t]
+                # Both samples of the switch have the other's profile:
+                events.append((t, c, scenario, "with %s" % labels[s]))
+            events.append((s, c, scenario, detail))
+
+    # Write each sample's FE file:
+    for s, fe_file in enumerate(samples):
+        write_fe_file(fe_file, template, saturated[s], signal[s], str(first_barcode + s // 8), random_state)
+
+    expected_rows = [{'Sample': labels[s], 'ProbeName': probe,
+                      'gSpike': int(expected[s, p, 0]), 'rSpike': int(expected[s, p, 1])}
+                     for s in range(num_samples) for p, probe in enumerate(probes)]
+    expected_df = pandas.DataFrame(expected_rows, columns=['Sample', 'ProbeName', 'gSpike', 'rSpike'])
+    scenarios_df = pandas.DataFrame([{'Sample': labels[s], 'Channel': "gr"[c], 'Scenario': scenario,
+                                      'Detail': detail} for s, c, scenario, detail in events],
+                                    columns=['Sample', 'Channel', 'Scenario', 'Detail'])
+    return samples, expected_df, scenarios_df
+
+
+def parse_scenarios(values):
+    """Parse scenario=count strings from the command line"""
+    scenarios = {}
+    for value in values or []:
+        name, _, count = value.partition("=")
+        if name not in SCENARIOS:
+            raise ValueError("Unknown scenario %s - Use one of %s" % (name, ", ".join(SCENARIOS)))
+        scenarios[name] = int(count or 1)
+    return scenarios
+
+
+def get_arguments(argv=None):
+    """Import Arguments from command line"""
+    parser = argparse.ArgumentParser(
+        description='Generate test data FE files for testing array_spiker.py')
+    parser.add_argument('-file', '-f', type=str,
+                        help='Optional FE file used as the template. By default a synthetic full size template is '
+                             'used')
+    parser.add_argument('-output_dir', '-o', type=str, help='File path to output directory', required=True)
+    parser.add_argument('-create_template', action='store_true',
+                        help='Print the spike in rows of the template file given with -file and exit')
+    parser.add_argument('-plates', type=int, default=1, help='Number of plates to generate (default 1)')
+    parser.add_argument('-half_plate', action='store_true', help='Generate half plates (24 FE files) not full (48)')
+    parser.add_argument('-spike_in_set', choices=['A', 'B'], default='A', help='Spike in set used (default A)')
+    parser.add_argument('-layout', type=str, help='Optional plate layout CSV produced by design_spike_ins.py')
+    parser.add_argument('-scenarios', nargs='+',
+                        help='Scenarios to inject into each plate as scenario=count, one of: %s' %
+                             ", ".join(SCENARIOS))
+    parser.add_argument('-features', type=int, default=NUM_FEATURES,
+                        help='Number of features in the synthetic template (default %d)' % NUM_FEATURES)
+    parser.add_argument('-seed', type=int, default=0, help='Random seed (default 0)')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = get_arguments(argv)
+    from analysis_helpers import parse_config_file
+    spike_in_probes = parse_config_file()
+    if args.create_template:
+        print(down_sample_fe_file(args.file))
+        return
+    if args.file is not None:
+        template = load_template(args.file, spike_in_probes)
+    else:
+        template = build_synthetic_template(spike_in_probes, args.features, seed=args.seed)
+    layout = plate_layout(spike_in_probes, args.half_plate, args.spike_in_set, args.layout)
+    scenarios = parse_scenarios(args.scenarios)
+    for plate in range(args.plates):
+        plate_dir = os.path.join(args.output_dir, "plate_%d" % (plate + 1))
+        if not os.path.exists(plate_dir):
+            os.makedirs(plate_dir)
+        fe_files, expected_df, scenarios_df = generate_test_files(
+            template, plate_dir, layout, scenarios,
+            first_barcode=258503010101 + plate * 10, seed=args.seed + plate)
+        expected_df.to_csv(os.path.join(plate_dir, "expected_spike_ins.csv"), index=False)
+        scenarios_df.to_csv(os.path.join(plate_dir, "injected_scenarios.csv"), index=False)
+        print("Generated %d FE files in: %s" % (len(fe_files), plate_dir))
 
-print(generate_test_files(down_sample_fe_file(filename)))
 
-print(generate_test_files(down_sample_fe_file("./test_files/258503010103_S01_Guys121919_CGH_1100_Jul11_2_1_3.txt")))
+if __name__ == '__main__':
+    main()
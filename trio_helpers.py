@@ -0,0 +1,312 @@
+"""Helper functions for arraySpiker which decode the trio of spike in probes detected in each sample into the plate well
+(and channel) it was assigned to, and check the detected trios against those expected from the sample sheet.
+
+Each trio is represented as a bitmask over the spike in probe panel (bit i set if spike_in_probes[i] is in the trio)
+so that the Hamming distance between a detected and an assigned trio is the popcount of their XOR."""
+
+from __future__ import print_function
+import collections
+import itertools
+import numpy as np
+import pandas
+
+# Plate wells in the order trios are assigned to them (down each column: A1, B1 ... H1, A2 ... H12):
+PLATE_ROWS = "ABCDEFGH"
+PLATE_WELLS = ["%s%d" % (row, column) for column in range(1, 13) for row in PLATE_ROWS]
+
+CHANNELS = ('g', 'r')
+
+# Above this many probes the nearest trio table (2**n entries) is not precomputed and nearest trios are found by
+# comparing against every assigned trio instead. Building the table costs more than decoding a run directly once it
+# has more than a few thousand entries:
+MAX_TABLE_PROBES = 12
+
+# Status of each sample/channel returned by check_sample_identity():
+PASS = "PASS"  # Detected trio matches the sample sheet
+PARTIAL_MATCH = "PARTIAL_MATCH"  # <3 probes detected but only the expected trio is consistent with them
+AMBIGUOUS = "AMBIGUOUS"  # <3 probes detected, consistent with the expected trio and at least one other
+MISMATCH = "MISMATCH"  # Detected probes identify a different trio - possible sample switch
+CONTAMINATION = "CONTAMINATION"  # >3 probes detected - possible cross-contamination
+NOT_DETECTED = "NOT_DETECTED"  # No spike in probes detected
+MISSING = "MISSING"  # No spike in probe rows for the sample, e.g. its FE file is missing or the probes were renamed
+
+TrioIndex = collections.namedtuple('TrioIndex', [
+    'probes',  # Spike in probe panel, bit i corresponds to probes[i]
+    'trio_masks',  # Bitmask of each assigned trio, in plate order
+    'wells',  # Plate well each trio is assigned to
+    'channels',  # Channel ('g' or 'r') each trio is assigned to
+    'channel_trios',  # Positions in trio_masks of the trios assigned to each channel, in the order of CHANNELS
+    'trio_lookup',  # Dictionary of (channel, trio bitmask) -> position in trio_masks
+    # Tables indexed [channel, bitmask], each channel only considering the trios assigned to it:
+    'nearest_distance',  # Hamming distance to the nearest trio(s)
+    'nearest_trio',  # Position of the nearest trio, -1 if several are equally near
+    'nearest_count',  # Number of trios at the nearest distance
+])
+
+# Number of set bits in each byte value, used by popcount():
+_BYTE_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
+def popcount(values):
+    """Vectorised count of the set bits in each element of an integer array"""
+    values = np.ascontiguousarray(values, dtype=np.uint64)
+    return _BYTE_POPCOUNT[values.view(np.uint8)].reshape(values.shape + (8,)).sum(axis=-1)
+
+
+def probes_to_bitmask(probes, spike_in_probes):
+    """Return the bitmask representing a collection of probes"""
+    mask = 0
+    for probe in probes:
+        mask |= 1 << spike_in_probes.index(probe)
+    return mask
+
+
+def bitmask_to_probes(mask, spike_in_probes):
+    """Return the list of probes represented by a bitmask"""
+    return [probe for i, probe in enumerate(spike_in_probes) if mask >> i & 1]
+
+
+def assign_trios_to_wells(trios, spike_in_set="A"):
+    """Assign trios to plate wells and channels. The first half of the trios is used for the red channel and the
+    second half for the green channel in set A; set B swaps the channels (see user_requirements.md). Returns lists of
+    wells and channels in the order of trios."""
+    if spike_in_set not in ("A", "B"):
+        raise ValueError("Unexpected spike in set %s - Use A or B" % spike_in_set)
+    half = len(trios) // 2
+    first, second = ('r', 'g') if spike_in_set == "A" else ('g', 'r')
+    channels = [first if i < half else second for i in range(len(trios))]
+    return PLATE_WELLS[:len(trios)], channels
+
+
+def _nearest_trios(masks, trio_masks, positions):
+    """For each bitmask find the Hamming distance to the nearest of the trios at positions in trio_masks, the position
+    of the nearest trio (-1 if there is a tie) and the number of trios at that distance"""
+    distances = popcount(np.bitwise_xor(np.asarray(masks, dtype=np.int64)[:, np.newaxis],
+                                        trio_masks[positions][np.newaxis, :]))
+    nearest_distance = distances.min(axis=1)
+    nearest_count = (distances == nearest_distance[:, np.newaxis]).sum(axis=1)
+    nearest_trio = np.where(nearest_count == 1, positions[distances.argmin(axis=1)], -1)
+    return nearest_distance, nearest_trio, nearest_count
+
+
+def build_trio_index(spike_in_probes, trios, spike_in_set="A", chunk_size=1 << 14):
+    """Build the decoding index for a plate layout. trios is the list of probe trios in plate order (see
+    assign_trios_to_wells()). The probes detected in a channel are only decoded against the trios assigned to that
+    channel. Where the panel has no more than MAX_TABLE_PROBES probes the nearest trio of each channel for every
+    possible bitmask is precomputed so that decoding is a table lookup."""
+    trio_masks = np.array([probes_to_bitmask(trio, spike_in_probes) for trio in trios], dtype=np.int64)
+    wells, channels = assign_trios_to_wells(trios, spike_in_set)
+    channel_trios = tuple(np.array([i for i, trio_channel in enumerate(channels) if trio_channel == channel],
+                                   dtype=np.int64) for channel in CHANNELS)
+    trio_lookup = dict(((channel, mask), i) for i, (channel, mask) in enumerate(zip(channels, trio_masks.tolist())))
+    nearest_distance = nearest_trio = nearest_count = None
+    if len(spike_in_probes) <= MAX_TABLE_PROBES:
+        num_masks = 1 << len(spike_in_probes)
+        nearest_distance = np.empty((len(CHANNELS), num_masks), dtype=np.int8)
+        nearest_trio = np.empty((len(CHANNELS), num_masks), dtype=np.int32)
+        nearest_count = np.empty((len(CHANNELS), num_masks), dtype=np.int32)
+        # Built in chunks to limit the size of the intermediate distance matrix:
+        for c, positions in enumerate(channel_trios):
+            for start in range(0, num_masks, chunk_size):
+                masks = np.arange(start, min(start + chunk_size, num_masks), dtype=np.int64)
+                (nearest_distance[c, start:start + len(masks)], nearest_trio[c, start:start + len(masks)],
+                 nearest_count[c, start:start + len(masks)]) = _nearest_trios(masks, trio_masks, positions)
+    return TrioIndex(list(spike_in_probes), trio_masks, wells, channels, channel_trios, trio_lookup,
+                     nearest_distance, nearest_trio, nearest_count)
+
+
+def decode_trio(index, mask, channel):
+    """Return the position of the trio assigned to channel ('g' or 'r') matching a detected bitmask exactly, or
+    None"""
+    return index.trio_lookup.get((channel, int(mask)))
+
+
+def nearest_trios(index, mask, channel):
+    """Return the Hamming distance to the nearest trio(s) assigned to channel ('g' or 'r') and the list of their
+    positions"""
+    c = CHANNELS.index(channel)
+    mask = int(mask)
+    if index.nearest_distance is not None:
+        distance = int(index.nearest_distance[c, mask])
+        if index.nearest_count[c, mask] == 1:
+            return distance, [int(index.nearest_trio[c, mask])]
+    else:
+        distance = int(_nearest_trios([mask], index.trio_masks, index.channel_trios[c])[0][0])
+    positions = index.channel_trios[c]
+    return distance, positions[popcount(np.bitwise_xor(mask, index.trio_masks[positions])) == distance].tolist()
+
+
+def decode_bitmasks(index, masks):
+    """Batch decode a samples x channels array of detected bitmasks, each channel against the trios assigned to it.
+    Returns arrays (shaped as masks) of the exact trio position (-1 if none), the distance to the nearest trio(s),
+    the nearest trio position (-1 if tied) and the number of nearest trios"""
+    masks = np.asarray(masks, dtype=np.int64)
+    nearest_distance, nearest_trio, nearest_count = [np.empty(masks.shape, dtype=np.int64) for _ in range(3)]
+    for c, positions in enumerate(index.channel_trios):
+        if index.nearest_distance is not None:
+            decoded = (index.nearest_distance[c, masks[:, c]], index.nearest_trio[c, masks[:, c]],
+                       index.nearest_count[c, masks[:, c]])
+        else:
+            decoded = _nearest_trios(masks[:, c], index.trio_masks, positions)
+        nearest_distance[:, c], nearest_trio[:, c], nearest_count[:, c] = decoded
+    # Assigned trios are unique, so a bitmask at distance 0 has exactly one nearest trio:
+    exact = np.where(nearest_distance == 0, nearest_trio, -1)
+    return exact, nearest_distance, nearest_trio, nearest_count
+
+
+def expected_bitmasks(expected_df, samples, spike_in_probes):
+    """Convert the expected spike in profile into a samples x channels array of bitmasks aligned with samples.
+    expected_df requires the fields Sample, ProbeName, gSpike and rSpike, where gSpike/rSpike are 0 or 1. Samples
+    missing from expected_df are given a bitmask of -1."""
+    probe_bits = pandas.Series(np.left_shift(1, np.arange(len(spike_in_probes), dtype=np.int64)),
+                               index=spike_in_probes)
+    bits = probe_bits.reindex(expected_df['ProbeName']).fillna(0).astype(np.int64).values
+    masks = np.full((len(samples), len(CHANNELS)), -1, dtype=np.int64)
+    for channel, field in enumerate(('gSpike', 'rSpike')):
+        channel_masks = pandas.Series(bits * (expected_df[field].values > 0)).groupby(
+            expected_df['Sample'].astype(str).values).sum()
+        masks[:, channel] = channel_masks.reindex(samples).fillna(-1).astype(np.int64).values
+    return masks
+
+
+def align_bitmasks(masks, samples, all_samples):
+    """Align a samples x channels array of bitmasks with all_samples, which includes samples. Samples with no
+    bitmask (e.g. an FE file with no spike in probe rows) are given -1."""
+    aligned = np.full((len(all_samples), len(CHANNELS)), -1, dtype=np.int64)
+    aligned[pandas.Index(all_samples).get_indexer(samples)] = masks
+    return aligned
+
+
+def check_sample_identity(index, samples, detected_masks, expected_masks):
+    """Compare the detected trio of each sample/channel to that expected from the sample sheet. detected_masks and
+    expected_masks are samples x channels bitmask arrays, -1 where the sample has no FE data or is not on the sample
+    sheet. Returns a dataframe with one row per sample/channel giving the expected and detected probes, the wells
+    they decode to and a status (see PASS etc. above)."""
+    detected_masks = np.asarray(detected_masks, dtype=np.int64)
+    expected_masks = np.asarray(expected_masks, dtype=np.int64)
+    missing = detected_masks < 0
+    exact, nearest_distance, nearest_trio, nearest_count = decode_bitmasks(index, np.where(missing, 0, detected_masks))
+    num_detected = np.where(missing, 0, popcount(detected_masks))
+    # Expected trio is among the nearest trios to the detected probes:
+    consistent = popcount(np.bitwise_xor(detected_masks, expected_masks)) == nearest_distance
+    status = np.full(detected_masks.shape, MISMATCH, dtype=object)
+    status[consistent & (num_detected < 3)] = AMBIGUOUS
+    status[consistent & (num_detected < 3) & (nearest_count == 1)] = PARTIAL_MATCH
+    status[num_detected > 3] = CONTAMINATION
+    status[num_detected == 0] = NOT_DETECTED
+    # Also passes a channel with no DNA expected and no probes detected:
+    status[detected_masks == expected_masks] = PASS
+    status[missing] = MISSING
+
+    def wells(positions):
+        return ";".join(index.wells[i] for i in positions)
+
+    rows = []
+    for s, sample in enumerate(samples):
+        for c, channel in enumerate(CHANNELS):
+            detected = int(detected_masks[s, c])
+            expected = int(expected_masks[s, c])
+            expected_trio = index.trio_lookup.get((channel, expected))
+            nearest = nearest_trios(index, detected, channel)[1] if 0 < num_detected[s, c] < 3 else []
+            rows.append({
+                'Sample': sample, 'Channel': channel,
+                'ExpectedProbes': ";".join(bitmask_to_probes(expected, index.probes)) if expected >= 0 else "",
+                'DetectedProbes': ";".join(bitmask_to_probes(detected, index.probes)) if detected >= 0 else "",
+                'NumDetected': int(num_detected[s, c]),
+                'ExpectedWell': wells([expected_trio]) if expected_trio is not None else "",
+                'DetectedWell': wells([exact[s, c]]) if exact[s, c] >= 0 else "",
+                'NearestWells': wells(nearest),
+                'Status': status[s, c]})
+    columns = ['Sample', 'Channel', 'ExpectedProbes', 'DetectedProbes', 'NumDetected', 'ExpectedWell',
+               'DetectedWell', 'NearestWells', 'Status']
+    return pandas.DataFrame(rows, columns=columns)
+
+
+def read_trio_layout(layout_file):
+    """Read a plate layout CSV (fields Well and Probes, the trio's probes delimited by ;) returning the list of trios
+    in plate order"""
+    layout_df = pandas.read_csv(layout_file)
+    layout_df['Position'] = [PLATE_WELLS.index(well) for well in layout_df['Well']]
+    layout_df = layout_df.sort_values(by='Position')
+    return [tuple(probes.split(";")) for probes in layout_df['Probes']]
+
+
+def write_trio_layout(trios, layout_file):
+    """Save a plate layout (list of trios in plate order) as a CSV readable by read_trio_layout()"""
+    layout_df = pandas.DataFrame({'Well': PLATE_WELLS[:len(trios)], 'Probes': [";".join(trio) for trio in trios]},
+                                 columns=['Well', 'Probes'])
+    layout_df.to_csv(layout_file, index=False)
+    return layout_file
+
+
+def layout_min_distance(trio_masks):
+    """Minimum pairwise Hamming distance between the trio bitmasks of a layout"""
+    trio_masks = np.asarray(trio_masks, dtype=np.int64)
+    distances = popcount(np.bitwise_xor(trio_masks[:, np.newaxis], trio_masks[np.newaxis, :]))
+    distances[np.diag_indices(len(trio_masks))] = distances.max() + 1  # Ignore distance of each trio to itself
+    return int(distances.min())
+
+
+def _greedy_layout(membership, num_trios, random_state):
+    """Choose num_trios rows of the candidate/probe membership matrix one at a time. Each step picks, from the
+    candidates sharing the fewest probes with any trio chosen so far, the one whose probes have been used least
+    (ties broken at random). Returns the positions of the chosen candidates."""
+    num_candidates = membership.shape[0]
+    max_shared = np.zeros(num_candidates, dtype=np.int64)  # Most probes shared with any chosen trio
+    available = np.ones(num_candidates, dtype=bool)
+    usage = np.zeros(membership.shape[1], dtype=np.int64)  # Number of chosen trios using each probe
+    chosen = []
+    for _ in range(num_trios):
+        candidates = np.nonzero(available)[0]
+        candidates = candidates[max_shared[candidates] == max_shared[candidates].min()]
+        usage_score = membership[candidates].dot(usage)
+        candidates = candidates[usage_score == usage_score.min()]
+        choice = candidates[random_state.randint(len(candidates))]
+        chosen.append(choice)
+        available[choice] = False
+        trio_probes = np.nonzero(membership[choice])[0]
+        usage[trio_probes] += 1
+        max_shared = np.maximum(max_shared, membership[:, trio_probes].sum(axis=1))
+    return chosen
+
+
+def design_trio_layout(spike_in_probes, num_trios=len(PLATE_WELLS), restarts=20, seed=None):
+    """Search for a plate layout of num_trios trios drawn from spike_in_probes which maximises the minimum pairwise
+    Hamming distance between trios and balances how often each probe is used. Runs a randomised greedy search
+    restarts times and returns the best layout found as a list of trios in plate order."""
+    candidate_trios = list(itertools.combinations(range(len(spike_in_probes)), 3))
+    if num_trios > len(candidate_trios):
+        raise ValueError("%d probes only give %d unique trios, %d required" % (
+            len(spike_in_probes), len(candidate_trios), num_trios))
+    membership = np.zeros((len(candidate_trios), len(spike_in_probes)), dtype=np.int64)
+    membership[np.repeat(np.arange(len(candidate_trios)), 3), np.array(candidate_trios).ravel()] = 1
+    candidate_masks = membership.dot(np.left_shift(1, np.arange(len(spike_in_probes), dtype=np.int64)))
+    random_state = np.random.RandomState(seed)
+    best_layout, best_score = None, None
+    for _ in range(restarts):
+        chosen = _greedy_layout(membership, num_trios, random_state)
+        usage = membership[chosen].sum(axis=0)
+        # Larger minimum distance first, then the smallest spread in probe usage:
+        score = (layout_min_distance(candidate_masks[chosen]), -(usage.max() - usage.min()))
+        if best_score is None or score > best_score:
+            best_layout, best_score = chosen, score
+    return [tuple(spike_in_probes[i] for i in candidate_trios[choice]) for choice in best_layout]
+
+
+def layout_to_expected_spike_ins(trios, spike_in_probes, spike_in_set="A", samples=None):
+    """Convert a plate layout into the expected spike in profile read by array_spiker.py (-spike_in_info), one row per
+    sample and probe. Each sample (FE file) carries one green and one red channel trio, so sample i is given the ith
+    trio assigned to each channel. Samples are numbered from 1 unless a list of sample labels is given."""
+    wells, channels = assign_trios_to_wells(trios, spike_in_set)
+    green_trios = [trio for trio, channel in zip(trios, channels) if channel == 'g']
+    red_trios = [trio for trio, channel in zip(trios, channels) if channel == 'r']
+    if samples is None:
+        samples = [str(i + 1) for i in range(len(green_trios))]
+    if len(samples) != len(green_trios):
+        raise ValueError("Layout requires %d samples, %d given" % (len(green_trios), len(samples)))
+    rows = []
+    for sample, green_trio, red_trio in zip(samples, green_trios, red_trios):
+        for probe in spike_in_probes:
+            rows.append({'Sample': sample, 'ProbeName': probe,
+                         'gSpike': int(probe in green_trio), 'rSpike': int(probe in red_trio)})
+    return pandas.DataFrame(rows, columns=['Sample', 'ProbeName', 'gSpike', 'rSpike'])
@@ -0,0 +1,146 @@
+"""Helper functions for watch_spiker.py which detect FE files as the scanner finishes writing them and collect the
+parsed rows of each run until all of its subarrays have arrived.
+
+On Linux, inotify (requires the optional inotify_simple package) reports each file written to the directory. Where
+inotify is unavailable, or does not work (e.g. on network shares), the directory is polled instead. Either way a file is
+considered complete once its size and modification time have not changed for a settling period, as a writer may close
+a file before all of it has been written."""
+
+from __future__ import print_function
+import collections
+import os
+import time
+import pandas
+from analysis_helpers import call_safely, make_pretty_label, parse_data_file
+from archive_helpers import is_fe_file
+
+
+class PollingWatcher(object):
+    """Reports files in a directory once their size and modification time are unchanged for settle seconds, and again
+    if they are rewritten. If file_names is given only those files are watched."""
+
+    def __init__(self, directory, interval=2.0, settle=5.0, file_names=None):
+        self.directory = directory
+        self.interval = interval
+        self.settle = settle
+        self.file_names = None if file_names is None else set(file_names)
+        self.pending = {}  # Path -> ((size, mtime), time first seen with that size and mtime)
+        self.reported = {}  # Path -> (size, mtime) when reported
+
+    def poll(self, timeout=None):
+        """Wait up to timeout seconds (default interval) and return the paths of files completed since the last poll"""
+        time.sleep(self.interval if timeout is None else min(timeout, self.interval))
+        now = time.time()
+        completed = []
+        file_names = os.listdir(self.directory) if self.file_names is None else list(self.file_names)
+        for file_name in sorted(file_names):
+            path = os.path.join(self.directory, file_name)
+            if not is_fe_file(file_name):
+                continue
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue  # Removed or renamed since listed
+            signature = (stat.st_size, stat.st_mtime)
+            if self.reported.get(path) == signature:
+                continue
+            seen = self.pending.get(path)
+            if seen is None or seen[0] != signature:
+                # New file, or still being written:
+                self.pending[path] = (signature, now)
+            elif now - seen[1] >= self.settle and now - stat.st_mtime >= self.settle:
+                del self.pending[path]
+                self.reported[path] = signature
+                completed.append(path)
+        return completed
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Uses inotify to find the files written to, or moved into, a directory rather than listing it. A writer may close
+    a file before it is complete (e.g. when copying it in chunks), so as when polling a file is only reported once its
+    size and modification time have been unchanged for settle seconds, and again if it is rewritten."""
+
+    def __init__(self, directory, settle=5.0):
+        from inotify_simple import INotify, flags
+        self.directory = directory
+        self.inotify = INotify()
+        self.inotify.add_watch(directory, flags.CLOSE_WRITE | flags.MOVED_TO)
+        # Files waiting to settle, starting with those already in the directory which may still be being written:
+        self.settling = PollingWatcher(directory, interval=0, settle=settle, file_names=os.listdir(directory))
+
+    def poll(self, timeout=None):
+        """Wait up to timeout seconds (default 1) and return the paths of files completed since the last poll"""
+        for event in self.inotify.read(timeout=int(1000 * (1.0 if timeout is None else timeout))):
+            if is_fe_file(event.name):
+                self.settling.file_names.add(event.name)
+        completed = self.settling.poll(0)
+        for path in completed:
+            # Watched again once inotify reports it has been rewritten:
+            self.settling.file_names.discard(os.path.basename(path))
+        return completed
+
+    def close(self):
+        self.inotify.close()
+
+
+def create_watcher(directory, polling=False, interval=2.0, settle=5.0):
+    """Return an InotifyWatcher if inotify is available (and polling is False), otherwise a PollingWatcher"""
+    if not polling:
+        try:
+            return InotifyWatcher(directory, settle)
+        except (ImportError, OSError):
+            pass  # inotify_simple not installed, or not supported on this platform or file system
+    return PollingWatcher(directory, interval, settle)
+
+
+class RunState(object):
+    """Rows parsed so far for one run, held until every expected subarray (FE file label) has arrived"""
+
+    def __init__(self, name, expected_labels, argv):
+        self.name = name
+        self.expected_labels = set(expected_labels)
+        self.argv = argv  # array_spiker.py arguments used to analyse the run, other than the FE files
+        self.files = collections.OrderedDict()  # Label -> FE file
+        self.frames = collections.OrderedDict()  # Label -> parsed rows
+        self.started = None
+
+    def add(self, fe_file, df):
+        """Store the rows of each expected subarray in df (parsed from fe_file, which may be a slide archive). Returns
+        the labels added."""
+        if self.started is None:
+            self.started = time.time()
+        labels = df['FE_filename'].apply(make_pretty_label)
+        added = []
+        for label, label_df in df.groupby(labels, sort=False):
+            if label in self.expected_labels:
+                self.files[label] = fe_file
+                self.frames[label] = label_df
+                added.append(label)
+        return added
+
+    @property
+    def missing(self):
+        return sorted(self.expected_labels - set(self.frames))
+
+    @property
+    def complete(self):
+        return not self.missing
+
+    def fe_files(self):
+        """Return the FE files holding the run's subarrays, each once"""
+        return list(collections.OrderedDict.fromkeys(self.files.values()))
+
+    def data_frame(self):
+        return pandas.concat(list(self.frames.values()), ignore_index=True)
+
+
+def parse_arrived_file(fe_file, spike_in_probes, cache_dir=None):
+    """Parse a newly completed FE file, returning None (so that it can be retried if rewritten) if it could not be
+    parsed, e.g. as it is not a complete FE file"""
+    df, error = call_safely(parse_data_file, fe_file, spike_in_probes, cache_dir)
+    if error is not None:
+        print("WARNING: Could not parse %s: %s" % (fe_file, error))
+    return df
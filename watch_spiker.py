@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+
+"""
+This script watches the directory the scanner writes FE files to and runs the spike in QC (array_spiker.py) for a
+plate as soon as its last subarray arrives. Each FE file is parsed once it has been completely written, so parsing
+overlaps with scanning, and the rows held in memory until every FE file expected for the run (from -spike_in_info or
+MOKA) has arrived. Several runs may be watched at once. See watch_helpers.py.
+"""
+
+from __future__ import print_function
+import argparse
+import os
+import time
+
+
+def get_arguments(argv=None):
+    """Import Arguments from command line"""
+    parser = argparse.ArgumentParser(description='Run spike in QC for each plate as its FE files are written')
+    parser.add_argument('-watch_dir', '-w',
+                        type=str,
+                        help='Directory the scanner writes FE files to',
+                        required=True)
+    parser.add_argument('-output_dir', '-o',
+                        type=str,
+                        help='Directory the results of each run are saved to, in a folder named after the run',
+                        required=True)
+    runs = parser.add_mutually_exclusive_group(required=True)
+    runs.add_argument('-spike_in_info', '-s',
+                      nargs='+',
+                      help='Expected spike in profile of each run to watch for (see array_spiker.py). A run is '
+                           'analysed once an FE file has arrived for every Sample in its profile')
+    runs.add_argument('-run_id', '-r',
+                      nargs='+',
+                      type=int,
+                      help='MOKA run IDs to watch for. A run is analysed once all of its FE files have arrived and '
+                           'the results recorded in MOKA')
+    parser.add_argument('-spike_in_set',
+                        choices=['A', 'B'],
+                        default='A',
+                        help='Plate layout used to spike in probes, see array_spiker.py',
+                        required=False)
+    parser.add_argument('-layout',
+                        type=str,
+                        help='Optional plate layout CSV produced by design_spike_ins.py',
+                        required=False)
+    parser.add_argument('-plots',
+                        choices=['inline', 'background', 'none'],
+                        default='background',
+                        help='How plots are rendered once a run has been analysed (default background, so the '
+                             'verdict is not delayed)',
+                        required=False)
+    parser.add_argument('-polling',
+                        action='store_true',
+                        help='Poll the directory rather than using inotify, e.g. for network shares')
+    parser.add_argument('-interval',
+                        type=float,
+                        default=2.0,
+                        help='Seconds between polls of the directory (default 2)',
+                        required=False)
+    parser.add_argument('-settle',
+                        type=float,
+                        default=5.0,
+                        help='Seconds a file must be unchanged before it is considered complete (default 5)',
+                        required=False)
+    parser.add_argument('-timeout',
+                        type=float,
+                        help='Stop after this many seconds even if runs are incomplete. By default waits until every '
+                             'run has been analysed',
+                        required=False)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    """Watch for the FE files of each run, analysing each run once complete. Returns a dictionary of run name -> True
+    if the QC step has been passed, for each run analysed."""
+    args = get_arguments(argv)
+    # Imported once arguments are valid so that -h returns without loading pandas
+    import pandas
+    import array_spiker
+    from analysis_helpers import call_safely, make_pretty_label, parse_config_file
+    from watch_helpers import InotifyWatcher, RunState, create_watcher, parse_arrived_file
+
+    spike_in_probes = parse_config_file()
+    settings = ['-spike_in_set', args.spike_in_set, '-plots', args.plots]
+    if args.layout:
+        settings += ['-layout', args.layout]
+
+    # The FE file labels (e.g. 258503010103_2_1_3) expected for each run:
+    pending = []
+    for expected_file in args.spike_in_info or []:
+        labels = pandas.read_csv(expected_file, dtype={'Sample': str})['Sample'].unique()
+        name = os.path.splitext(os.path.basename(expected_file))[0]
+        pending.append(RunState(name, labels, ['-spike_in_info', expected_file]))
+    if args.run_id:
+        import moka_helpers
+        for run_id in args.run_id:
+            labels = [make_pretty_label(fe_file_name) for fe_file_name in
+                      moka_helpers.get_fe_file_name(run_id).values()]
+            pending.append(RunState("run_%d" % run_id, labels, ['-run_id', str(run_id)]))
+
+    watcher = create_watcher(args.watch_dir, args.polling, args.interval, args.settle)
+    print("Watching %s for %d run(s) using %s" % (args.watch_dir, len(pending),
+                                                 "inotify" if isinstance(watcher, InotifyWatcher) else "polling"))
+    results = {}
+    start = time.time()
+    try:
+        while pending:
+            if args.timeout is not None and time.time() - start > args.timeout:
+                for run in pending:
+                    print("TIMEOUT: %s is missing %d FE file(s): %s" % (run.name, len(run.missing),
+                                                                       ", ".join(run.missing)))
+                break
+            for fe_file in watcher.poll():
+                df = parse_arrived_file(fe_file, spike_in_probes)
+                if df is None:
+                    continue
+                for run in pending:
+                    if run.add(fe_file, df):
+                        print("%s: %d of %d FE files parsed (%s)" % (run.name, len(run.frames),
+                                                                      len(run.expected_labels),
+                                                                      os.path.basename(fe_file)))
+            for run in [run for run in pending if run.complete]:
+                pending.remove(run)
+                print("%s: all FE files arrived, running QC" % run.name)
+                argv = (['-file'] + run.fe_files() + ['-output_dir', os.path.join(args.output_dir, run.name)] +
+                        settings + run.argv)
+                passed, error = call_safely(array_spiker.main, argv, df=run.data_frame())
+                results[run.name] = bool(passed)
+                if error is not None:
+                    print("ERROR: %s could not be analysed, QC FAILED: %s" % (run.name, error))
+                    continue
+                print("%s: QC %s, %.1f seconds after its first FE file arrived" % (
+                    run.name, "PASSED" if passed else "FAILED", time.time() - run.started))
+    finally:
+        watcher.close()
+    return results
+
+
+if __name__ == '__main__':
+    main()